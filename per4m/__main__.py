@@ -12,6 +12,9 @@ positional arguments:
     record              Run VizTracer and perf simultaneously. See also man perf record.
     script              Take stacktraces from VizTracer, and inject them in perf script output.
     perf2trace          Convert perf.data to TraceEvent JSON data.
+    gilstats            Load GIL and scheduler events in NumPy arrays, for fast (repeated) analysis.
+    top                 Live, top like, view of who has the GIL, and who waits on it.
+    merge               Merge TraceEvent JSON files (e.g. of VizTracer and perf2trace) by timestamp, streaming.
 
 Examples:
 $ perf script --no-inline | per4m -v
@@ -26,6 +29,15 @@ def main(args=sys.argv):
     elif len(args) > 1 and args[1] == "perf2trace":
         from .perf2trace import main
         main([os.path.basename(args[0]) + " " + args[1]] + args[2:])
+    elif len(args) > 1 and args[1] == "gilstats":
+        from .eventstore import main
+        main([os.path.basename(args[0]) + " " + args[1]] + args[2:])
+    elif len(args) > 1 and args[1] == "top":
+        from .top import main
+        main([os.path.basename(args[0]) + " " + args[1]] + args[2:])
+    elif len(args) > 1 and args[1] == "merge":
+        from .tracemerge import main
+        main([os.path.basename(args[0]) + " " + args[1]] + args[2:])
     elif len(args) > 1 and args[1] == "giltracer":
         from .giltracer import main
     elif len(args) > 1 and args[1] == "offgil":
@@ -0,0 +1,156 @@
+import argparse
+import contextlib
+import os
+import re
+import sys
+import time
+
+from .perf2trace import perf2trace, gil2trace, parse_values, EventKinds, IGNORE, FUNCTION_ENTRY, FUNCTION_RETURN, TAKE, TAKE_RETURN, DROP, DROP_RETURN, SCHED_SWITCH, SCHED_WAKEUP
+from .perfutils import read_events, read_tokenized_events, parse_function_probe, parse_sched_switch, parse_sched_wakeup
+
+
+usage = """
+
+Benchmark the perf script parsers on a synthetic perf script dump (no perf needed).
+
+We time parsing the events like before the single pass tokenizer (per line, matching each event with re.match),
+and with the tokenizer, and then the whole conversion (gil2trace or perf2trace). The time to generate the input is
+measured separately, and left out.
+
+Usage:
+
+$ python -m per4m.benchmark --events 10000000
+$ python -m per4m.benchmark sched --events 1000000
+"""
+
+
+def synthetic_gil(events, threads=4):
+    """Yields perf script lines as produced by perf script --ns for the GIL uprobes and pytrace probes (no stacktraces)"""
+    t = 3485124.0
+    tids = [302629 + i for i in range(threads)]
+    cycle = [
+        ('python:take_gil', ' (563fc316fcc0)'),
+        ('python:take_gil__return', ' (563fc316fcc0 <- 563fc315691f)'),
+        ('pytrace:function_entry', ' (7f2b3c4d5e6f) filename="/home/user/per4m/example1.py" funcname="some_computation" l=15 what=0'),
+        ('pytrace:function_return', ' (7f2b3c4d5e70) filename="/home/user/per4m/example1.py" funcname="some_computation" l=17 what=3'),
+        ('python:drop_gil', ' (563fc316fd10)'),
+        ('python:drop_gil__return', ' (563fc316fd10 <- 563fc315691f)'),
+    ]
+    for i in range(events):
+        tid = tids[(i // len(cycle)) % threads]
+        event, rest = cycle[i % len(cycle)]
+        t += 0.000001234
+        yield f"          python {tid} [{tid % 64:03d}] {t:.9f}: {event}:{rest}\n"
+
+
+def synthetic_sched(events, threads=4):
+    """Yields perf script lines for sched_switch (with a short stacktrace)/sched_wakeup pairs"""
+    t = 3485124.0
+    tids = [302629 + i for i in range(threads)]
+    stacks = [
+        ["ffffffff9700008c __schedule+0x2c ([kernel.kallsyms])",
+         "55f1a2b3c4d5 take_gil+0x1d5 (/usr/bin/python3.8)",
+         "55f1a2b3c4d6 PyEval_RestoreThread+0x1d (/usr/bin/python3.8)"],
+        ["ffffffff9700008c __schedule+0x2c ([kernel.kallsyms])",
+         "7f2b3c4d5e6f __nanosleep+0x1d (/usr/lib/libc.so.6)"],
+    ]
+    for i in range(events):
+        tid = tids[(i // 2) % threads]
+        t += 0.000001234
+        if i % 2 == 0:
+            yield f"python {tid} [{tid % 64:03d}] {t:.9f}:       sched:sched_switch: prev_comm=python prev_pid={tid} prev_prio=120 prev_state=S ==> next_comm=swapper/11 next_pid=0 next_prio=120\n"
+            for line in stacks[(i // 2) % 2]:
+                yield f"\t{line}\n"
+        else:
+            yield f"swapper     0 [{tid % 64:03d}] {t:.9f}:       sched:sched_wakeup: comm=python pid={tid} prio=120 target_cpu={tid % 64:03d}\n"
+        yield "\n"
+
+
+# the probes as gil2trace matched them, in this order, before EventKinds
+REFERENCE_PROBES = [('pytrace:function_entry', FUNCTION_ENTRY), ('pytrace:function_return', FUNCTION_RETURN),
+                    ('python:take_gil$', TAKE), ('python:take_gil__return', TAKE_RETURN),
+                    ('python:drop_gil$', DROP), ('python:drop_gil__return', DROP_RETURN)]
+
+
+def reference_parse(lines):
+    """Yields the kind of each event, parsed like the converters did before perfutils.tokenize_header, to compare against"""
+    for header, stacktrace in read_events(lines):
+        parts = header.split()
+        event = parts[4][:-1]  # strip off ':'
+        if ":" in event:  # tracepoint
+            dso, triggerpid, cpu, time, _, *other = parts
+        else:  # counter etc
+            dso, triggerpid, time, count, _, *other = parts
+        triggerpid = int(triggerpid)
+        time = float(time[:-1]) * 1e6
+        if event == "sched:sched_switch":
+            parse_values(parts, prev_pid=int)
+            yield SCHED_SWITCH
+        elif event == "sched:sched_wakeup":
+            parse_values(parts, pid=int)
+            yield SCHED_WAKEUP
+        else:
+            kind = next((kind for probe, kind in REFERENCE_PROBES if re.match(probe, event)), IGNORE)
+            if kind == FUNCTION_ENTRY:
+                parse_values(other, l=int, what=int)
+            yield kind
+
+
+def tokenized_parse(lines):
+    """Yields the kind of each event, parsed like the converters do now (see reference_parse)"""
+    event_kinds = EventKinds()
+    for header, stacktrace, tokens in read_tokenized_events(lines):
+        comm, pid, cpu, time, count, event, other = tokens
+        kind = event_kinds[event]
+        if kind == FUNCTION_ENTRY:
+            parse_function_probe(other)
+        elif kind == SCHED_SWITCH:
+            parse_sched_switch(other)
+        elif kind == SCHED_WAKEUP:
+            parse_sched_wakeup(other)
+        yield kind
+
+
+def timed(iterable):
+    # returns the time it takes to consume iterable, and the number of items
+    count = 0
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        for _ in iterable:
+            count += 1
+    return time.perf_counter() - t0, count
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     usage=usage)
+    parser.add_argument('--events', '-n', type=int, default=10_000_000, help="Number of synthetic events (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=4, help="Number of synthetic threads (default: %(default)s)")
+    parser.add_argument('--reference', help="Also time parsing like before the tokenizer, to see the speedup (default: %(default)s)", default=True, action='store_true')
+    parser.add_argument('--no-reference', dest="reference", action='store_false')
+    parser.add_argument("type", help="Type of conversion to benchmark (default: %(default)s)", choices=['sched', 'gil'], nargs='?', default='gil')
+    args = parser.parse_args(argv[1:])
+
+    synthetic = synthetic_gil if args.type == "gil" else synthetic_sched
+    dt_input, _ = timed(synthetic(args.events, args.threads))
+    print(f"{args.type}: generating {args.events} events takes {dt_input:.2f} sec, which we leave out")
+
+    if args.reference:
+        dt_before, _ = timed(reference_parse(synthetic(args.events, args.threads)))
+        dt_before -= dt_input
+        print(f"{args.type}: parsing before the tokenizer {dt_before:.2f} sec, {args.events/dt_before:,.0f} events/sec")
+    dt_after, _ = timed(tokenized_parse(synthetic(args.events, args.threads)))
+    dt_after -= dt_input
+    speedup = f" ({dt_before / dt_after:.1f}x faster)" if args.reference else ""
+    print(f"{args.type}: parsing with the tokenizer {dt_after:.2f} sec, {args.events/dt_after:,.0f} events/sec{speedup}")
+
+    lines = synthetic(args.events, args.threads)
+    converter = gil2trace(lines, verbose=0) if args.type == "gil" else perf2trace(lines, verbose=0)
+    dt, count = timed(converter)
+    dt -= dt_input
+    print(f"{args.type}: converting {args.events} events in {dt:.2f} sec, {args.events/dt:,.0f} events/sec ({count} trace events)")
+
+
+if __name__ == '__main__':
+    main()
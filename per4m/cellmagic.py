@@ -1,7 +1,6 @@
 import os
 import tempfile
 import viztracer
-from viztracer.report_builder import ReportBuilder
 from IPython.display import HTML, display
 
 from IPython.core.magic import (cell_magic,
@@ -12,6 +11,7 @@ from IPython.core.magic import (cell_magic,
 
 
 from .giltracer import PerfRecordGIL
+from .tracemerge import build_report
 
 @magics_class
 class GilTraceMagic(Magics):
@@ -20,16 +20,19 @@ class GilTraceMagic(Magics):
     def giltracer(self, line, cell, local_ns):
         temp_dir = tempfile.mkdtemp()
         perf_path = os.path.join(temp_dir, 'perf.data')
-        viz_path = os.path.join(temp_dir, 'viztracer.json')
-        gil_path = os.path.join(temp_dir, 'giltracer.json')
-        out_path = 'giltracer.html'
+        # e.g. %%giltracer giltracer.pftrace, for a Perfetto trace instead of an html report
+        out_path = line.strip() or 'giltracer.html'
         code = self.shell.transform_cell(cell)
-        with PerfRecordGIL(perf_path, gil_path) as gt:
-            with viztracer.VizTracer(output_file=viz_path):
+        tracer = viztracer.VizTracer()
+        with PerfRecordGIL(perf_path) as gt:
+            tracer.start()
+            try:
                 exec(code, local_ns, local_ns)
-        gt.post_process()
-        builder = ReportBuilder([viz_path, gil_path])
-        builder.save(output_file=out_path)
+            finally:
+                tracer.stop()
+        # no intermediate json files, the events go to the report directly
+        tracer.parse()
+        build_report([tracer.data, gt.trace_events()], out_path)
         
         download = HTML(f'''<a href="{out_path}" download>Download {out_path}</a>''')
         view = HTML(f'''<a href="{out_path}" target="_blank" rel="noopener noreferrer">Open {out_path} in new tab</a> (might not work due to security issue)''')
@@ -0,0 +1,248 @@
+import argparse
+from array import array
+import sys
+
+import tabulate
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("per4m gilstats needs NumPy, install it with: pip install per4m[gilstats]") from e
+
+from .perfdata import PerfData
+from .ringbuffer import RingBufferDump
+from .perfutils import read_tokenized_events, perf_script, parse_function_probe, parse_sched_switch, parse_sched_wakeup, read_symbols
+from .perf2trace import EventKinds, print_summary, IGNORE, FUNCTION_ENTRY, FUNCTION_RETURN, TAKE, TAKE_RETURN, DROP, DROP_RETURN, SCHED_SWITCH, SCHED_WAKEUP, LOST, THROTTLE, UNTHROTTLE
+
+
+usage = """
+
+Load GIL and scheduler events in NumPy arrays, for fast (repeated) analysis.
+
+Usage:
+
+$ perf script --ns --no-inline -i perf-gil.data | per4m gilstats --save gil.npz
+$ per4m gilstats --input-perf perf-gil.data --native --histogram
+$ per4m gilstats --input-npz gil.npz --histogram
+$ per4m gilstats --input-pytrace pytrace.dat
+"""
+
+GIL_KINDS = [FUNCTION_ENTRY, FUNCTION_RETURN, TAKE, TAKE_RETURN, DROP, DROP_RETURN]
+
+
+class EventStore:
+    """Columnar storage of GIL and sched events.
+
+    Each event has a tid, ts (in us), kind (see perf2trace), cpu (-1 if unknown) and stack. The
+    stack is an index into calls (the Python call that was entered, for pytrace:function_entry)
+    or into stacks (the stacktrace of sched_switch), and -1 otherwise. For sched events the tid
+    is the thread that goes to sleep/wakes up, not the thread that triggered the event.
+
+    Unlike gil2trace, we do not repair the GIL state when perf lost events, we only count how often
+    perf told us it lost (or throttled) events in lost, so the totals can differ from perf2trace's
+    when lost is not 0.
+    """
+    def __init__(self, tid, ts, kind, cpu, stack, calls, stacks, parent_pid, lost=0):
+        self.tid = tid
+        self.ts = ts
+        self.kind = kind
+        self.cpu = cpu
+        self.stack = stack
+        self.calls = calls
+        self.stacks = stacks
+        self.parent_pid = parent_pid
+        self.lost = lost
+
+    def __len__(self):
+        return len(self.ts)
+
+    @classmethod
+    def from_perf(cls, input, pids=None, symbols=None, **probes):
+        """Loads events from perf script output or a perfdata.PerfData reader, symbols resolves pytrace code object ids"""
+        event_kinds = EventKinds(**probes)
+        tids = array('q')
+        times = array('d')
+        kinds = array('b')
+        cpus = array('h')
+        stacks = array('l')
+        call_ids = {}
+        stack_ids = {}
+        parent_pid = None
+        lost = 0
+        for header, stacktrace, tokens in read_tokenized_events(input):
+            comm, pid, cpu, time, count, event, other = tokens
+            kind = event_kinds[event]
+            if kind in (LOST, THROTTLE):
+                lost += 1
+            if kind in (IGNORE, LOST, THROTTLE, UNTHROTTLE):
+                continue
+            stack = -1
+            if kind == SCHED_SWITCH:
+                pid, prev_state = parse_sched_switch(other)
+                if prev_state == 'R':
+                    continue  # still runnable
+                if stacktrace:
+                    stack = stack_ids.setdefault(tuple(stacktrace), len(stack_ids))
+            elif kind == SCHED_WAKEUP:
+                pid = parse_sched_wakeup(other)
+            elif kind == FUNCTION_ENTRY:
+                call = parse_function_probe(other, symbols)
+                stack = call_ids.setdefault(call, len(call_ids))
+            if pids and pid not in pids:
+                continue
+            if parent_pid is None:
+                parent_pid = pid
+            tids.append(pid)
+            times.append(time)
+            kinds.append(kind)
+            cpus.append(int(cpu[1:-1]) if cpu else -1)
+            stacks.append(stack)
+        return cls(np.frombuffer(tids, dtype=np.int64), np.frombuffer(times, dtype=np.float64),
+                   np.frombuffer(kinds, dtype=np.int8), np.frombuffer(cpus, dtype=np.int16),
+                   np.array(stacks, dtype=np.int32), list(call_ids), list(stack_ids), parent_pid, lost)
+
+    def save(self, filename):
+        np.savez(filename, tid=self.tid, ts=self.ts, kind=self.kind, cpu=self.cpu, stack=self.stack,
+                 calls=np.array(['\t'.join(map(str, call)) for call in self.calls], dtype=str),
+                 stacks=np.array(['\n'.join(stack) for stack in self.stacks], dtype=str),
+                 parent_pid=-1 if self.parent_pid is None else self.parent_pid, lost=self.lost)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            calls = []
+            for call in data['calls']:
+                path, funcname, lineno, what = str(call).split('\t')
+                calls.append((path, funcname, int(lineno), int(what)))
+            stacks = [tuple(str(stack).split('\n')) for stack in data['stacks']]
+            parent_pid = int(data['parent_pid'])
+            lost = int(data['lost']) if 'lost' in data else 0
+            return cls(data['tid'], data['ts'], data['kind'], data['cpu'], data['stack'], calls, stacks,
+                       None if parent_pid == -1 else parent_pid, lost)
+
+    def _gil_events(self):
+        # only the GIL events, sorted by thread (and by time within a thread)
+        mask = np.isin(self.kind, GIL_KINDS)
+        tid, ts, kind = self.tid[mask], self.ts[mask], self.kind[mask]
+        order = np.argsort(tid, kind='stable')
+        tid, ts, kind = tid[order], ts[order], kind[order]
+        new_thread = np.r_[True, tid[1:] != tid[:-1]] if len(tid) else np.zeros(0, dtype=bool)
+        thread = np.cumsum(new_thread) - 1  # index of the thread for each event
+        starts = np.flatnonzero(new_thread)
+        return tid, ts, kind, thread, starts
+
+    def _gil_intervals(self):
+        tid, ts, kind, thread, starts = self._gil_events()
+        index = np.arange(len(ts))
+
+        def last(which):
+            # index of the last event of this kind, at or before each event, in the same thread (else -1)
+            last_index = np.maximum.accumulate(np.where(kind == which, index, -1)) if len(ts) else index
+            valid = (last_index >= 0) & (thread[np.maximum(last_index, 0)] == thread)
+            return np.where(valid, last_index, -1)
+
+        t_min = np.minimum.reduceat(ts, starts) if len(ts) else ts
+        t_max = np.maximum.reduceat(ts, starts) if len(ts) else ts
+        time_first = ts.min() if len(ts) else 0
+
+        # wait: from calling take_gil (but not before we saw the thread) till it returns
+        takes = np.flatnonzero(kind == TAKE_RETURN)
+        last_take = last(TAKE)[takes]
+        wants_take = np.where(last_take >= 0, ts[np.maximum(last_take, 0)], -np.inf)
+        wait = ts[takes] - np.maximum(t_min[thread[takes]], wants_take)
+
+        # hold: from take_gil returning, till drop_gil returns
+        drops = np.flatnonzero(kind == DROP_RETURN)
+        last_take_return = last(TAKE_RETURN)[drops]
+        previous_drop = np.r_[-1, last(DROP_RETURN)[:-1]][drops] if len(ts) else drops
+        previous_drop = np.where(thread[np.maximum(previous_drop, 0)] == thread[drops], previous_drop, -1)
+        has_gil = last_take_return > previous_drop
+        hold = ts[drops] - np.where(has_gil, ts[np.maximum(last_take_return, 0)], time_first)
+        return tid[starts], t_min, t_max, thread[takes], wait, thread[drops], hold
+
+    def totals(self):
+        """Returns dicts mapping pid -> t_min, t_max, time on gil and time waiting on the gil (like gil2trace, but without repairing lost events)"""
+        pids, t_min, t_max, wait_thread, wait, hold_thread, hold = self._gil_intervals()
+        time_wait_gil = np.bincount(wait_thread, weights=wait, minlength=len(pids))
+        time_on_gil = np.bincount(hold_thread, weights=hold, minlength=len(pids))
+        pids = pids.tolist()
+        return (dict(zip(pids, t_min.tolist())), dict(zip(pids, t_max.tolist())),
+                dict(zip(pids, time_on_gil.tolist())), dict(zip(pids, time_wait_gil.tolist())))
+
+    def wait_times(self):
+        """Returns (tid, duration) arrays of all waits on the GIL"""
+        pids, t_min, t_max, wait_thread, wait, hold_thread, hold = self._gil_intervals()
+        return pids[wait_thread], wait
+
+    def hold_times(self):
+        """Returns (tid, duration) arrays of all GIL holds"""
+        pids, t_min, t_max, wait_thread, wait, hold_thread, hold = self._gil_intervals()
+        return pids[hold_thread], hold
+
+    def print_summary(self, verbose=1):
+        t_min, t_max, time_on_gil, time_wait_gil = self.totals()
+        print_summary(t_min, t_max, time_on_gil, time_wait_gil, self.parent_pid, verbose=verbose)
+        if self.lost:
+            print(f"perf lost (or throttled) events {self.lost} times, which we do not repair, use perf2trace for a repaired GIL state", file=sys.stderr)
+
+
+def histogram_table(tids, durations, bins):
+    """Per thread histogram (counts) of durations (in us) as a table"""
+    table = []
+    for tid in np.unique(tids):
+        counts, _ = np.histogram(durations[tids == tid], bins=bins)
+        table.append([tid, *counts])
+    headers = ['PID'] + [f'<{edge:g}us' for edge in bins[1:]]
+    return tabulate.tabulate(table, headers)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     usage=usage)
+    parser.add_argument('--verbose', '-v', action='count', default=1)
+    parser.add_argument('--quiet', '-q', action='count', default=0)
+    parser.add_argument('--input-perf', help="Run perf script on this perf.data file, instead of reading perf script output from stdin")
+    parser.add_argument('--native', help="Read --input-perf directly, instead of using perf script (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--symbols', help="Symbol table to resolve the code object ids of the pytrace:function_entry_id probes")
+    parser.add_argument('--input-pytrace', help="Read events from a pytrace ring buffer dump (pytrace.dump)")
+    parser.add_argument('--input-npz', help="Load events saved earlier with --save")
+    parser.add_argument('--save', help="Save the events to this .npz file")
+    parser.add_argument('--histogram', help="Show histograms of GIL wait and hold times (default: %(default)s)", default=False, action='store_true')
+
+    args = parser.parse_args(argv[1:])
+    verbose = args.verbose - args.quiet
+
+    if args.input_npz:
+        store = EventStore.load(args.input_npz)
+    else:
+        if args.input_pytrace:
+            input = RingBufferDump(args.input_pytrace)
+        elif args.input_perf and args.native:
+            input = PerfData(args.input_perf)
+        elif args.input_perf:
+            input = perf_script(args.input_perf, verbose=verbose)
+        else:
+            input = sys.stdin
+        store = EventStore.from_perf(input, symbols=read_symbols(args.symbols) if args.symbols else None)
+    if verbose >= 2:
+        print(f"Loaded {len(store)} events")
+    if args.save:
+        store.save(args.save)
+        if verbose >= 1:
+            print(f"Wrote {len(store)} events to {args.save}")
+    if verbose >= 1:
+        store.print_summary(verbose=verbose)
+    if args.histogram:
+        bins = np.r_[0, np.logspace(0, 6, 7)]
+        print("Histogram of GIL wait times:")
+        print()
+        print(histogram_table(*store.wait_times(), bins))
+        print()
+        print("Histogram of GIL hold times:")
+        print()
+        print(histogram_table(*store.hold_times(), bins))
+        print()
+
+
+if __name__ == '__main__':
+    main()
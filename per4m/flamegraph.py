@@ -0,0 +1,83 @@
+from html import escape
+import zlib
+
+
+def build_tree(folded):
+    """Builds a tree of nested dicts from a mapping of folded stack -> weight
+
+    Each node is a dict {'name': ..., 'value': ..., 'children': {name: node}}.
+    """
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for stack, weight in folded.items():
+        root['value'] += weight
+        node = root
+        for name in stack.split(';'):
+            children = node['children']
+            if name not in children:
+                children[name] = {'name': name, 'value': 0, 'children': {}}
+            node = children[name]
+            node['value'] += weight
+    return root
+
+
+def frame_color(name):
+    # similar to flamegraph.pl --colors=python, with a stable color per function name
+    variation = zlib.crc32(name.encode('utf8')) % 50
+    if name.startswith('py::'):  # Python code (injected from VizTracer)
+        return f'rgb({50 + variation},{180 + variation // 2},{50 + variation})'
+    elif name.startswith('cext::'):  # C extension functions, as seen by VizTracer
+        return f'rgb({50 + variation},{150 + variation},{200 + variation // 2})'
+    elif name.startswith('cpyeval::'):
+        return f'rgb({180 + variation},{180 + variation},{50 + variation})'
+    elif name.endswith('_[k]'):  # kernel
+        return f'rgb({200 + variation},{120 + variation},{50})'
+    else:
+        return f'rgb({205 + variation},{60 + variation},{50})'
+
+
+def flamegraph_svg(folded, title="Flame Graph", countname="samples", width=1200, frame_height=16, min_width=0.1):
+    """Renders a mapping of folded stack -> weight as a self-contained SVG flame graph (root at the bottom)"""
+    root = build_tree(folded)
+    total = root['value']
+    pad_top, pad_bottom, pad_side = 2 * frame_height, frame_height, 10
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node['children'].values()), default=0)
+
+    height = depth(root) * frame_height + pad_top + pad_bottom
+    scale = (width - 2 * pad_side) / total if total else 0
+    rects = []
+
+    def layout(node, x, level):
+        w = node['value'] * scale
+        if w < min_width:
+            return
+        y = height - pad_bottom - (level + 1) * frame_height
+        name = escape(node['name'])
+        percentage = node['value'] / total * 100
+        info = f"{name} ({node['value']:,} {escape(countname)}, {percentage:.2f}%)"
+        # roughly 7px per character for a 12px font
+        chars = int(w / 7)
+        label = name if len(name) <= chars else (escape(node['name'][:chars - 2]) + '..' if chars > 3 else '')
+        rects.append(f'<g><title>{info}</title><rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{frame_height - 1}" fill="{frame_color(node["name"])}" rx="2" ry="2"/>'
+                     f'<text x="{x + 3:.1f}" y="{y + frame_height - 5}">{label}</text></g>')
+        for child in sorted(node['children'].values(), key=lambda child: child['name']):
+            layout(child, x, level + 1)
+            x += child['value'] * scale
+
+    if total:
+        layout(root, pad_side, 0)
+    return '\n'.join([
+        '<?xml version="1.0" standalone="no"?>',
+        f'<svg version="1.1" width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">',
+        '<style>text { font-family: Verdana, sans-serif; font-size: 12px; fill: black; } rect:hover { stroke: black; stroke-width: 0.5; }</style>',
+        f'<rect x="0" y="0" width="{width}" height="{height}" fill="#f8f8f8"/>',
+        f'<text x="{width / 2}" y="{frame_height + 4}" text-anchor="middle" style="font-size: 17px">{escape(title)}</text>',
+        *rects,
+        '</svg>',
+    ])
+
+
+def write_flamegraph(folded, filename, **kwargs):
+    with open(filename, 'w') as f:
+        f.write(flamegraph_svg(folded, **kwargs))
@@ -3,10 +3,16 @@ import os
 import sys
 
 import viztracer
-from viztracer.report_builder import ReportBuilder
 
 import runpy
+import signal
+import time
 from .record import PerfRecord
+from .perfdata import PerfData
+from .perfutils import perf_script, read_symbols, write_symbols
+from .perf2trace import perf2trace, gil2trace
+from .tracemerge import build_report
+from .tracewriter import trace_writer
 
 
 usage = """
@@ -15,40 +21,141 @@ Run VizTracer and perf simultaneously, then inject the GIL information in the vi
 Usage:
 
 $ giltracer -m per4m.example1
+
+Or trace the Python calls with pytrace (and its pytrace:function_entry_id/return_id probes, read README.md), instead of VizTracer
+$ giltracer --pytrace -m per4m.example1
+
+Or attach to a running process for 10 seconds (without VizTracer)
+$ giltracer --pid 1234 --duration 10
+Or keep recording it, and write a report of the last events on SIGUSR2
+$ giltracer --pid 1234 --flight-recorder
 """
 
-class PerfRecordSched(PerfRecord):
-    def __init__(self, output='perf-sched.data', trace_output='schedtracer.json', verbose=1):
-        super().__init__(output=output, verbose=verbose, args=["-e 'sched:*'"])
+class PerfRecordTrace(PerfRecord):
+    """A PerfRecord that we convert to trace events in this process, see trace_events"""
+    def post_process(self, input=None, trace_output=None):
+        """Writes the trace events of the recording (or of input) to trace_output (see tracewriter.trace_writer)"""
+        trace_output = trace_output or self.trace_output
+        with trace_writer(trace_output) as writer:
+            for event in self.trace_events(input):
+                writer.write(event)
+        if self.verbose >= 1:
+            print(f"Wrote {writer.count} events to {trace_output}")
+
+
+class PerfRecordSched(PerfRecordTrace):
+    def __init__(self, output='perf-sched.data', trace_output='schedtracer.json', verbose=1, jobs=1, pid=None, **kwargs):
+        super().__init__(output=output, verbose=verbose, args=["-e 'sched:*'"], pid=pid, **kwargs)
         self.trace_output = trace_output
         self.verbose = verbose
+        self.jobs = jobs
 
-    def post_process(self, *args):
-        verbose = '-q ' + '-v ' * self.verbose
-        cmd = f"perf script -i {self.output} --no-inline --ns | per4m perf2trace sched -o {self.trace_output} {verbose}"
-        if self.verbose >= 1:
-            print(cmd)
-        if os.system(cmd) != 0:
-            raise OSError(f'Failed to run perf or per4m perf2trace, command:\n$ {cmd}')
+    def trace_events(self, input=None):
+        """Yields the trace events of the recording (or of input), running perf2trace on the perf script output"""
+        input = input or self.output
+        for header, stacktrace, event in perf2trace(perf_script(input, jobs=self.jobs, verbose=self.verbose), verbose=self.verbose):
+            yield event
 
 
-class PerfRecordGIL(PerfRecord):
-    def __init__(self, output='perf-gil.data', trace_output='giltracer.json', viztracer_input="viztracer.json", verbose=1):
+class PerfRecordGIL(PerfRecordTrace):
+    def __init__(self, output='perf-gil.data', trace_output='giltracer.json', viztracer_input="viztracer.json", verbose=1, jobs=1, native=False, pid=None, symbols=None, **kwargs):
         # TODO: check output of perf probe --list="python:*gil*"  to see if probes are set
-        super().__init__(output=output, verbose=verbose, args=["-e 'python:*gil*'", "-e pytrace:function_entry", "-e pytrace:function_return"], stacktrace=False)
+        super().__init__(output=output, verbose=verbose, args=["-e 'python:*gil*'", "-e 'pytrace:*'"], stacktrace=False, pid=pid, **kwargs)
         # this is used to filter the giltracer data
         self.viztracer_input = viztracer_input
         self.trace_output = trace_output
         self.verbose = verbose
+        self.jobs = jobs
+        self.native = native
+        # the pytrace code object id -> (filename, funcname) table (see perfutils.write_symbols), to resolve
+        # the pytrace:function_entry_id probes. When we record ourselves, stop() writes it.
+        self.symbols = symbols
 
-    def post_process(self, *args):
-        verbose = '-q ' + '-v ' * self.verbose
-        # -i {self.viztracer_input}   # we don't use this ftm
-        cmd = f"perf script -i {self.output} --no-inline --ns | per4m perf2trace gil -o {self.trace_output} {verbose}"
-        if self.verbose >= 1:
-            print(cmd)
-        if os.system(cmd) != 0:
-            raise OSError(f'Failed to run perf or per4m perf2trace, command:\n$ {cmd}')
+    def stop(self):
+        super().stop()
+        pytrace = sys.modules.get('per4m.pytrace')
+        if self.pid is None and pytrace is not None and pytrace.symbols():
+            self.symbols = self.symbols or f'{os.path.splitext(self.output)[0]}-symbols.json'
+            write_symbols(self.symbols, pytrace.symbols())
+            if self.verbose >= 2:
+                print(f"Wrote pytrace symbols to {self.symbols}")
+
+    def trace_events(self, input=None):
+        """Yields the trace events of the recording (or of input), running gil2trace on the perf script output (or on perf.data directly when native)"""
+        input = input or self.output
+        if self.native:
+            # we do not need stacktraces, so we can skip perf script
+            events = PerfData(input)
+        else:
+            events = perf_script(input, jobs=self.jobs, verbose=self.verbose)
+        # same options as per4m perf2trace gil uses by default
+        symbols = read_symbols(self.symbols) if self.symbols else None
+        for header, event in gil2trace(events, verbose=self.verbose, as_async=True, only_lock=False, symbols=symbols):
+            yield event
+
+
+def attach(pid, duration, output, state_detect=False, gil_detect=True, jobs=1, native=False, symbols=None, verbose=1):
+    """Records an already running process for duration seconds (or till Ctrl-C), and writes the report to output"""
+    perf1 = PerfRecordSched(verbose=verbose, jobs=jobs, pid=pid) if state_detect else None
+    perf2 = PerfRecordGIL(verbose=verbose, jobs=jobs, native=native, pid=pid, symbols=symbols) if gil_detect else None
+    if perf1:
+        perf1.start()
+    if perf2:
+        perf2.start()
+    try:
+        if verbose >= 1:
+            print(f"Recording process {pid}" + (f" for {duration} seconds" if duration else ", press Ctrl-C to stop"))
+        if duration:
+            time.sleep(duration)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if perf1:
+            perf1.stop()
+        if perf2:
+            perf2.stop()
+    sources = [perf.trace_events() for perf in (perf1, perf2) if perf]
+    if sources:
+        build_report(sources, output, verbose=verbose)
+
+
+def flight_recorder(pid, output, state_detect=False, gil_detect=True, buffer_size="16M", max_files=10, jobs=1, native=False, symbols=None, verbose=1):
+    """Keeps recording pid in a ring buffer, and writes a report of the last events on SIGUSR2, till Ctrl-C"""
+    recorders = []
+    if state_detect:
+        recorders.append(PerfRecordSched(output='perf-sched-flight.data', verbose=verbose, jobs=jobs, pid=pid, overwrite=True, buffer_size=buffer_size, max_files=max_files))
+    if gil_detect:
+        recorders.append(PerfRecordGIL(output='perf-gil-flight.data', verbose=verbose, jobs=jobs, native=native, pid=pid, symbols=symbols, overwrite=True, buffer_size=buffer_size, max_files=max_files))
+    dump_requested = []
+    previous_handler = signal.signal(signal.SIGUSR2, lambda signum, frame: dump_requested.append(True))
+    for recorder in recorders:
+        recorder.start()
+    name, ext = os.path.splitext(output)
+    try:
+        if verbose >= 1:
+            print(f"Recording process {pid} in flight recorder mode, run 'kill -USR2 {os.getpid()}' to write a report of the last events, press Ctrl-C to stop")
+        while True:
+            time.sleep(0.1)
+            if not dump_requested:
+                continue
+            dump_requested.clear()
+            try:
+                filenames = [recorder.dump() for recorder in recorders]
+                # perf names the dumps after the time
+                report = f'{name}-{os.path.basename(filenames[-1]).rsplit(".", 1)[-1]}{ext}'
+                build_report([recorder.trace_events(filename) for recorder, filename in zip(recorders, filenames)], report, verbose=verbose)
+            except OSError as e:
+                # keep recording, we may have more luck next time
+                print(f"Failed to write a report: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGUSR2, previous_handler)
+        for recorder in recorders:
+            recorder.stop()
 
 
 def main(argv=sys.argv):
@@ -59,15 +166,41 @@ def main(argv=sys.argv):
     parser.add_argument('--import', dest="import_", help="Comma seperated list of modules to import before tracing (cleans up tracing output)")
     parser.add_argument('--verbose', '-v', action='count', default=1)
     parser.add_argument('--quiet', '-q', action='count', default=0)
-    parser.add_argument('--output', '-o', dest="output", default='giltracer.html', help="Output filename (default %(default)s)")
+    parser.add_argument('--output', '-o', dest="output", default='giltracer.html', help="Output filename, an html report, or a (streamed) merged trace when it ends with .json(.gz) or .pftrace(.gz) (default %(default)s)")
     parser.add_argument('--state-detect', help="Use perf sched events to detect if a process is sleeping due to the GIL (default: %(default)s)", default=False, action='store_true')
     parser.add_argument('--no-state-detect', dest="state_detect", action='store_false')
     parser.add_argument('--gil-detect', help="Use uprobes to detect who has the GIL (read README.md) (default: %(default)s)", default=True, action='store_true')
     parser.add_argument('--no-gil-detect', dest="gil_detect", action='store_false')
+    parser.add_argument('--native', help="Read perf-gil.data directly instead of using perf script (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--trace-files', help="Also write schedtracer.json and giltracer.json, e.g. for per4m merge (viztracer.json is always written) (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--no-trace-files', dest="trace_files", action='store_false')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Number of perf script processes to run in parallel when converting the perf data (default: %(default)s)")
+
+    parser.add_argument('--pid', '-p', type=int, help="Attach to this (already running) process, instead of running a script or module")
+    parser.add_argument('--duration', '-d', type=float, default=None, help="With --pid, record for this many seconds (default: till Ctrl-C)")
+    parser.add_argument('--flight-recorder', help="With --pid, keep only the last events in memory, and write a report of them on SIGUSR2 (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--buffer-size', default="16M", help="Flight recorder buffer size per CPU, see perf record --mmap-pages (default: %(default)s)")
+    parser.add_argument('--max-files', type=int, default=10, help="Number of flight recorder dumps to keep (default: %(default)s)")
+    parser.add_argument('--pytrace', help="Trace the Python calls with pytrace.start(ids=True) and perf (needs the pytrace:function_entry_id/return_id probes, read README.md), instead of VizTracer (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--no-pytrace', dest="pytrace", action='store_false')
+    parser.add_argument('--symbols', help="With --pid, the pytrace symbol table the process wrote with per4m.perfutils.write_symbols, to resolve the pytrace:function_entry_id probes (without --pid we write and use it ourselves)")
 
     parser.add_argument('args', nargs=argparse.REMAINDER)
     args = parser.parse_args(argv[1:])
     verbose = args.verbose - args.quiet
+    if args.pytrace and not args.gil_detect:
+        parser.error("--pytrace needs --gil-detect, since perf records the pytrace probes")
+    if args.pytrace and args.pid:
+        parser.error("--pytrace cannot attach to a process, call pytrace.start(ids=True) in the process itself")
+
+    if args.pid and args.flight_recorder:
+        flight_recorder(args.pid, args.output, state_detect=args.state_detect, gil_detect=args.gil_detect, buffer_size=args.buffer_size,
+                        max_files=args.max_files, jobs=args.jobs, native=args.native, symbols=args.symbols, verbose=verbose)
+        return
+    if args.pid:
+        attach(args.pid, args.duration, args.output, state_detect=args.state_detect, gil_detect=args.gil_detect,
+               jobs=args.jobs, native=args.native, symbols=args.symbols, verbose=verbose)
+        return
 
     if args.import_:
         for module in args.import_.split(','):
@@ -75,9 +208,14 @@ def main(argv=sys.argv):
                 print(f'importing {module}')
             __import__(module)
 
-    perf1 = PerfRecordSched(verbose=verbose) if args.state_detect else None
-    perf2 = PerfRecordGIL(verbose=verbose) if args.gil_detect else None
-    vt = viztracer.VizTracer(output_file="viztracer.json", verbose=verbose)
+    perf1 = PerfRecordSched(verbose=verbose, jobs=args.jobs) if args.state_detect else None
+    perf2 = PerfRecordGIL(verbose=verbose, jobs=args.jobs, native=args.native) if args.gil_detect else None
+    # pytrace and VizTracer both need the profile function, so we use one of them
+    if args.pytrace:
+        from . import pytrace
+        vt = None
+    else:
+        vt = viztracer.VizTracer(output_file="viztracer.json", verbose=verbose)
 
     # pass on the rest of the arguments
     sys.argv = args.args
@@ -92,27 +230,32 @@ def main(argv=sys.argv):
         perf2.start()
 
     try:
-        vt.start()
+        if vt:
+            vt.start()
+        else:
+            pytrace.start(ids=True)
         module['main'](args.args)
     finally:
-        vt.stop()
+        if vt:
+            vt.stop()
+        else:
+            pytrace.stop()
         if perf1:
             perf1.stop()
         if perf2:
             perf2.stop()
-        vt.save('viztracer.json')
-        if perf1:
-            perf1.post_process()
-        if perf2:
-            perf2.post_process()
-
-        files = ['viztracer.json']
-        if perf1:
-            files.append('schedtracer.json')
-        if perf2:
-            files.append('giltracer.json')
-        builder = ReportBuilder(files, verbose=verbose)
-        builder.save(output_file=args.output)
+        # per4m offgil and script need viztracer.json (and the perf data), so we always keep it
+        if vt:
+            vt.save('viztracer.json')
+        perfs = [perf for perf in (perf1, perf2) if perf]
+        if args.trace_files:
+            for perf in perfs:
+                perf.post_process()
+            sources = (['viztracer.json'] if vt else []) + [perf.trace_output for perf in perfs]
+        else:
+            # convert in this process, and hand the events to the report directly
+            sources = ([vt.data] if vt else []) + [perf.trace_events() for perf in perfs]
+        build_report(sources, args.output, verbose=verbose)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import json
+import math
+
+
+class LogHistogram:
+    """Streaming histogram with logarithmically sized buckets (like HdrHistogram), for durations in us.
+
+    A value falls in a bucket that is at most 1/2**(precision-1) of the value wide, so with the default
+    precision of 7 bits the percentiles are within 2%, while the number of buckets only grows with the
+    log of the range of values. Values are stored with a resolution of unit (in us, so 1 ns by default).
+    """
+    def __init__(self, precision=7, unit=1e-3):
+        self.precision = precision
+        self.unit = unit
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, value):
+        value = max(0, int(value / self.unit))
+        exponent = max(0, value.bit_length() - self.precision)
+        # the mantissa (the top precision bits) is < 2**precision, so the index increases with the value
+        return (exponent << self.precision) + (value >> exponent)
+
+    def bounds(self, index):
+        """Returns the (low, high) values (in us) of the bucket with this index"""
+        exponent = index >> self.precision
+        mantissa = index & ((1 << self.precision) - 1)
+        return (mantissa << exponent) * self.unit, ((mantissa + 1) << exponent) * self.unit
+
+    def record(self, value, count=1):
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    def percentiles(self, *percentiles):
+        """Returns the values (in us) below which the given percentages of the values fall
+
+        Like HdrHistogram we return the upper bound of the bucket, but never more than the maximum.
+        """
+        if not self.count:
+            return [math.nan] * len(percentiles)
+        targets = sorted((percentile / 100 * self.count, i) for i, percentile in enumerate(percentiles))
+        values = [self.max] * len(percentiles)
+        seen = 0
+        t = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            while t < len(targets) and seen >= targets[t][0]:
+                values[targets[t][1]] = min(self.bounds(index)[1], self.max)
+                t += 1
+            if t == len(targets):
+                break
+        return values
+
+    def buckets(self):
+        """Yields (low, high, count) of the non-empty buckets, in us"""
+        for index in sorted(self.counts):
+            yield (*self.bounds(index), self.counts[index])
+
+    def to_dict(self):
+        p50, p90, p99, p999 = self.percentiles(50, 90, 99, 99.9)
+        return {'count': self.count, 'total': self.total, 'min': self.min if self.count else None, 'max': self.max if self.count else None,
+                'p50': p50, 'p90': p90, 'p99': p99, 'p99.9': p999, 'buckets': [list(bucket) for bucket in self.buckets()]}
+
+
+def write_histograms(filename, wait_histograms, hold_histograms):
+    """Writes the wait and hold LogHistograms (dicts mapping pid -> LogHistogram) as JSON, with durations in us"""
+    data = {}
+    for pid in sorted(set(wait_histograms) | set(hold_histograms)):
+        data[str(pid)] = {name: histograms[pid].to_dict() for name, histograms in [('wait', wait_histograms), ('hold', hold_histograms)] if pid in histograms}
+    with open(filename, 'w') as f:
+        json.dump(data, f)
@@ -1,15 +1,15 @@
 import argparse
-import json
+import os
 import shlex
 import subprocess
 import sys
 
-from viztracer.prog_snapshot import ProgSnapshot
-
-
 from .perfutils import read_events, parse_header
-from .script import stacktrace_inject, print_stderr
+from .script import SnapshotIndex, stacktrace_inject, print_stderr
 from .perf2trace import perf2trace
+from .stacks import FoldedStacks
+from .flamegraph import write_flamegraph
+from .tracemerge import load_snapshot
 
 
 usage = """
@@ -24,6 +24,12 @@ $ giltracer --no-gil-detect --state-detect -m per4m.example3
 
 # offgil will use perf-sched.data
 $ offgil | ~/github/FlameGraph/stackcollapse.pl | ~/github/FlameGraph/flamegraph.pl --countname=us --title="Off-GIL Time Flame Graph" --colors=python > offgil.svg
+
+# or let offgil aggregate the stacks (much faster), and skip stackcollapse.pl
+$ offgil --folded | ~/github/FlameGraph/flamegraph.pl --countname=us --title="Off-GIL Time Flame Graph" --colors=python > offgil.svg
+
+# or let offgil create the flame graph itself
+$ offgil --svg offgil.svg
 """
 
 
@@ -45,10 +51,16 @@ def main(argv=sys.argv):
     parser.add_argument('--input-perf', help="Perf input (default %(default)s)", default="perf-sched.data")
     parser.add_argument('--input-viztracer', help="VizTracer input (default %(default)s)", default="viztracer.json")
     parser.add_argument('--output', '-o', dest="output", default=None, help="Output filename (default %(default)s)")
+    parser.add_argument('--folded', help="Output aggregated stacks in folded format (as stackcollapse.pl would) (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--svg', help="Write a flame graph of the aggregated stacks to this SVG file (default: %(default)s)", default=None)
+    parser.add_argument('--title', help="Title of the flame graph (default: %(default)s)", default="Off-GIL Time Flame Graph")
     
 
     args = parser.parse_args(argv[1:])
     verbose = args.verbose - args.quiet
+    for filename, option in [(args.input_perf, '--input-perf'), (args.input_viztracer, '--input-viztracer')]:
+        if not os.path.exists(filename):
+            parser.error(f"{filename} does not exist, run giltracer --no-gil-detect --state-detect first, or pass {option}")
 
     perf_script_args = ['--no-inline']
     perf_script_args = ' '.join(perf_script_args)
@@ -65,15 +77,14 @@ def main(argv=sys.argv):
     
     if verbose >= 1:
         print_stderr("Loading snapshot")
-    with open(args.input_viztracer, "r") as f:
-        json_data = f.read()
-    snap = ProgSnapshot(json_data)
+    # a single streaming pass gives us the snapshot, and the first timestamp
+    snapshot, summary = load_snapshot(args.input_viztracer)
+    snap = SnapshotIndex(snapshot)
     # find all pids (or tids)
-    pids = list(snap.func_trees)
-    for pid in pids.copy():
-        pids.extend(list(snap.func_trees[pid]))
-    t0 = min(event['ts'] for event in json.loads(json_data)['traceEvents'] if 'ts' in event)
-    
+    pids = set(snap.pids)
+    t0 = summary.t0
+    folded = FoldedStacks() if args.folded or args.svg else None
+
     for header, stacktrace, event in perf2trace(perf.stdout, verbose):
         if event['name'] == args.state:
             values, _, _ = parse_header(header)
@@ -89,12 +100,22 @@ def main(argv=sys.argv):
                                 take_gil_index = i
                         if take_gil_index is not None:  # shouldn't it be always there?
                             stacktrace = stacktrace[take_gil_index:]
-                    for call in stacktrace:
-                        ptr, signature = call.split(' ', 1)
-                        print(signature, file=output)
+                    if folded is not None:
+                        folded.add(stacktrace, int(event['dur']))
+                    else:
+                        for call in stacktrace:
+                            ptr, signature = call.split(' ', 1)
+                            print(signature, file=output)
                 except:
                     print_stderr(f"Error for event: {header}")
                     raise
-            print(int(event['dur']))
-            print(file=output)
+            if folded is None:
+                print(int(event['dur']))
+                print(file=output)
+    if args.folded:
+        folded.write(output)
+    if args.svg:
+        write_flamegraph(folded.folded(), args.svg, title=args.title, countname="us")
+        if verbose >= 1:
+            print_stderr(f"Wrote {args.svg}")
 
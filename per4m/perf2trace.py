@@ -1,5 +1,5 @@
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
 import json
 import re
 import sys
@@ -7,7 +7,12 @@ import math
 
 import tabulate
 
-from .perfutils import read_events
+from .perfdata import PerfData
+from .ringbuffer import RingBufferDump
+from .histogram import LogHistogram, write_histograms
+from .stacks import StackTable
+from .tracewriter import trace_writer
+from .perfutils import read_tokenized_events, perf_script, parse_sched_switch, parse_sched_wakeup, parse_sched_process_fork, parse_function_probe, parse_lost, read_symbols, header_tgid
 
 
 def parse_values(parts, **types):
@@ -35,6 +40,161 @@ def drops_gil(stacktrace):
     return in_stacktrace('drop_gil', stacktrace)
 
 
+# kinds of events gil2trace handles (and eventstore stores, except the last three)
+IGNORE, FUNCTION_ENTRY, FUNCTION_RETURN, TAKE, TAKE_RETURN, DROP, DROP_RETURN, SCHED_SWITCH, SCHED_WAKEUP, LOST, THROTTLE, UNTHROTTLE = range(12)
+
+
+# what perf script --show-lost-events (and perfdata.PerfData) calls the records that tell us we lost events
+perf_records = {'PERF_RECORD_LOST': LOST, 'PERF_RECORD_LOST_SAMPLES': LOST, 'PERF_RECORD_THROTTLE': THROTTLE, 'PERF_RECORD_UNTHROTTLE': UNTHROTTLE}
+
+
+class EventKinds(dict):
+    """Dispatch table that maps the exact event name to what kind of event it is.
+
+    We only match the (regex) probe names the first time we see an event.
+    """
+    def __init__(self, take_probe="python:take_gil$", take_probe_return="python:take_gil__return", drop_probe="python:drop_gil$", drop_probe_return="python:drop_gil__return"):
+        super().__init__({'sched:sched_switch': SCHED_SWITCH, 'sched:sched_wakeup': SCHED_WAKEUP, **perf_records})
+        self.probes = [(re.compile('pytrace:function_entry'), FUNCTION_ENTRY), (re.compile('pytrace:function_return'), FUNCTION_RETURN),
+                       (re.compile(take_probe), TAKE), (re.compile(take_probe_return), TAKE_RETURN),
+                       (re.compile(drop_probe), DROP), (re.compile(drop_probe_return), DROP_RETURN)]
+
+    def __missing__(self, event):
+        kind = self[event] = next((kind for probe, kind in self.probes if probe.match(event)), IGNORE)
+        return kind
+
+
+class TraceQuality:
+    """Keeps track of the events perf lost (PERF_RECORD_LOST) or did not record (throttling), and of the
+    anomalies in the GIL events we had to repair, so we know how much we can trust a trace.
+
+    Times are in us, like the events, lost events are also counted per window of window seconds.
+    """
+    def __init__(self, window=1):
+        self.window = window * 1e6
+        self.lost = Counter()  # cpu -> number of events lost
+        self.lost_windows = Counter()  # window (since the first event) -> number of events lost
+        self.lost_records = 0  # perf does not always tell how many events it lost
+        self.throttled = {}  # cpu -> time since it is throttled
+        self.throttled_time = 0
+        self.last_lost = None  # last time we lost events, or got throttled
+        self.anomalies = Counter()  # what -> count
+        self.uncertain_time = 0
+        self.uncertain_holds = 0  # repaired GIL holds and waits, which we leave out of the latencies
+        self.uncertain_waits = 0
+        self.events = 0  # number of GIL events seen
+        self.time_first = None
+
+    def record(self, kind, time, cpu, other):
+        """Handles a LOST, THROTTLE or UNTHROTTLE event"""
+        cpu = int(cpu[1:-1]) if cpu else -1
+        if self.time_first is None:
+            self.time_first = time
+        self.last_lost = time
+        if kind == LOST:
+            self.lost_records += 1
+            count = parse_lost(other)
+            if count:
+                self.lost[cpu] += count
+                self.lost_windows[int((time - self.time_first) // self.window)] += count
+        elif kind == THROTTLE:
+            self.throttled.setdefault(cpu, time)
+        elif kind == UNTHROTTLE and cpu in self.throttled:
+            self.throttled_time += time - self.throttled.pop(cpu)
+
+    def anomaly(self, what, duration=0):
+        self.anomalies[what] += 1
+        self.uncertain_time += duration
+
+    def consistency(self):
+        """Fraction of the GIL events that did not need a repair"""
+        if not self.events:
+            return 1.
+        return max(0., 1 - sum(self.anomalies.values()) / self.events)
+
+    def print_summary(self, total_time=0):
+        # total_time is the time of all threads (in us), to put the uncertain time in perspective
+        if not (self.lost_records or self.throttled or self.throttled_time or self.anomalies):
+            return
+        print("Trace quality:")
+        print()
+        if self.lost_records:
+            per_cpu = ', '.join(f'{cpu}: {count}' for cpu, count in sorted(self.lost.items()))
+            print(f"perf lost {sum(self.lost.values())} events in {self.lost_records} chunks" + (f" (per CPU {per_cpu})" if per_cpu else ""))
+            if self.lost_windows:
+                worst = ', '.join(f'{window * self.window / 1e6:g}s: {count}' for window, count in self.lost_windows.most_common(5))
+                print(f"most events were lost (per {self.window / 1e6:g}s since the start): {worst}")
+        if self.throttled or self.throttled_time:
+            print(f"perf was throttled for {self.throttled_time:.0f} us" + (f", and still was at the end on {len(self.throttled)} CPU(s)" if self.throttled else ""))
+        if self.anomalies:
+            print("repaired GIL anomalies: " + ', '.join(f'{what}: {count}' for what, count in self.anomalies.most_common()))
+        if self.uncertain_holds or self.uncertain_waits:
+            print(f"{self.uncertain_holds} GIL holds and {self.uncertain_waits} waits are repaired, they count in the totals, but not in the wait and hold times")
+        if self.events:
+            uncertain = f", {self.uncertain_time / total_time * 100:.1f}% of the thread time is uncertain" if total_time else ""
+            print(f"{self.consistency() * 100:.1f}% of the {self.events} GIL events are consistent{uncertain}")
+        if self.lost_records or self.throttled_time:
+            print("To lose fewer events, give perf a larger buffer (perf record -m), or record fewer events (e.g. giltracer --no-state-detect)")
+        print()
+
+
+class GilContention:
+    """Aggregates who waited on the GIL while which thread held it, and which Python function the holder was running.
+
+    Between two events of a process, each thread waiting on the GIL is blocked by the thread(s) holding it, so we
+    add that time to the waiter x holder matrix, and to the function on top of the Python stack of the holder
+    (weighted by the number of waiters). Memory only grows with the number of threads and functions.
+    """
+    def __init__(self):
+        self.matrix = defaultdict(Counter)  # waiter pid -> holder pid -> time (in us)
+        self.functions = Counter()  # call (or None, when not in a Python function) -> time others waited
+        self.last_time = {}  # process -> time
+
+    def advance(self, time, tgid, holders, waiters, pystack):
+        last = self.last_time.get(tgid)
+        if last is not None and time <= last:
+            return
+        self.last_time[tgid] = time
+        if last is None or not holders or not waiters:
+            return
+        # during a handover, there can briefly be two holders, so share the time
+        dt = (time - last) / len(holders)
+        for holder in holders:
+            stack = pystack.get(holder)
+            self.functions[stack[-1] if stack else None] += dt * len(waiters)
+            for waiter in waiters:
+                self.matrix[waiter][holder] += dt
+
+    def top_functions(self, count=10):
+        """Returns a list of (call, time others waited in us) of the functions that blocked others the most"""
+        return self.functions.most_common(count)
+
+    def print_summary(self, parent_pid, count=10):
+        if not self.matrix:
+            return
+        holders = sorted({holder for blocked in self.matrix.values() for holder in blocked})
+        table = [[waiter if waiter != parent_pid else f'{waiter}*', *[blocked.get(holder, 0) for holder in holders]]
+                 for waiter, blocked in sorted(self.matrix.items())]
+        headers = ['waiter \\ holder'] + [holder if holder != parent_pid else f'{holder}*' for holder in holders]
+        print("Who blocks whom, time (us) spent waiting on the GIL (rows) while another thread had it (columns):")
+        print()
+        print(tabulate.tabulate(table, headers, floatfmt=".1f"))
+        print()
+        total = sum(self.functions.values())
+        table = []
+        for call, time in self.top_functions(count):
+            if call is None:
+                name = '(not in a traced Python function)'
+            else:
+                filename, funcname, lineno = [str(part).strip('"') for part in call[:3]]
+                name = f'{funcname} ({filename}:{lineno})'
+            table.append([name, time, time / total * 100])
+        print("Python functions that held the GIL while others waited:")
+        print()
+        print(tabulate.tabulate(table, ['function', 'others waited(us)', '%'], floatfmt=".1f"))
+        print()
+
+
 usage = """
 
 Convert perf.data to TraceEvent JSON data.
@@ -52,7 +212,22 @@ Usage for GIL:
 (read the docs to install the GIL uprobes)
 $ perf record -e 'python:*gil*' -k CLOCK_MONOTONIC -- python -m per4m.example1
 $ perf script --ns --no-inline | per4m perf2trace gil -o example1gil.json
+Or let per4m run perf script, in parallel on 8 time slices of perf.data
+$ per4m perf2trace gil --input-perf perf.data -j 8 -o example1gil.json
+Or read perf.data directly, without perf script (fastest, but does not give stacktraces)
+$ per4m perf2trace gil --input-perf perf.data --native -o example1gil.json
 $ viztracer --combine example1.json example1gil.json -o example1.html
+Or write a Perfetto trace, which is much smaller, and opens a lot faster in https://ui.perfetto.dev
+$ per4m perf2trace gil --input-perf perf.data -o example1gil.pftrace
+
+When tracing Python calls with pytrace.start(True), the probes only get a code object id:
+$ sudo perf probe -x per4m/pytrace*.so 'pytrace:function_entry_id=pytrace_function_entry_id code=%di:x64 l=%si:s32 what=%dx:s32'
+$ sudo perf probe -x per4m/pytrace*.so 'pytrace:function_return_id=pytrace_function_return_id code=%di:x64 l=%si:s32 what=%dx:s32'
+and per4m.perfutils.write_symbols('symbols.json') after pytrace.stop() writes the table to resolve them:
+$ per4m perf2trace gil --input-perf perf.data --symbols symbols.json -o example1gil.json
+
+Or without perf, tracing in process with pytrace.start(ring=1_000_000) and pytrace.dump('pytrace.dat'):
+$ per4m perf2trace gil --input-pytrace pytrace.dat -o example1gil.json
 
 
 """
@@ -74,8 +249,17 @@ def main(argv=sys.argv):
     parser.add_argument('--all-tracepoints', help="store all tracepoints phase (default: %(default)s)", default=False, action='store_true')
 
     parser.add_argument('--input', '-i', help="Optional VizTracer input for filtering PIDs and gil load calculations")
-
-    parser.add_argument('--output', '-o', dest="output", default='perf.json', help="Output filename (default %(default)s)")
+    parser.add_argument('--symbols', help="Symbol table written by per4m.perfutils.write_symbols, to resolve the code object ids of the pytrace:function_entry_id probes")
+    parser.add_argument('--input-perf', help="Run perf script on this perf.data file, instead of reading perf script output from stdin")
+    parser.add_argument('--native', help="Read --input-perf directly, instead of using perf script (no stacktraces) (default: %(default)s)", default=False, action='store_true')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Number of perf script processes to run in parallel (on time slices of --input-perf) (default: %(default)s)")
+    parser.add_argument('--input-pytrace', help="Read events from a pytrace ring buffer dump (pytrace.dump), instead of perf")
+
+    parser.add_argument('--output', '-o', dest="output", default='perf.json', help="Output filename, gzip compressed when it ends with .gz (default %(default)s)")
+    parser.add_argument('--gzip', help="gzip compress the output (default: when the output filename ends with .gz)", default=None, action='store_true')
+    parser.add_argument('--format', choices=['json', 'perfetto'], default=None, help="Write TraceEvent JSON, or a (much smaller) Perfetto protobuf trace for ui.perfetto.dev (default: perfetto when the output filename ends with .pftrace(.gz), else json)")
+    parser.add_argument('--max-events', type=int, default=None, help="Only keep the last N trace events (ring buffer), to limit the output size, the ends of async and duration events whose begin was dropped are dropped too (default: keep all)")
+    parser.add_argument('--histograms', help="For gil, write the per thread histograms of GIL wait and hold times (in us) to this JSON file")
     parser.add_argument("type", help="Type of conversion to do", choices=['sched', 'gil'])
 
 
@@ -93,10 +277,21 @@ def main(argv=sys.argv):
             pids.add(event['pid'])
             pids.add(event['tid'])
 
-    trace_events = []
+    if args.input_pytrace:
+        input = RingBufferDump(args.input_pytrace)
+        if verbose >= 1 and any(input.dropped.values()):
+            print(f"Ring buffer overflowed, lost the first {sum(input.dropped.values())} events", file=sys.stderr)
+    elif args.input_perf and args.native:
+        input = PerfData(args.input_perf)
+    elif args.input_perf:
+        input = perf_script(args.input_perf, jobs=args.jobs, verbose=verbose)
+    else:
+        input = sys.stdin
+    writer = trace_writer(args.output, format=args.format, compress=args.gzip, max_events=args.max_events)
     if args.type == "sched":
-        for header, tb, event in perf2trace(sys.stdin, verbose=verbose, store_runing=store_runing, store_sleeping=store_sleeping, all_tracepoints=args.all_tracepoints):
-            trace_events.append(event)
+        with writer:
+            for header, tb, event in perf2trace(input, verbose=verbose, store_runing=store_runing, store_sleeping=store_sleeping, all_tracepoints=args.all_tracepoints):
+                writer.write(event)
     elif args.type == "gil":
         # we don't use this any more, lets keep it to maybe pull out thread information
         # if args.input:
@@ -109,75 +304,178 @@ def main(argv=sys.argv):
         #             t_min[pid] = min(t_min.get(pid, ts), ts)
         #             t_max[pid] = max(t_max.get(pid, ts), ts)
 
-        for header, event in gil2trace(sys.stdin, verbose=verbose, as_async=args.as_async, only_lock=args.only_lock, pids=pids):
-            if verbose >= 3:
-                print(event)
-            trace_events.append(event)
+        with writer:
+            symbols = read_symbols(args.symbols) if args.symbols else None
+            wait_histograms = defaultdict(LogHistogram)
+            hold_histograms = defaultdict(LogHistogram)
+            for header, event in gil2trace(input, verbose=verbose, as_async=args.as_async, only_lock=args.only_lock, pids=pids, symbols=symbols,
+                                           wait_histograms=wait_histograms, hold_histograms=hold_histograms):
+                if verbose >= 3:
+                    print(event)
+                writer.write(event)
+        if args.histograms:
+            write_histograms(args.histograms, wait_histograms, hold_histograms)
+            if verbose >= 1:
+                print(f"Wrote GIL wait and hold time histograms to {args.histograms}")
     else:
         raise ValueError(f'Unknown type {args.type}')
-    with open(args.output, 'w') as f:
-        json.dump({'traceEvents': trace_events}, f)
     if verbose >= 1:
-        print(f"Wrote to {args.output}")
+        if writer.dropped:
+            print(f"Dropped {writer.dropped} events, the oldest ones and the ends whose begin was dropped (--max-events={args.max_events})")
+        print(f"Wrote {writer.count} events to {args.output}")
 
 
-def gil2trace(input, verbose=1, take_probe="python:take_gil$", take_probe_return="python:take_gil__return", drop_probe="python:drop_gil$", drop_probe_return="python:drop_gil__return", as_async=False, show_instant=True, duration_min_us=1, only_lock=True, t_min={}, t_max={}, pids=set()):
+def gil2trace(input, verbose=1, take_probe="python:take_gil$", take_probe_return="python:take_gil__return", drop_probe="python:drop_gil$", drop_probe_return="python:drop_gil__return", as_async=False, show_instant=True, duration_min_us=1, only_lock=True, t_min=None, t_max=None, pids=None, symbols=None, quality=None, wait_histograms=None, hold_histograms=None, contention=None):
     time_first = None
+    # fresh dicts for each conversion, giltracer converts several recordings in the same process
+    if t_min is None:
+        t_min = {}
+    if t_max is None:
+        t_max = {}
+    if pids is None:
+        pids = set()
+    if quality is None:
+        quality = TraceQuality()
+    if contention is None:
+        contention = GilContention()
+    # per pid, the distribution of how long each wait on and each hold of the GIL took
+    if wait_histograms is None:
+        wait_histograms = defaultdict(LogHistogram)
+    if hold_histograms is None:
+        hold_histograms = defaultdict(LogHistogram)
 
     # dicts that map pid -> time
     wants_take_gil = {}
     wants_drop_gil = {}
-    has_gil = {}
+    has_gil = defaultdict(dict)  # per process (each has its own GIL), the pids (threads) that have the GIL
     has_gil_stack = {}
+    waiting = defaultdict(set)  # per process, the pids that called take_gil, but did not return from it yet
 
     pystack = defaultdict(list)
-    wait_for_stack = defaultdict(list)  # pid -> call
 
     parent_pid = None
+    tgids = {}  # maps pid (thread) -> process id
     # to avoid printing out the same msg over and over
     ignored = set()
     # keep track of various times
     time_on_gil = defaultdict(int)
     time_wait_gil = defaultdict(int)
     jitter = 1e-3  # add 1 ns for proper sorting
-    for header, _ in read_events(input):
+    event_kinds = EventKinds(take_probe, take_probe_return, drop_probe, drop_probe_return)
+
+    def repair(header, tgid, pid, begin, end, what):
+        # we had to guess what happened between begin and end, since perf lost (some of) the events
+        quality.anomaly(what, end - begin)
+        if verbose >= 2:
+            print(f'Anomaly: {what} for PID {pid}, repaired between {begin} and {end}', file=sys.stderr)
+        if end > begin:
+            yield header, {"pid": tgid, "tid": pid, "ts": begin, "dur": end - begin, "name": 'uncertain', "ph": "X", "cat": "GIL state", 'args': {'reason': what}, 'cname': 'grey'}
+
+    def release(header, tgid, pid, time_gil_take, time_gil_drop, uncertain=False):
+        # pid had the GIL from time_gil_take till drop_gil returned at time_gil_drop, uncertain when we repaired either
+        duration = time_gil_drop - time_gil_take
+        time_on_gil[pid] += duration
+        if uncertain:
+            quality.uncertain_holds += 1
+        else:
+            hold_histograms[pid].record(duration)
+        has_gil[tgid].pop(pid, None)
+        if duration < duration_min_us:
+            if verbose >= 2:
+                print(f'Ignoring {duration}us duration GIL lock', file=sys.stderr)
+            return
+        # when we missed take_gil or drop_gil, we assume they did not take any time
+        wants_take = min(wants_take_gil.get(pid, time_gil_take), time_gil_take)
+        wants_drop = wants_drop_gil.get(pid, time_gil_drop)
+        if not time_gil_take <= wants_drop <= time_gil_drop:
+            wants_drop = time_gil_drop
+
+        args = {'duraction': f'{duration} us'}
+        if show_instant:
+            # we do both tevent only after drop, so we can ignore 0 duraction event
+            # TODO: 'flush' out takes without a drop (e.g. perf stopped before drop happned)
+            name = "GIL-take"
+            scope = "t"  # thread scope
+            event = {"pid": tgid, "tid": f'{pid}', "ts": time_gil_take, "name": name, "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'terrible'}
+            yield header, event
+
+            name = "GIL-drop"
+            scope = "t"  # thread scope
+            event = {"pid": tgid, "tid": f'{pid}', "ts": time_gil_drop, "name": name, "ph": "i", "cat": "GIL state", 's': scope, 'args': args, 'cname': 'good'}
+            yield header, event
+
+        if as_async:
+            begin, end = 'b', 'e'
+
+        else:
+            begin, end = 'B', 'E'
+        event_id = int(time_gil_drop*1e3)
+        name = "GIL-flow"
+        common = {"pid": tgid if as_async else f'{tgid}-GIL', "tid": f'{pid}', 'cat': 'GIL state', 'args': args, 'id': event_id, 'cname': 'bad'}
+        # we may have called take_gil earlier than we got it back
+        # sth like [called take [ take success [still dropping]]]
+        yield header, {"name": 'GIL', "ph": begin, "ts": wants_take, **common, 'cname': 'bad'}
+        if not only_lock and pid in wants_take_gil:
+            yield header, {"name": 'take_gil', "ph": begin, "ts": wants_take, **common}
+            yield header, {"name": 'take_gil', "ph": end, "ts": time_gil_take, **common}
+        yield header, {"name": 'LOCK',   "ph": begin, "ts": time_gil_take, **common, 'cname': 'terrible'}
+        yield header, {"name": 'LOCK', "ph": end, "ts": wants_drop, **common, 'cname': 'terrible'}
+        if not only_lock:
+            yield header, {"name": 'drop_gil',   "ph": begin, "ts": wants_drop, **common}
+            yield header, {"name": 'drop_gil', "ph": end, "ts": time_gil_drop, **common}
+        # if not only_lock and pid in wants_take_gil:
+        yield header, {"name": 'GIL', "ph": end, "ts": time_gil_drop, **common, 'cname': 'bad'}
+
+    for header, _, tokens in read_tokenized_events(input):
         try:
             header = header.rstrip()
             if verbose >= 2:
                 print(header)
 
-            # parse the header
-            comm, pid, cpu, time, event, *other = header.split()
-            pid = int(pid)
+            comm, pid, cpu, time, count, event, other = tokens
+            kind = event_kinds[event]
+            if kind in (LOST, THROTTLE, UNTHROTTLE):
+                # not about a thread, so we handle them before filtering and the statistics
+                quality.record(kind, time, cpu, other)
+                if kind != UNTHROTTLE and parent_pid is not None:
+                    name = 'perf lost events' if kind == LOST else 'perf throttled'
+                    yield header, {"pid": tgids.get(parent_pid, parent_pid), "tid": parent_pid, "ts": time, "name": name, "ph": "i", "cat": "perf", 's': 'g', 'args': {'lost': parse_lost(other), 'cpu': cpu}}
+                continue
             if pids and pid not in pids:  # optionally filter
                 continue
             if parent_pid is None:  # lets assume the first event is from the parent process
                 parent_pid = pid
-            assert event[-1] == ':'
-            event = event[:-1]  # take off :
-            assert time[-1] == ':'
-            time = time[:-1]  # take off :
-            time = float(time[:-1]) * 1e6
+            tgid = tgids.get(pid)
+            if tgid is None:
+                # only with perf script -F +pid we know the process, otherwise assume it is the parent process
+                tgid = tgids[pid] = header_tgid(header) or parent_pid
+            gil_holders = has_gil[tgid]
+            waiters = waiting[tgid]
 
             # keeping track for statistics
-            t_min[pid] = min(time, t_min.get(pid, time))
-            t_max[pid] = max(time, t_max.get(pid, time))
+            if pid not in t_min:
+                t_min[pid] = t_max[pid] = time
+            elif time > t_max[pid]:
+                t_max[pid] = time
+            elif time < t_min[pid]:
+                t_min[pid] = time
+
+            # who blocked whom since the previous event, before anything changes
+            contention.advance(time, tgid, gil_holders, waiters, pystack)
 
             # and proces it
             if time_first is None:
                 time_first = time
+                if quality.time_first is None:
+                    quality.time_first = time
 
-            function_entry_probe = 'pytrace:function_entry'
-            function_return_probe = 'pytrace:function_return'
-            if re.match(function_entry_probe, event):
-                values = parse_values(other, l=int, what=int)
-                call = (values['filename'], values['funcname'],
-                        values['l'], values['what'])
+            if kind == FUNCTION_ENTRY:
+                call = parse_function_probe(other, symbols)
                 pystack[pid].append(call)
                 depth = len(pystack[pid])
                 if verbose >= 3:
                     print(pid, "  " * depth, "→", call)
-            elif re.match(function_return_probe, event):
+            elif kind == FUNCTION_RETURN:
                 try:
                     call = pystack[pid].pop()
                     depth = len(pystack[pid])
@@ -185,94 +483,79 @@ def gil2trace(input, verbose=1, take_probe="python:take_gil$", take_probe_return
                         print(pid, "  " * depth, "←", call)
                 except:
                     pass  # we may have missed some calls
-            elif re.match(take_probe, event):
+            elif kind == TAKE:
+                quality.events += 1
                 wants_take_gil[pid] = time
+                waiters.add(pid)
                 scope = "t"  # thread scope
-                yield header, {"pid": parent_pid, "tid": pid, "ts": time, "name": 'take', "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'bad'}
-                if has_gil:
-                    for blocking_pid in has_gil:
-                        if pystack[blocking_pid]:
-                            call = pystack[blocking_pid][-1]
-                            wait_for_stack[pid].append((blocking_pid, call, None))
-                        else:
-                            call = ('cpython', 'cpython', -1)
-                            wait_for_stack[pid].append((blocking_pid, call, None))
-            elif re.match(take_probe_return, event):
-                if has_gil:
-                    for other_pid in has_gil:
-                        gap = time - has_gil[other_pid]
-                        # optimistic overlap would be if we take it from the time it wanted to drop
-                        # gap = time - wants_drop_gil[other_pid]
-                        # print(gap)
-                        if gap < 0: # this many us overlap is ok
-                            # I think it happens when a thread has dropped the GIL, but it has not returned yet
-                            # TODO: we should be able to correct the times
+                yield header, {"pid": tgid, "tid": pid, "ts": time, "name": 'take', "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'bad'}
+            elif kind == TAKE_RETURN:
+                quality.events += 1
+                uncertain_wait = pid not in waiters
+                if uncertain_wait:
+                    # we missed take_gil, so we do not know since when it waited
+                    yield from repair(header, tgid, pid, time, time, 'missing take')
+                    wants_take_gil[pid] = time
+                waiters.discard(pid)
+                if pid in gil_holders:
+                    # we missed it returning from drop_gil, which happened before it wanted the GIL back
+                    drop_time = wants_take_gil[pid]
+                    yield from repair(header, tgid, pid, drop_time, time, 'missing drop')
+                    yield from release(header, tgid, pid, gil_holders[pid], drop_time, uncertain=True)
+                for other_pid in list(gil_holders):
+                    gap = time - gil_holders[other_pid]
+                    # optimistic overlap would be if we take it from the time it wanted to drop
+                    # gap = time - wants_drop_gil[other_pid]
+                    # print(gap)
+                    if gap < 0: # this many us overlap is ok
+                        # I think it happens when a thread has dropped the GIL, but it has not returned yet
+                        overlap = -gap
+                        quality.anomaly('overlap', overlap)
+                        if verbose >= 2:
                             tip = "(If running as giltracer, try passing --no-state-detect to reduce CPU load"
                             print(f'Anomaly: PID {other_pid} already seems to have the GIL, {overlap} us overlap with {pid} {pid==parent_pid}) {tip}', file=sys.stderr)
-                            # keep this for debugging
-                            # yield header, {"pid": parent_pid, "tid": other_pid, "ts": has_gil[other_pid], "dur": overlap, "name": 'GIL overlap1', "ph": "X", "cat": "process state"}
-                            # yield header, {"pid": parent_pid, "tid": pid, "ts": has_gil[other_pid], "dur": overlap, "name": 'GIL overlap1', "ph": "X", "cat": "process state"}
-                            # yield header, {"pid": parent_pid, "tid": other_pid, "ts": wants_drop_gil[other_pid], "dur": overlap_relaxed, "name": 'GIL overlap2', "ph": "X", "cat": "process state"}
-                            # yield header, {"pid": parent_pid, "tid": pid, "ts": wants_drop_gil[other_pid], "dur": overlap_relaxed, "name": 'GIL overlap2', "ph": "X", "cat": "process state"}
-                has_gil[pid] = time
+                        # keep this for debugging
+                        # yield header, {"pid": parent_pid, "tid": other_pid, "ts": has_gil[other_pid], "dur": overlap, "name": 'GIL overlap1', "ph": "X", "cat": "process state"}
+                        # yield header, {"pid": parent_pid, "tid": pid, "ts": has_gil[other_pid], "dur": overlap, "name": 'GIL overlap1', "ph": "X", "cat": "process state"}
+                        # yield header, {"pid": parent_pid, "tid": other_pid, "ts": wants_drop_gil[other_pid], "dur": overlap_relaxed, "name": 'GIL overlap2', "ph": "X", "cat": "process state"}
+                        # yield header, {"pid": parent_pid, "tid": pid, "ts": wants_drop_gil[other_pid], "dur": overlap_relaxed, "name": 'GIL overlap2', "ph": "X", "cat": "process state"}
+                    elif wants_drop_gil.get(other_pid, -math.inf) < gil_holders[other_pid]:
+                        # the other thread did not even call drop_gil, we must have lost it (and its return),
+                        # so it dropped it somewhere after the last time we saw it
+                        drop_time = min(t_max[other_pid], time)
+                        yield from repair(header, tgid, other_pid, drop_time, time, 'missing drop')
+                        yield from release(header, tgid, other_pid, gil_holders[other_pid], drop_time, uncertain=True)
+                gil_holders[pid] = time
                 has_gil_stack[pid] = pystack[pid].copy()
                 time_wait = time - max(t_min[pid], wants_take_gil[pid])
                 time_wait_gil[pid] += time_wait
-            elif re.match(drop_probe, event):
+                if uncertain_wait:
+                    quality.uncertain_waits += 1
+                else:
+                    wait_histograms[pid].record(time_wait)
+            elif kind == DROP:
+                quality.events += 1
                 wants_drop_gil[pid] = time
                 scope = "t"  # thread scope
-                yield header, {"pid": parent_pid, "tid": pid, "ts": time, "name": 'drop', "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'bad'}
-            elif re.match(drop_probe_return, event):
-                if pid not in has_gil:
-                    print(f'Anomaly: this PIDs drops the GIL: {pid}, but never took it (maybe we missed it?)', file=sys.stderr)
-                time_gil_take = has_gil.get(pid, time_first)
-                time_gil_drop = time
-                duration = time_gil_drop - time_gil_take
-                time_on_gil[pid] += duration
-                if pid in has_gil:
-                    del has_gil[pid]
-                if duration < duration_min_us:
+                yield header, {"pid": tgid, "tid": pid, "ts": time, "name": 'drop', "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'bad'}
+            elif kind == DROP_RETURN:
+                quality.events += 1
+                uncertain_hold = False
+                if pid in gil_holders:
+                    time_gil_take = gil_holders[pid]
+                elif quality.last_lost is None:
+                    # we started recording while it had the GIL
                     if verbose >= 2:
-                        print(f'Ignoring {duration}us duration GIL lock', file=sys.stderr)
-                    continue
-
-                args = {'duraction': f'{duration} us'}
-                if show_instant:
-                    # we do both tevent only after drop, so we can ignore 0 duraction event
-                    # TODO: 'flush' out takes without a drop (e.g. perf stopped before drop happned)
-                    name = "GIL-take"
-                    scope = "t"  # thread scope
-                    event = {"pid": parent_pid, "tid": f'{pid}', "ts": time_gil_take, "name": name, "ph": "i", "cat": "GIL state", 's': scope, 'cname': 'terrible'}
-                    yield header, event
-
-                    name = "GIL-drop"
-                    scope = "t"  # thread scope
-                    event = {"pid": parent_pid, "tid": f'{pid}', "ts": time_gil_drop, "name": name, "ph": "i", "cat": "GIL state", 's': scope, 'args': args, 'cname': 'good'}
-                    yield header, event
-
-                if as_async:
-                    begin, end = 'b', 'e'
-
+                        print(f'Anomaly: this PIDs drops the GIL: {pid}, but never took it (maybe we missed it?)', file=sys.stderr)
+                    time_gil_take = time_first
                 else:
-                    begin, end = 'B', 'E'
-                event_id = int(time*1e3)
-                name = "GIL-flow"
-                common = {"pid": parent_pid if as_async else f'{parent_pid}-GIL', "tid": f'{pid}', 'cat': 'GIL state', 'args': args, 'id': event_id, 'cname': 'bad'}
-                # we may have called take_gil earlier than we got it back
-                # sth like [called take [ take success [still dropping]]]
-                yield header, {"name": 'GIL', "ph": begin, "ts": wants_take_gil[pid], **common, 'cname': 'bad'}
-                if not only_lock and pid in wants_take_gil:
-                    yield header, {"name": 'take_gil', "ph": begin, "ts": wants_take_gil[pid], **common}
-                    yield header, {"name": 'take_gil', "ph": end, "ts": time_gil_take, **common}
-                assert time_gil_take >= wants_take_gil[pid], f"{time_gil_take} >= {wants_take_gil[pid]}"
-                yield header, {"name": 'LOCK',   "ph": begin, "ts": time_gil_take, **common, 'cname': 'terrible'}
-                yield header, {"name": 'LOCK', "ph": end, "ts": wants_drop_gil[pid], **common, 'cname': 'terrible'}
-                if not only_lock:
-                    yield header, {"name": 'drop_gil',   "ph": begin, "ts": wants_drop_gil[pid], **common}
-                    yield header, {"name": 'drop_gil', "ph": end, "ts": time_gil_drop, **common}
-                # if not only_lock and pid in wants_take_gil:
-                yield header, {"name": 'GIL', "ph": end, "ts": time_gil_drop, **common, 'cname': 'bad'}
-                assert time_gil_drop >= wants_drop_gil[pid]
+                    # we lost it taking the GIL, the best guess is that it happened when we lost events
+                    time_gil_take = min(max(quality.last_lost, t_min[pid]), time)
+                    uncertain_hold = True
+                    yield from repair(header, tgid, pid, time_gil_take, time, 'missing take')
+                if wants_drop_gil.get(pid, -math.inf) < time_gil_take:
+                    yield from repair(header, tgid, pid, time, time, 'missing drop')
+                yield from release(header, tgid, pid, time_gil_take, time, uncertain=uncertain_hold)
             else:
                 if event not in ignored:
                     print(f'ignoring {event}', file=sys.stderr)
@@ -281,83 +564,112 @@ def gil2trace(input, verbose=1, take_probe="python:take_gil$", take_probe_return
             print("error on line", header, file=sys.stderr)
             raise
     if verbose >= 1:
-        pids = ["PID"]
-        totals = ["total"]
-        wait = ["wait"]
-        table = []
-        for pid in t_min:
-            total = t_max[pid] - t_min[pid]
-            wait = time_wait_gil[pid]
-            on_gil = time_on_gil[pid]
-            no_gil = total - wait - on_gil
-            row = [pid if pid != parent_pid else f'{pid}*', total]
-            if total == 0:
-                 row += [math.inf, math.inf, math.inf]
+        processes = sorted(set(tgids.values()))
+        if len(processes) <= 1:
+            print_summary(t_min, t_max, time_on_gil, time_wait_gil, parent_pid, verbose=verbose)
+            print_latencies(wait_histograms, hold_histograms, list(t_min), parent_pid)
+        else:
+            for process in processes:
+                threads = [pid for pid in t_min if tgids.get(pid) == process]
+                print_summary({pid: t_min[pid] for pid in threads}, t_max, time_on_gil, time_wait_gil, process, verbose=verbose, process=process)
+                print_latencies(wait_histograms, hold_histograms, threads, process, process=process)
+        contention.print_summary(parent_pid)
+        quality.print_summary(total_time=sum(t_max[pid] - t_min[pid] for pid in t_min))
+
+
+def print_summary(t_min, t_max, time_on_gil, time_wait_gil, parent_pid, verbose=1, process=None):
+    # all arguments, except parent_pid and process, are dicts that map pid -> time (in us)
+    # only the pids in t_min are shown, process is only used in the title
+    table = []
+    for pid in t_min:
+        total = t_max[pid] - t_min[pid]
+        wait = time_wait_gil[pid]
+        on_gil = time_on_gil[pid]
+        no_gil = total - wait - on_gil
+        row = [pid if pid != parent_pid else f'{pid}*', total]
+        if total == 0:
+             row += [math.inf, math.inf, math.inf]
+        else:
+            row += [no_gil/total*100, on_gil/total*100, wait/total * 100]
+        if verbose >= 2:
+            row.extend([no_gil, on_gil, wait])
+        table.append(row)
+    headers = ['PID', 'total(us)', 'no gil%✅', 'has gil%❗', 'gil wait%❌']
+    if verbose:
+        headers.extend(['no gil(us)', 'has gil(us)', 'gil wait(us)'])
+    table = tabulate.tabulate(table, headers, floatfmt=".1f")
+    print()
+    print("Summary of threads:" if process is None else f"Summary of threads of process {process}:")
+    print()
+    print(table)
+    print()
+    print("High 'no gil' is good (✅), we like low 'has gil' (❗),\n and we don't want 'gil wait' (❌). (* indicates main thread)")
+    print()
+
+
+def print_latencies(wait_histograms, hold_histograms, pids, parent_pid, process=None):
+    # wait_histograms and hold_histograms map pid -> LogHistogram, only pids are shown
+    table = []
+    for pid in pids:
+        row = [pid if pid != parent_pid else f'{pid}*']
+        for histograms in [wait_histograms, hold_histograms]:
+            histogram = histograms.get(pid)
+            if histogram:
+                row += [histogram.count, *histogram.percentiles(50, 90, 99), histogram.max]
             else:
-                row += [no_gil/total*100, on_gil/total*100, wait/total * 100]
-            if verbose >= 2:
-                row.extend([no_gil, on_gil, wait])
-            table.append(row)
-        headers = ['PID', 'total(us)', 'no gil%✅', 'has gil%❗', 'gil wait%❌']
-        if verbose:
-            headers.extend(['no gil(us)', 'has gil(us)', 'gil wait(us)'])
-        table = tabulate.tabulate(table, headers, floatfmt=".1f")
-        print()
-        print("Summary of threads:")
-        print()
-        print(table)
-        print()
-        print("High 'no gil' is good (✅), we like low 'has gil' (❗),\n and we don't want 'gil wait' (❌). (* indicates main thread)")
-        print()
-
-
-def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tracepoints=False):
+                row += [0] + [None] * 4
+        table.append(row)
+    if not any(wait_histograms.get(pid) or hold_histograms.get(pid) for pid in pids):
+        return
+    headers = ['PID', 'waits', 'wait p50(us)', 'p90', 'p99', 'max', 'holds', 'hold p50(us)', 'p90', 'p99', 'max']
+    table = tabulate.tabulate(table, headers, floatfmt=".1f")
+    print("GIL wait and hold times of threads:" if process is None else f"GIL wait and hold times of threads of process {process}:")
+    print()
+    print(table)
+    print()
+
+
+def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tracepoints=False, stacks=None, quality=None):
+    # stacktraces are interned, so we only keep one copy of each, and only need to look for take_gil once per stack
+    if stacks is None:
+        stacks = StackTable()
+    if quality is None:
+        quality = TraceQuality()
+    stack_takes_gil = {}  # stack id -> bool
     # useful for debugging, to have the pids a name
     pid_names = {}
     # pid_names = {872068: "main", 872070: "t1", 872071: "t2"}
     # a bit pendantic to keep these separated
     last_run_time = {}
     last_sleep_time = {}
-    last_sleep_stacktrace = {}
+    last_sleep_stacktrace = {}  # pid -> stack id
     time_first = None
     parent_pid = {}  # maps pid/tid to the parent
+    tgids = {}  # maps pid/tid to the process id, when perf script -F +pid tells us
     count = None
-    for header, stacktrace in read_events(input):
+    for header, stacktrace, tokens in read_tokenized_events(input):
         try:
             if verbose >= 3:
                 print(header)
             pid = None
-            parts = header.split()
             # python 302629 [011] 3485124.180312:       sched:sched_switch: prev_comm=python prev_pid=302629 prev_prio=120 prev_state=S ==> next_comm=swapper/11 next_pid=0 next_prio=120
-            event = parts[4][:-1] # strip off ':'
-            if ":" in event:  # tracepoint
-                dso, triggerpid, cpu, time, _, *other = parts
-                tracepoint = True
-            else:  # counter etc
-                dso, triggerpid, time, count, _, *other = parts
-                tracepoint = False
-            triggerpid = int(triggerpid)
-            time = float(time[:-1]) * 1e6
+            dso, triggerpid, cpu, time, count, event, other = tokens
+            tracepoint = count is None
+            if triggerpid not in tgids:
+                tgids[triggerpid] = header_tgid(header)
             if time_first is None:
                 time_first = time
-            def log(*args, time=time/1e6):
-                offset = time - time_first/1e6
-                print(f"{time:13.6f}[+{offset:5.4f}]", *args)
+            if verbose >= 2:
+                def log(*args, time=time/1e6):
+                    offset = time - time_first/1e6
+                    print(f"{time:13.6f}[+{offset:5.4f}]", *args)
             if all_tracepoints and tracepoint:
-                yield header, stacktrace, {'name': event, 'pid': parent_pid.get(pid, pid), 'tid': triggerpid, 'ts': time, 'ph': 'i', 's': 'g'}
+                yield header, stacktrace, {'name': event, 'pid': tgids.get(pid) or parent_pid.get(pid, pid), 'tid': triggerpid, 'ts': time, 'ph': 'i', 's': 'g'}
             first_line = False
             gil_event = None
             if event == "sched:sched_switch":
                 # e.g. python 393320 [040] 3498299.441431:                sched:sched_switch: prev_comm=python prev_pid=393320 prev_prio=120 prev_state=S ==> next_comm=swapper/40 next_pid=0 next_prio=120
-                try:
-                    values = parse_values(parts, prev_pid=int)
-                    pid = values['prev_pid']
-                    prev_state = values['prev_state']
-                except ValueError:
-                    # perf 4
-                    comm, pid = other[0].rsplit(':', 1)
-                    pid = int(pid)
-                    prev_state = other[2]
+                pid, prev_state = parse_sched_switch(other)
                 # we are going to sleep?
                 if prev_state == 'R':
                     # this happens when a process just started, so we just set the start time
@@ -374,23 +686,16 @@ def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tr
                 if verbose >= 2:
                     log(f'{name} will switch to state={prev_state}, ran for {dur}')
                 if store_runing:
-                    event = {"pid": parent_pid.get(pid, pid), "tid": pid, "ts": last_run_time[pid], "dur": dur, "name": 'R', "ph": "X", "cat": "process state"}
+                    event = {"pid": tgids.get(pid) or parent_pid.get(pid, pid), "tid": pid, "ts": last_run_time[pid], "dur": dur, "name": 'R', "ph": "X", "cat": "process state"}
                     yield header, stacktrace, event
 
                 last_sleep_time[pid] = time
-                last_sleep_stacktrace[pid] = stacktrace
+                last_sleep_stacktrace[pid] = stacks.intern(stacktrace) if stacktrace is not None else None
                 del last_run_time[pid]
             elif event == "sched:sched_wakeup":
                 # e.g: swapper     0 [040] 3498299.642199:                sched:sched_waking: comm=python pid=393320 prio=120 target_cpu=040
                 prev_state = None
-                try:
-                    values = parse_values(parts, pid=int)
-                    pid = values['pid']
-                    comm = values['comm']
-                except ValueError:
-                    # perf 4
-                    comm, pid = other[0].rsplit(':', 1)
-                    pid = int(pid)
+                pid = parse_sched_wakeup(other)
 
                 # if comm != "python":
                 #     if verbose >= 2:
@@ -402,13 +707,20 @@ def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tr
                     # q
                     last_run_time[pid] = time
                     continue
-                recover_from_gil = takes_gil(last_sleep_stacktrace[pid]) if last_sleep_stacktrace[pid] else False
+                stack_id = last_sleep_stacktrace.get(pid)
+                sleep_stacktrace = None
+                recover_from_gil = False
+                if stack_id is not None:
+                    sleep_stacktrace = stacks[stack_id]
+                    recover_from_gil = stack_takes_gil.get(stack_id)
+                    if recover_from_gil is None:
+                        recover_from_gil = stack_takes_gil[stack_id] = takes_gil(sleep_stacktrace)
                 duration = time - last_sleep_time[pid]
                 if verbose >= 2:
                     name = pid_names.get(pid, pid)
                     log(f'Waking up {name}', '(recovering from GIL)' if recover_from_gil else '', f', slept for {duration} msec')
-                if verbose >= 3 and last_sleep_stacktrace[pid]:
-                    print("Stack trace when we went to sleep:\n\t", "\t".join(last_sleep_stacktrace[pid]))
+                if verbose >= 3 and sleep_stacktrace:
+                    print("Stack trace when we went to sleep:\n\t", "\t".join(sleep_stacktrace))
                 if store_sleeping:
                     if recover_from_gil:
                         name = 'S(GIL)'
@@ -416,32 +728,33 @@ def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tr
                     else:
                         name = 'S'
                         cname = 'bad'
-                    event = {"pid": parent_pid.get(pid, pid), "tid": pid, "ts": last_sleep_time[pid], "dur": duration, "name": name, "ph": "X", "cat": "process state", 'cname': cname}
+                    event = {"pid": tgids.get(pid) or parent_pid.get(pid, pid), "tid": pid, "ts": last_sleep_time[pid], "dur": duration, "name": name, "ph": "X", "cat": "process state", 'cname': cname}
+                    if quality.last_lost is not None and last_sleep_time[pid] < quality.last_lost:
+                        # we may have missed it waking up (and going to sleep again) in between
+                        quality.anomaly('sleep with lost events', duration)
+                        event['args'] = {'uncertain': 'perf lost events while sleeping'}
                     # A bit ugly, but here we lie about the stacktrace, we actually yield the one that caused us to sleep (for offgil.py)
-                    yield header, last_sleep_stacktrace[pid], event
+                    yield header, sleep_stacktrace, event
                 last_run_time[pid] = time
                 del last_sleep_time[pid]
+            elif event in perf_records:
+                quality.record(perf_records[event], time, cpu, other)
+                if verbose >= 2:
+                    log(f'perf lost events: {other}')
             elif event == "sched:sched_process_exec":
                 if verbose >= 2:
                     name = pid_names.get(triggerpid, triggerpid)
                     log(f'Starting (exec) {name}')
             elif event == "sched:sched_wakeup_new":
                 # e.g: swapper     0 [040] 3498299.642199:                sched:sched_waking: comm=python pid=393320 prio=120 target_cpu=040
-                try:
-                    values = parse_values(parts, pid=int)
-                    pid = values['pid']
-                except ValueError:
-                    # perf 4
-                    comm, pid = other[0].rsplit(':', 1)
-                    pid = int(pid)
+                pid = parse_sched_wakeup(other)
                 if verbose >= 2:
                     name = pid_names.get(pid, pid)
                     log(f'Starting (new) {name}')
                 last_run_time[pid] = time
             elif event == "sched:sched_process_fork":
-                values = parse_values(parts, pid=int, child_pid=int)
                 # set up a child parent relationship for better visualization
-                pid, child_pid = values['pid'], values['child_pid']
+                pid, child_pid = parse_sched_process_fork(other)
                 if verbose >= 2:
                     log(f'Process {pid} forked {child_pid}')
                 parent_pid[child_pid] = pid
@@ -457,6 +770,8 @@ def perf2trace(input, verbose=1, store_runing=False, store_sleeping=True, all_tr
         except:
             print("error on line", repr(header), stacktrace, file=sys.stderr)
             raise
+    if verbose >= 1:
+        quality.print_summary()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,438 @@
+import bisect
+import mmap
+from operator import itemgetter
+import re
+import struct
+
+
+# Reads perf.data files directly, without running perf script.
+# We only decode what per4m needs: samples of tracepoints (e.g. sched:*) and uprobes (python:*gil*,
+# pytrace:*), with their fields decoded using the tracepoint formats stored in the perf.data file,
+# and counter samples. Callchains are not symbolized (perf script does that using the mmap records
+# and debug info), so for sched stacktraces (to detect S(GIL)) we still need perf script.
+# The records that tell us perf lost events (or the kernel throttled them) are yielded as well,
+# named like perf script --show-lost-events does (e.g. PERF_RECORD_LOST).
+
+PERF_MAGIC = b'PERFILE2'
+
+# perf_event_attr.type
+PERF_TYPE_TRACEPOINT = 2
+
+# perf_event_header.type
+PERF_RECORD_LOST = 2
+PERF_RECORD_COMM = 3
+PERF_RECORD_THROTTLE = 5
+PERF_RECORD_UNTHROTTLE = 6
+PERF_RECORD_SAMPLE = 9
+PERF_RECORD_LOST_SAMPLES = 13
+PERF_RECORD_FINISHED_ROUND = 68
+
+# perf_event_attr.sample_type, in the order they appear in a sample record
+PERF_SAMPLE_IP = 1 << 0
+PERF_SAMPLE_TID = 1 << 1
+PERF_SAMPLE_TIME = 1 << 2
+PERF_SAMPLE_ADDR = 1 << 3
+PERF_SAMPLE_READ = 1 << 4
+PERF_SAMPLE_CALLCHAIN = 1 << 5
+PERF_SAMPLE_ID = 1 << 6
+PERF_SAMPLE_CPU = 1 << 7
+PERF_SAMPLE_PERIOD = 1 << 8
+PERF_SAMPLE_STREAM_ID = 1 << 9
+PERF_SAMPLE_RAW = 1 << 10
+PERF_SAMPLE_IDENTIFIER = 1 << 16
+
+# perf_event_attr flags
+ATTR_FLAG_SAMPLE_ID_ALL = 1 << 18
+
+# pseudo attributes for the non-sample records we yield, they have no fields to decode
+_record_attrs = {type: dict(name=f'PERF_RECORD_{name}', format=None, tracepoint=True, record=True)
+                 for type, name in [(PERF_RECORD_LOST, 'LOST'), (PERF_RECORD_LOST_SAMPLES, 'LOST_SAMPLES'),
+                                    (PERF_RECORD_THROTTLE, 'THROTTLE'), (PERF_RECORD_UNTHROTTLE, 'UNTHROTTLE')]}
+
+# feature bits (perf_file_header.adds_features)
+HEADER_TRACING_DATA = 1
+HEADER_EVENT_DESC = 12
+
+
+class PerfDataError(ValueError):
+    pass
+
+
+class Reader:
+    def __init__(self, buffer, offset=0, endian='<'):
+        self.buffer = buffer
+        self.offset = offset
+        self.endian = endian
+
+    def unpack(self, fmt):
+        fmt = self.endian + fmt
+        values = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def u32(self):
+        return self.unpack('I')[0]
+
+    def u64(self):
+        return self.unpack('Q')[0]
+
+    def bytes(self, size):
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return bytes(data)
+
+    def cstring(self):
+        end = self.buffer.find(b'\0', self.offset)
+        value = bytes(self.buffer[self.offset:end]).decode('utf8', 'replace')
+        self.offset = end + 1
+        return value
+
+    def perf_string(self):
+        # u32 length (including padding), followed by a 0-padded string
+        size = self.u32()
+        return self.bytes(size).split(b'\0', 1)[0].decode('utf8', 'replace')
+
+
+class EventFormat:
+    """Field layout of a tracepoint, parsed from its format file, e.g.
+    /sys/kernel/debug/tracing/events/sched/sched_switch/format"""
+    def __init__(self, system, text):
+        self.system = system
+        self.name = None
+        self.id = None
+        self.fields = []  # (name, offset, size, signed, is_data_loc, is_string)
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith('name:'):
+                self.name = line.split(':', 1)[1].strip()
+            elif line.startswith('ID:'):
+                self.id = int(line.split(':', 1)[1])
+            elif line.startswith('field:'):
+                parts = dict(part.strip().split(':', 1) for part in line.split(';') if ':' in part)
+                declaration = parts['field'].strip()
+                name = re.sub(r'\[.*\]', '', declaration.split()[-1])
+                if name.startswith('common_'):
+                    continue
+                is_data_loc = declaration.startswith('__data_loc')
+                is_string = 'char' in declaration and ('[' in declaration or is_data_loc)
+                self.fields.append((name, int(parts['offset']), int(parts['size']), int(parts.get('signed', 0)) == 1, is_data_loc, is_string))
+
+        # unpack all fields in one go
+        fmt = '<'
+        position = 0
+        self.names = []
+        self.strings = []
+        self.data_locs = []
+        for name, offset, size, signed, is_data_loc, is_string in sorted(self.fields, key=itemgetter(1)):
+            if offset < position:
+                continue  # overlapping fields, should not happen
+            if is_data_loc:
+                code = 'I'
+                self.data_locs.append(len(self.names))
+            elif is_string:
+                code = f'{size}s'
+                self.strings.append(len(self.names))
+            elif size in (1, 2, 4, 8):
+                code = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}[size]
+                if not signed:
+                    code = code.upper()
+            else:
+                continue
+            if offset > position:
+                fmt += f'{offset - position}x'
+            fmt += code
+            self.names.append(name)
+            position = offset + size
+        self.struct = struct.Struct(fmt)
+
+    @property
+    def fullname(self):
+        return f'{self.system}:{self.name}'
+
+    def decode(self, raw):
+        values = list(self.struct.unpack_from(raw, 0))
+        for i in self.strings:
+            values[i] = values[i].split(b'\0', 1)[0].decode('utf8', 'replace')
+        for i in self.data_locs:
+            loc = values[i]
+            start, length = loc & 0xffff, loc >> 16
+            values[i] = raw[start:start + length].split(b'\0', 1)[0].decode('utf8', 'replace')
+        return dict(zip(self.names, values))
+
+
+def parse_tracing_data(buffer):
+    """Parses the tracing data feature section, returns a dict mapping tracepoint id -> EventFormat"""
+    reader = Reader(buffer)
+    magic = reader.bytes(10)
+    if magic != b'\x17\x08\x44tracing':
+        raise PerfDataError('Unexpected tracing data magic')
+    version = float(reader.cstring())
+    big_endian, long_size = reader.unpack('BB')
+    reader.endian = '>' if big_endian else '<'
+    reader.u32()  # page size
+    for expected in ['header_page', 'header_event']:
+        name = reader.cstring()
+        if name != expected:
+            raise PerfDataError(f'Expected {expected} in tracing data, got {name}')
+        reader.bytes(reader.u64())
+    for _ in range(reader.u32()):  # ftrace formats
+        reader.bytes(reader.u64())
+    formats = {}
+    for _ in range(reader.u32()):
+        system = reader.cstring()
+        for _ in range(reader.u32()):
+            text = reader.bytes(reader.u64()).decode('utf8', 'replace')
+            format = EventFormat(system, text)
+            if format.id is not None:
+                formats[format.id] = format
+    return formats
+
+
+class PerfData:
+    """Reads samples from a perf.data file (as written by perf record, not in pipe mode).
+
+    tokenized_events() yields (header, stacktrace, tokens) like perfutils.read_tokenized_events
+    does for perf script output, except that the last element of the tokens is a dict with the
+    decoded tracepoint fields, instead of the (unparsed) text that follows the event name.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.comms = {}
+        self._parse_header()
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _parse_header(self):
+        buffer = self.buffer
+        if buffer[:8] != PERF_MAGIC:
+            raise PerfDataError(f'{self.filename} is not a perf.data file (or written in pipe mode)')
+        reader = Reader(buffer, 8)
+        size, attr_size = reader.unpack('QQ')
+        attrs_offset, attrs_size, data_offset, data_size, _, _ = reader.unpack('QQQQQQ')
+        features = reader.unpack('QQQQ')
+        self.data_offset = data_offset
+        self.data_size = data_size
+
+        # attributes, with the ids that samples refer to
+        self.attrs = []
+        self.id_to_attr = {}
+        for offset in range(attrs_offset, attrs_offset + attrs_size, attr_size):
+            reader = Reader(buffer, offset)
+            type, _, config, _, sample_type, read_format, flags = reader.unpack('IIQQQQQ')
+            reader.offset = offset + attr_size - 16
+            ids_offset, ids_size = reader.unpack('QQ')
+            attr = dict(type=type, config=config, sample_type=sample_type, sample_id_all=bool(flags & ATTR_FLAG_SAMPLE_ID_ALL),
+                        name=None, record=False)
+            self.attrs.append(attr)
+            for id, in struct.iter_unpack('<Q', buffer[ids_offset:ids_offset + ids_size]):
+                self.id_to_attr[id] = attr
+        if not self.attrs:
+            raise PerfDataError(f'No events found in {self.filename}')
+        # we parse all records with the same layout, which perf record also uses for all events
+        for key in ('sample_type', 'sample_id_all'):
+            if len({attr[key] for attr in self.attrs}) > 1:
+                raise PerfDataError(f'The events in {self.filename} do not all have the same {key}, which is not supported')
+        self.sample_type = self.attrs[0]['sample_type']
+        self.sample_id_all = self.attrs[0]['sample_id_all']
+        if self.sample_type & PERF_SAMPLE_READ:
+            raise PerfDataError('Samples with PERF_SAMPLE_READ are not supported')
+
+        # feature sections follow the data section, one for each feature bit set
+        sections = {}
+        reader = Reader(buffer, data_offset + data_size)
+        for bit in range(256):
+            if features[bit // 64] & (1 << (bit % 64)):
+                sections[bit] = reader.unpack('QQ')
+
+        formats = {}
+        if HEADER_TRACING_DATA in sections:
+            offset, size = sections[HEADER_TRACING_DATA]
+            formats = parse_tracing_data(buffer[offset:offset + size])
+        if HEADER_EVENT_DESC in sections:
+            offset, size = sections[HEADER_EVENT_DESC]
+            reader = Reader(buffer, offset)
+            count, desc_attr_size = reader.unpack('II')
+            for _ in range(count):
+                reader.offset += desc_attr_size
+                id_count = reader.u32()
+                name = reader.perf_string()
+                for id in reader.unpack('Q' * id_count):
+                    if id in self.id_to_attr:
+                        self.id_to_attr[id]['name'] = name
+        for attr in self.attrs:
+            attr['format'] = None
+            if attr['type'] == PERF_TYPE_TRACEPOINT:
+                attr['format'] = formats.get(attr['config'])
+                if attr['format'] is not None:
+                    attr['name'] = attr['format'].fullname
+            if attr['name'] is None:
+                attr['name'] = f"event-{attr['type']}-{attr['config']}"
+            attr['tracepoint'] = ':' in attr['name']
+
+    def _sample_layout(self):
+        # the fields up to (and including) PERF_SAMPLE_PERIOD have a fixed size, so we unpack them in one go
+        sample_type = self.sample_type
+        fmt = '<'
+        names = []
+        layout = [
+            (PERF_SAMPLE_IDENTIFIER, 'Q', ['id']),
+            (PERF_SAMPLE_IP, '8x', []),
+            (PERF_SAMPLE_TID, 'II', ['pid', 'tid']),
+            (PERF_SAMPLE_TIME, 'Q', ['time']),
+            (PERF_SAMPLE_ADDR, '8x', []),
+            (PERF_SAMPLE_ID, '8x' if sample_type & PERF_SAMPLE_IDENTIFIER else 'Q', [] if sample_type & PERF_SAMPLE_IDENTIFIER else ['id']),
+            (PERF_SAMPLE_STREAM_ID, '8x', []),
+            (PERF_SAMPLE_CPU, 'I4x', ['cpu']),
+            (PERF_SAMPLE_PERIOD, 'Q', ['period']),
+        ]
+        for flag, code, field_names in layout:
+            if sample_type & flag:
+                fmt += code
+                names.extend(field_names)
+        return struct.Struct(fmt), {name: i for i, name in enumerate(names)}
+
+    def _sample_id_layout(self):
+        # with sample_id_all, non-sample records end with these fields (in a different order than samples)
+        sample_type = self.sample_type
+        fmt = '<'
+        names = []
+        layout = [
+            (PERF_SAMPLE_TID, 'ii', ['pid', 'tid']),
+            (PERF_SAMPLE_TIME, 'Q', ['time']),
+            (PERF_SAMPLE_ID, '8x', []),
+            (PERF_SAMPLE_STREAM_ID, '8x', []),
+            (PERF_SAMPLE_CPU, 'I4x', ['cpu']),
+            (PERF_SAMPLE_IDENTIFIER, '8x', []),
+        ]
+        for flag, code, field_names in layout:
+            if sample_type & flag:
+                fmt += code
+                names.extend(field_names)
+        return struct.Struct(fmt), {name: i for i, name in enumerate(names)}
+
+    def records(self):
+        """Yields (type, offset, size) for all records in the data section, in the order they are stored"""
+        buffer = self.buffer
+        offset = self.data_offset
+        end = self.data_offset + self.data_size
+        header = struct.Struct('<IHH')
+        while offset < end:
+            type, misc, size = header.unpack_from(buffer, offset)
+            if size == 0:
+                raise PerfDataError(f'Corrupt record at offset {offset} in {self.filename}')
+            yield type, offset + 8, size - 8
+            offset += size
+
+    def samples(self):
+        """Yields (time, attr, pid, tid, cpu, period, raw) ordered by time, like perf script does.
+
+        The lost and throttle records are included (attr['record'] is True), with the number of lost
+        events (if known) as period.
+
+        Like perf, we use the PERF_RECORD_FINISHED_ROUND records: all samples older than the
+        newest sample of the previous round can be flushed.
+        """
+        buffer = self.buffer
+        sample_type = self.sample_type
+        fixed, index = self._sample_layout()
+        single_attr = self.attrs[0] if len(self.attrs) == 1 else None
+        id_to_attr = self.id_to_attr
+        i_id, i_pid, i_tid, i_time, i_cpu, i_period = [index.get(name) for name in ['id', 'pid', 'tid', 'time', 'cpu', 'period']]
+        sample_id, sample_id_index = self._sample_id_layout()
+        j_pid, j_tid, j_time, j_cpu = [sample_id_index.get(name) for name in ['pid', 'tid', 'time', 'cpu']]
+        has_callchain = sample_type & PERF_SAMPLE_CALLCHAIN
+        has_raw = sample_type & PERF_SAMPLE_RAW
+        u32 = struct.Struct('<I')
+        u64 = struct.Struct('<Q')
+
+        pending = []
+        previous_round_max = None
+        round_max = 0
+        for type, offset, size in self.records():
+            if type == PERF_RECORD_SAMPLE:
+                values = fixed.unpack_from(buffer, offset)
+                attr = single_attr or id_to_attr[values[i_id]]
+                time = values[i_time] if i_time is not None else 0
+                raw = None
+                if has_raw:
+                    position = offset + fixed.size
+                    if has_callchain:
+                        # we cannot symbolize them, so skip them
+                        position += 8 + 8 * u64.unpack_from(buffer, position)[0]
+                    raw_size, = u32.unpack_from(buffer, position)
+                    raw = buffer[position + 4:position + 4 + raw_size]
+                pending.append((time, attr,
+                                values[i_pid] if i_pid is not None else None,
+                                values[i_tid] if i_tid is not None else None,
+                                values[i_cpu] if i_cpu is not None else None,
+                                values[i_period] if i_period is not None else None,
+                                raw))
+                if time > round_max:
+                    round_max = time
+            elif type in _record_attrs:
+                # we pass the number of lost events as period
+                if type == PERF_RECORD_LOST:
+                    count = u64.unpack_from(buffer, offset + 8)[0]  # after the id
+                elif type == PERF_RECORD_LOST_SAMPLES:
+                    count = u64.unpack_from(buffer, offset)[0]
+                else:
+                    count = None  # throttling does not tell how many events we missed
+                pid = tid = -1
+                cpu = None
+                time = round_max  # the best we know without sample_id_all
+                if self.sample_id_all and size >= sample_id.size:
+                    values = sample_id.unpack_from(buffer, offset + size - sample_id.size)
+                    pid = values[j_pid] if j_pid is not None else None
+                    tid = values[j_tid] if j_tid is not None else None
+                    cpu = values[j_cpu] if j_cpu is not None else None
+                    time = values[j_time] if j_time is not None else time
+                pending.append((time, _record_attrs[type], pid, tid, cpu, count, None))
+            elif type == PERF_RECORD_COMM:
+                pid, tid = struct.unpack_from('<II', buffer, offset)
+                self.comms[tid] = buffer[offset + 8:offset + size].split(b'\0', 1)[0].decode('utf8', 'replace')
+            elif type == PERF_RECORD_FINISHED_ROUND:
+                if previous_round_max is not None:
+                    pending.sort(key=itemgetter(0))  # stable, so equal times keep their order
+                    flush = bisect.bisect_right([sample[0] for sample in pending], previous_round_max)
+                    yield from pending[:flush]
+                    del pending[:flush]
+                previous_round_max = round_max
+        pending.sort(key=itemgetter(0))
+        yield from pending
+
+    def tokenized_events(self):
+        """Yields (header, stacktrace, (comm, pid, cpu, time, count, event, fields)), stacktrace is always None"""
+        for time_ns, attr, pid, tid, cpu, period, raw in self.samples():
+            comm = self.comms.get(tid, ':-1')
+            event = attr['name']
+            time = time_ns / 1e3
+            fields = {}
+            if attr['format'] is not None and raw is not None:
+                fields = attr['format'].decode(raw)
+            elif attr['record'] and period is not None:
+                fields = {'lost': period}
+            time_text = f"{time_ns // 10**9}.{time_ns % 10**9:09d}:"
+            # like perf script -F +pid
+            pid_text = f'{pid}/{tid}' if pid is not None else f'{tid}'
+            if attr['record']:
+                cpu_text = f'[{cpu:03d}]' if cpu is not None else '[-1]'
+                header = f"{comm} {pid_text} {cpu_text} {time_text} {event}" + (f" lost {period}" if period is not None else "")
+                yield header, None, (comm, tid, cpu_text, time, None, event, fields)
+            elif attr['tracepoint']:
+                cpu_text = f'[{cpu:03d}]' if cpu is not None else '[-1]'
+                header = f"{comm} {pid_text} {cpu_text} {time_text} {event}:"
+                yield header, None, (comm, tid, cpu_text, time, None, event, fields)
+            else:
+                count = str(period)
+                header = f"{comm} {pid_text} {time_text} {count} {event}:"
+                yield header, None, (comm, tid, None, time, count, event, fields)
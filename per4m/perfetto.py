@@ -0,0 +1,239 @@
+import gzip
+import json
+import struct
+
+from .tracewriter import TraceEventWriter
+
+
+# Writes Perfetto's protobuf trace format (https://perfetto.dev/docs/reference/trace-packet-proto), which
+# ui.perfetto.dev opens much faster than TraceEvent JSON, and is a lot smaller: event names, categories
+# and argument names are interned, and pids/tids are only stored once, in the track descriptors.
+# We encode the few messages we need by hand, so we do not depend on protobuf. The field numbers
+# below are those of the perfetto protos (TracePacket, TrackDescriptor, TrackEvent, ...).
+
+# TracePacket
+PACKET_TIMESTAMP = 8
+PACKET_SEQUENCE_ID = 10
+PACKET_TRACK_EVENT = 11
+PACKET_INTERNED_DATA = 12
+PACKET_SEQUENCE_FLAGS = 13
+PACKET_TRACK_DESCRIPTOR = 60
+SEQ_INCREMENTAL_STATE_CLEARED = 1
+SEQ_NEEDS_INCREMENTAL_STATE = 2
+
+# TrackDescriptor, ProcessDescriptor and ThreadDescriptor
+TRACK_UUID = 1
+TRACK_NAME = 2
+TRACK_PROCESS = 3
+TRACK_THREAD = 4
+TRACK_PARENT_UUID = 5
+TRACK_COUNTER = 8
+PROCESS_PID = 1
+THREAD_PID = 1
+THREAD_TID = 2
+
+# TrackEvent
+EVENT_CATEGORY_IIDS = 3
+EVENT_DEBUG_ANNOTATIONS = 4
+EVENT_TYPE = 9
+EVENT_NAME_IID = 10
+EVENT_TRACK_UUID = 11
+EVENT_DOUBLE_COUNTER_VALUE = 44
+TYPE_SLICE_BEGIN, TYPE_SLICE_END, TYPE_INSTANT, TYPE_COUNTER = 1, 2, 3, 4
+
+# InternedData (each entry is a message with iid = 1 and name = 2)
+INTERNED_CATEGORIES = 1
+INTERNED_EVENT_NAMES = 2
+INTERNED_ANNOTATION_NAMES = 3
+
+# DebugAnnotation
+ANNOTATION_NAME_IID = 1
+ANNOTATION_BOOL = 2
+ANNOTATION_INT = 4
+ANNOTATION_DOUBLE = 5
+ANNOTATION_STRING = 6
+
+_double = struct.Struct('<d')
+
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64  # two's complement, like protobuf does for negative int64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def field_bytes(number, data):
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return varint((number << 3) | 2) + varint(len(data)) + data
+
+
+def field_double(number, value):
+    return varint((number << 3) | 1) + _double.pack(value)
+
+
+def _int(value):
+    # pids and tids are ints, or strings like '1234' or '1234-GIL'
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PerfettoWriter(TraceEventWriter):
+    """Writes the same TraceEvent dicts as TraceEventWriter, but as a Perfetto protobuf trace.
+
+    Each thread gets a track (below a track for its process), and the events with a non-numeric
+    pid (e.g. the '1234-GIL' lanes of gil2trace, or 'counters') get their own tracks, with a track
+    per thread below it. Complete (X) events are written as a begin and end slice, async (b/e)
+    events as slices on a track for each thread below the process, and counters as counter tracks.
+    """
+    sequence_id = 1
+
+    def __init__(self, output, compress=None, max_events=None):
+        super().__init__(output, compress=compress, max_events=max_events)
+        self.tracks = {}  # key -> uuid
+        self.interned = {INTERNED_CATEGORIES: {}, INTERNED_EVENT_NAMES: {}, INTERNED_ANNOTATION_NAMES: {}}  # name -> iid
+        self.first_packet = True
+
+    def open(self):
+        self.file = gzip.open(self.output, 'wb') if self.compress else open(self.output, 'wb')
+        return self
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.ring is not None:
+            for event in self._balanced():
+                self._write(event)
+            self.ring.clear()
+        self.file.close()
+        self.file = None
+
+    def _packet(self, payload, timestamp=None, interned=b''):
+        packet = field_varint(PACKET_SEQUENCE_ID, self.sequence_id)
+        flags = 0
+        if self.first_packet:
+            flags |= SEQ_INCREMENTAL_STATE_CLEARED
+            self.first_packet = False
+        if timestamp is not None:
+            packet += field_varint(PACKET_TIMESTAMP, timestamp)
+            flags |= SEQ_NEEDS_INCREMENTAL_STATE  # for the interned strings
+        if flags:
+            packet += field_varint(PACKET_SEQUENCE_FLAGS, flags)
+        if interned:
+            packet += field_bytes(PACKET_INTERNED_DATA, interned)
+        # the trace is a repeated TracePacket packet = 1, so we can write them one by one
+        self.file.write(field_bytes(1, packet + payload))
+
+    def _intern(self, field, name, new):
+        # returns the iid of name, and adds it to new (the InternedData we send along) if we did not see it before
+        table = self.interned[field]
+        iid = table.get(name)
+        if iid is None:
+            iid = table[name] = len(table) + 1
+            new.append(field_bytes(field, field_varint(1, iid) + field_bytes(2, name)))
+        return iid
+
+    def _track(self, key, descriptor):
+        # returns the uuid of the track, and writes its descriptor the first time
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = len(self.tracks) + 1
+            self._packet(field_bytes(PACKET_TRACK_DESCRIPTOR, field_varint(TRACK_UUID, uuid) + descriptor()))
+        return uuid
+
+    def _process_track(self, pid):
+        number = _int(pid)
+        if number is not None:
+            return self._track(('process', number), lambda: field_bytes(TRACK_PROCESS, field_varint(PROCESS_PID, number)))
+        # e.g. 1234-GIL, which we put below the process
+        owner = _int(str(pid).split('-')[0])
+        parent = self._process_track(owner) if owner is not None else None
+        return self._track(('process', pid), lambda: field_bytes(TRACK_NAME, str(pid)) +
+                           (field_varint(TRACK_PARENT_UUID, parent) if parent else b''))
+
+    def _thread_track(self, pid, tid, lane=None):
+        pid_number, tid_number = _int(pid), _int(tid)
+        parent = self._process_track(pid)
+        if lane is None and pid_number is not None and tid_number is not None:
+            return self._track(('thread', pid_number, tid_number), lambda: field_bytes(TRACK_THREAD, field_varint(THREAD_PID, pid_number) + field_varint(THREAD_TID, tid_number)) +
+                               field_varint(TRACK_PARENT_UUID, parent))
+        name = f'{lane} {tid}' if lane else str(tid)
+        return self._track(('lane', str(pid), str(tid), lane), lambda: field_bytes(TRACK_NAME, name) + field_varint(TRACK_PARENT_UUID, parent))
+
+    def _annotations(self, args, new):
+        annotations = b''
+        for name, value in args.items():
+            annotation = field_varint(ANNOTATION_NAME_IID, self._intern(INTERNED_ANNOTATION_NAMES, name, new))
+            if isinstance(value, bool):
+                annotation += field_varint(ANNOTATION_BOOL, value)
+            elif isinstance(value, int):
+                annotation += field_varint(ANNOTATION_INT, value)
+            elif isinstance(value, float):
+                annotation += field_double(ANNOTATION_DOUBLE, value)
+            else:
+                annotation += field_bytes(ANNOTATION_STRING, value if isinstance(value, str) else json.dumps(value))
+            annotations += field_bytes(EVENT_DEBUG_ANNOTATIONS, annotation)
+        return annotations
+
+    def _event(self, track, type, timestamp, name=None, category=None, args=None, counter=None):
+        new = []
+        payload = field_varint(EVENT_TRACK_UUID, track) + field_varint(EVENT_TYPE, type)
+        if name is not None:
+            payload += field_varint(EVENT_NAME_IID, self._intern(INTERNED_EVENT_NAMES, name, new))
+        if category is not None:
+            payload += field_varint(EVENT_CATEGORY_IIDS, self._intern(INTERNED_CATEGORIES, category, new))
+        if args:
+            payload += self._annotations(args, new)
+        if counter is not None:
+            payload += field_double(EVENT_DOUBLE_COUNTER_VALUE, counter)
+        self._packet(field_bytes(PACKET_TRACK_EVENT, payload), timestamp=timestamp, interned=b''.join(new))
+
+    def _write(self, event):
+        phase = event.get('ph')
+        pid, tid = event.get('pid'), event.get('tid', event.get('pid'))
+        name, category, args = event.get('name'), event.get('cat'), event.get('args')
+        timestamp = int(round(event.get('ts', 0) * 1e3))  # us -> ns
+        if phase in ('X', 'B', 'E', 'i', 'I'):
+            if phase in ('i', 'I') and event.get('s') == 'g':
+                track = self._track('global', lambda: field_bytes(TRACK_NAME, 'global'))
+            elif phase in ('i', 'I') and event.get('s') == 'p':
+                track = self._process_track(pid)
+            else:
+                track = self._thread_track(pid, tid)
+            if phase == 'X':
+                self._event(track, TYPE_SLICE_BEGIN, timestamp, name, category, args)
+                self._event(track, TYPE_SLICE_END, timestamp + int(round(event.get('dur', 0) * 1e3)))
+            elif phase == 'B':
+                self._event(track, TYPE_SLICE_BEGIN, timestamp, name, category, args)
+            elif phase == 'E':
+                self._event(track, TYPE_SLICE_END, timestamp)
+            else:
+                self._event(track, TYPE_INSTANT, timestamp, name, category, args)
+        elif phase in ('b', 'e'):
+            # async events do not need to nest with the thread's slices, so they get their own track
+            track = self._thread_track(pid, tid, lane=category or 'async')
+            if phase == 'b':
+                self._event(track, TYPE_SLICE_BEGIN, timestamp, name, category, args)
+            else:
+                self._event(track, TYPE_SLICE_END, timestamp)
+        elif phase == 'C':
+            parent = self._process_track(pid)
+            for key, value in (args or {}).items():
+                counter_name = name if len(args) == 1 else f'{name} {key}'
+                track = self._track(('counter', str(pid), counter_name), lambda: field_bytes(TRACK_NAME, counter_name) + field_bytes(TRACK_COUNTER, b'') +
+                                    field_varint(TRACK_PARENT_UUID, parent))
+                self._event(track, TYPE_COUNTER, timestamp, counter=float(value))
+        else:
+            return  # e.g. metadata and flow events, which we do not support
+        self.count += 1
@@ -1,3 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+
+
 def read_events(input):
     first_line = True
     stacktrace = []
@@ -21,17 +30,266 @@ def read_events(input):
         yield header, stacktrace
 
 
+def read_tokenized_events(input):
+    """Yields (header, stacktrace, tokens), where tokens is what tokenize_header returns.
+
+    input is either perf script output (an iterable of lines), or a perfdata.PerfData reader. The
+    latter yields the tokens directly, with the tracepoint fields decoded in a dict instead of
+    the unparsed text that follows the event name. The parse_* functions below accept both.
+    """
+    if hasattr(input, 'tokenized_events'):
+        yield from input.tokenized_events()
+    else:
+        for header, stacktrace in read_events(input):
+            yield header, stacktrace, tokenize_header(header)
+
+
+def tokenize_header(header):
+    """Splits a perf script header in a single pass.
+
+    Returns (comm, pid, cpu, time, count, event, rest), where time is in microseconds, and
+    cpu is None for counters, and count is None for tracepoints. The tracepoint/probe specific
+    part (rest) is left unparsed, so only the events we are interested in pay for parsing it,
+    see the parse_* functions below. The pid is the thread id, with perf script -F +pid the
+    header contains the process id as well (pid/tid), see header_tgid.
+    """
+    parts = header.split(None, 5)
+    if len(parts) == 5:
+        parts.append('')
+    a, pid, b, c, event, rest = parts
+    if '/' in pid:
+        pid = pid[pid.index('/') + 1:]
+    if event.startswith('PERF_RECORD_'):  # perf script --show-lost-events, e.g. python 302629 [011] 3485124.180312: PERF_RECORD_LOST lost 12
+        return a, int(pid), b, float(c[:-1]) * 1e6, None, event.rstrip(':'), rest
+    event = event[:-1]  # strip off ':'
+    if ":" in event:  # tracepoint, e.g. python 302629 [011] 3485124.180312: sched:sched_switch: ...
+        return a, int(pid), b, float(c[:-1]) * 1e6, None, event, rest
+    else:  # counter etc, e.g. python 302629 3485124.180312: 100000 cycles: ...
+        return a, int(pid), None, float(b[:-1]) * 1e6, c, event, rest
+
+
+def header_tgid(header):
+    """Returns the process id (tgid) of a perf script header (e.g. python 302629/302631 ...), or None if not present"""
+    parts = header.split(None, 2)
+    if len(parts) > 1 and '/' in parts[1]:
+        return int(parts[1][:parts[1].index('/')])
+    return None
+
+
+_sched_switch = re.compile(r'prev_pid=(-?\d+) prev_prio=\S+ prev_state=(\S+)')
+# perf 4, e.g. python:302629 [120] S ==> swapper/11:0 [120]
+_sched_switch_perf4 = re.compile(r'\S*:(-?\d+) \[\S+\] (\S+)')
+_sched_wakeup = re.compile(r'(?:^|\s)pid=(-?\d+)')
+# perf 4, e.g. python:393320 [120] success=1 CPU:040
+_sched_wakeup_perf4 = re.compile(r'\S*:(-?\d+)')
+_sched_process_fork = re.compile(r'(?:^|\s)pid=(-?\d+).*\schild_pid=(-?\d+)')
+_function_probe = re.compile(r'filename=(\S+) funcname=(\S+) l=(-?\d+) what=(-?\d+)')
+# pytrace:function_entry_id/return_id, the code object id instead of the filename and funcname
+_function_probe_id = re.compile(r'code=(\S+) l=(-?\d+) what=(-?\d+)')
+_key_value = re.compile(r'(\w+)=(\S+)')
+_lost = re.compile(r'lost[:=]?\s*(\d+)')
+# prev_state bits of sched_switch, as perf script shows them
+_task_states = 'SDTtXZPI'
+
+
+def task_state(state):
+    """Converts the prev_state bitmask of sched_switch to what perf script shows (e.g. S, D or R+)"""
+    if state == 0:
+        return 'R'
+    for i, letter in enumerate(_task_states):
+        if state & (1 << i):
+            return letter
+    return 'R+'  # preempted
+
+
+def parse_sched_switch(rest):
+    """Returns (prev_pid, prev_state) of a sched:sched_switch event"""
+    if isinstance(rest, dict):
+        return rest['prev_pid'], task_state(rest['prev_state'])
+    match = _sched_switch.search(rest) or _sched_switch_perf4.match(rest)
+    if match is None:
+        raise ValueError(f'Could not parse sched_switch event: {rest}')
+    pid, prev_state = match.groups()
+    return int(pid), prev_state
+
+
+def parse_sched_wakeup(rest):
+    """Returns the pid of a sched:sched_wakeup(_new) event"""
+    if isinstance(rest, dict):
+        return rest['pid']
+    match = _sched_wakeup.search(rest) or _sched_wakeup_perf4.match(rest)
+    if match is None:
+        raise ValueError(f'Could not parse sched_wakeup event: {rest}')
+    return int(match.group(1))
+
+
+def parse_sched_process_fork(rest):
+    """Returns (pid, child_pid) of a sched:sched_process_fork event"""
+    if isinstance(rest, dict):
+        return rest['parent_pid'], rest['child_pid']
+    match = _sched_process_fork.search(rest)
+    if match is None:
+        raise ValueError(f'Could not parse sched_process_fork event: {rest}')
+    pid, child_pid = match.groups()
+    return int(pid), int(child_pid)
+
+
+def parse_lost(rest):
+    """Returns the number of events lost by a PERF_RECORD_LOST(_SAMPLES) record, or None if perf did not tell us"""
+    if isinstance(rest, dict):
+        return rest.get('lost')
+    match = _lost.search(rest)
+    return int(match.group(1)) if match else None
+
+
+def parse_function_probe(rest, symbols=None):
+    """Returns (filename, funcname, lineno, what) of a pytrace:function_entry/return(_id) event
+
+    For the _id probes the code object id is resolved using symbols (see read_symbols).
+    """
+    if isinstance(rest, dict):
+        if 'code' in rest:
+            return resolve_code(rest['code'], symbols) + (rest['l'], rest['what'])
+        # perf script shows strings quoted
+        return f'"{rest["filename"]}"', f'"{rest["funcname"]}"', rest['l'], rest['what']
+    match = _function_probe.search(rest)
+    if match is None:
+        match = _function_probe_id.search(rest)
+        if match is not None:
+            code, lineno, what = match.groups()
+            return resolve_code(int(code, 0), symbols) + (int(lineno), int(what))
+        # the probe arguments may have been defined in a different order
+        values = dict(_key_value.findall(rest))
+        try:
+            return values['filename'], values['funcname'], int(values['l']), int(values['what'])
+        except KeyError as e:
+            raise ValueError(f'Expected to find key {e} in {rest}')
+    filename, funcname, lineno, what = match.groups()
+    return filename, funcname, int(lineno), int(what)
+
+
+def resolve_code(code, symbols):
+    """Returns the (quoted, as perf script shows them) filename and funcname of a pytrace code object id"""
+    if symbols and code in symbols:
+        filename, funcname = symbols[code]
+        return f'"{filename}"', f'"{funcname}"'
+    return '"<unknown>"', f'"{code:#x}"'
+
+
+def write_symbols(filename, symbols=None):
+    """Writes the code object id -> (filename, funcname) table of pytrace (pytrace.symbols() by default) as JSON
+
+    Call this after pytrace.stop(), when tracing with pytrace.start(True).
+    """
+    if symbols is None:
+        from . import pytrace
+        symbols = pytrace.symbols()
+    with open(filename, 'w') as f:
+        json.dump({str(code): list(names) for code, names in symbols.items()}, f)
+
+
+def read_symbols(filename):
+    with open(filename) as f:
+        return {int(code): tuple(names) for code, names in json.load(f).items()}
+
+
 def parse_header(header):
-    parts = header.split()
-    event = parts[4][:-1] # strip off ':'
-    if ":" in event:  # tracepoint
-        dso, triggerpid, cpu, time, _, *other = parts
-        time = float(time[:-1]) * 1e6
-        values = dict(dso=dso, triggerpid=int(triggerpid), cpu=cpu, time=time)
+    dso, triggerpid, cpu, time, count, event, rest = tokenize_header(header)
+    other = rest.split()
+    if count is None:
+        values = dict(dso=dso, triggerpid=triggerpid, cpu=cpu, time=time)
         tracepoint = True
-    else:  # counter etc
-        dso, triggerpid, time, count, _, *other = parts
-        time = float(time[:-1]) * 1e6
-        values = dict(dso=dso, triggerpid=int(triggerpid), count=count, time=time)
+    else:
+        values = dict(dso=dso, triggerpid=triggerpid, count=count, time=time)
         tracepoint = False
     return values, other, tracepoint
+
+
+def perf_version():
+    """Returns the (major, minor) version of perf, or None if we cannot tell"""
+    try:
+        result = subprocess.run(['perf', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    match = re.search(r'(\d+)\.(\d+)', result.stdout)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def perf_time_range(filename):
+    """Returns the (first, last) sample time in ns of a perf.data file, or None if perf does not tell us"""
+    cmd = f"perf report --header-only -i {filename}"
+    result = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    times = {}
+    for line in result.stdout.splitlines():
+        # e.g. # time of first sample : 3485124.180312
+        match = re.match(r'# time of (first|last) sample : (\d+)\.(\d+)', line)
+        if match:
+            which, sec, frac = match.groups()
+            times[which] = int(sec) * 10**9 + int(frac.ljust(9, '0')[:9])
+    if 'first' not in times or 'last' not in times:
+        return None
+    return times['first'], times['last']
+
+
+def _format_ns(ns):
+    return f"{ns // 10**9}.{ns % 10**9:09d}"
+
+
+def time_windows(first, last, count):
+    """Splits [first, last] (in ns) in count non-overlapping windows, usable as perf script --time argument
+
+    The first and last window are open ended, so we never miss an event due to rounding.
+    """
+    step = max(1, (last - first + 1) // count)
+    starts = [first + i * step for i in range(count)]
+    starts = sorted(set(k for k in starts if k <= last))
+    windows = []
+    for i, start in enumerate(starts):
+        begin = '' if i == 0 else _format_ns(start)
+        end = '' if i == len(starts) - 1 else _format_ns(starts[i + 1] - 1)
+        windows.append(f'{begin},{end}')
+    return windows
+
+
+def perf_script(filename, args="--no-inline --ns -F +pid --show-lost-events", jobs=1, verbose=1):
+    """Yields the lines of perf script output for filename.
+
+    With jobs > 1 we split the recording in time windows (perf script --time) and run perf script
+    on them in parallel. The lines are yielded in the same order as a single perf script would,
+    so any converter consuming them carries its state across the window boundaries, and gives
+    identical output.
+    """
+    windows = None
+    if jobs > 1:
+        time_range = perf_time_range(filename)
+        if time_range is None:
+            if verbose >= 1:
+                print(f'Could not find the time range of {filename}, running perf script serially', file=sys.stderr)
+        else:
+            windows = time_windows(*time_range, jobs)
+    if not windows:
+        cmd = f"perf script -i {filename} {args}"
+        if verbose >= 2:
+            print(f"Running: {cmd}", file=sys.stderr)
+        perf = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, text=True)
+        yield from perf.stdout
+        if perf.wait() != 0:
+            raise OSError(f'Failed to run perf script, command:\n$ {cmd}')
+        return
+
+    def run(window):
+        cmd = f"perf script -i {filename} {args} --time {window}"
+        if verbose >= 2:
+            print(f"Running: {cmd}", file=sys.stderr)
+        output = tempfile.TemporaryFile('w+')
+        if subprocess.run(shlex.split(cmd), stdout=output).returncode != 0:
+            output.close()
+            raise OSError(f'Failed to run perf script, command:\n$ {cmd}')
+        output.seek(0)
+        return output
+
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(run, window) for window in windows]
+        for future in futures:
+            with future.result() as output:
+                yield from output
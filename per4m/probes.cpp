@@ -6,4 +6,13 @@ extern "C" void pytrace_function_entry(const char *filename, const char *funcnam
 
 extern "C" void pytrace_function_return(const char *filename, const char *funcname, int lineno, int what) {
     // do nothing
-}
\ No newline at end of file
+}
+
+// code_id is a PyCodeObject pointer, which pytrace keeps alive, so it is a stable id while tracing
+extern "C" void pytrace_function_entry_id(unsigned long long code_id, int lineno, int what) {
+    // do nothing, so we can attach a probe here
+}
+
+extern "C" void pytrace_function_return_id(unsigned long long code_id, int lineno, int what) {
+    // do nothing
+}
@@ -1,5 +1,15 @@
 #include <Python.h>
 #include <frameobject.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/syscall.h>
+#include <time.h>
+#include <unistd.h>
+#include <atomic>
+#include <string>
+#include <unordered_set>
+#include <vector>
 
 extern "C" void pytrace_function_entry(const char *filename,
                                        const char *funcname, int lineno,
@@ -7,6 +17,233 @@ extern "C" void pytrace_function_entry(const char *filename,
 extern "C" void pytrace_function_return(const char *filename,
                                         const char *funcname, int lineno,
                                         int what);
+extern "C" void pytrace_function_entry_id(unsigned long long code_id,
+                                          int lineno, int what);
+extern "C" void pytrace_function_return_id(unsigned long long code_id,
+                                           int lineno, int what);
+
+// all code objects we passed to the probes (by id), we keep a reference so
+// the id (the pointer) cannot be reused by another code object
+static std::unordered_set<PyCodeObject *> seen_codes;
+
+int pytrace_trace_id(PyObject *obj, PyFrameObject *frame, int what,
+                     PyObject *arg) {
+  // same as pytrace_trace, but without converting the filename and function
+  // name to strings, see symbols()
+  if ((what == PyTrace_CALL) || (what == PyTrace_C_CALL) ||
+      (what == PyTrace_RETURN) || (what == PyTrace_C_RETURN)) {
+    PyCodeObject *code = frame->f_code;
+    if (seen_codes.insert(code).second) {
+      Py_INCREF(code);
+    }
+    int lineno = PyCode_Addr2Line(code, frame->f_lasti);
+    unsigned long long code_id = (unsigned long long)(uintptr_t)code;
+    if ((what == PyTrace_CALL) || (what == PyTrace_C_CALL)) {
+      pytrace_function_entry_id(code_id, lineno, what);
+    } else {
+      pytrace_function_return_id(code_id, lineno, what);
+    }
+  }
+  return 0;
+}
+
+// In-process tracing, instead of passing the events to probes, we store them
+// in a preallocated ring buffer per thread, see dump() for the file format.
+// All writes happen from the profile function, so with the GIL held.
+// Each buffer costs ring * sizeof(Record) (24) bytes, we keep the buffers of
+// the last MAX_FINISHED_RINGS threads that finished (so dump() still has their
+// events), and reuse older ones for new threads.
+enum RecordKind { RECORD_ENTRY, RECORD_RETURN, RECORD_TAKE, RECORD_DROP };
+
+struct Record {
+  uint64_t time;  // ns, CLOCK_MONOTONIC (same as perf record -k CLOCK_MONOTONIC)
+  uint64_t code_id;
+  int32_t lineno;
+  int16_t kind;
+  int16_t what;
+};
+
+struct RingBuffer {
+  int64_t tid;
+  uint64_t written;  // total number of records written, older ones are overwritten
+  uint64_t last_time;
+  std::atomic<bool> finished;  // set when the thread exits, possibly without the GIL
+  std::vector<Record> records;
+
+  RingBuffer(int64_t tid, size_t capacity)
+      : tid(tid), written(0), last_time(0), finished(false), records(capacity) {}
+
+  void reset(int64_t new_tid) {
+    tid = new_tid;
+    written = 0;
+    last_time = 0;
+    finished = false;
+  }
+
+  void write(uint64_t time, uint64_t code_id, int32_t lineno, int16_t kind,
+             int16_t what) {
+    Record &record = records[written % records.size()];
+    record.time = time;
+    record.code_id = code_id;
+    record.lineno = lineno;
+    record.kind = kind;
+    record.what = what;
+    written++;
+    last_time = time;
+  }
+};
+
+static const size_t MAX_FINISHED_RINGS = 16;
+static size_t ring_capacity = 0;
+static std::vector<RingBuffer *> ring_buffers;  // of all threads, also (some of) the ones that finished
+static RingBuffer *ring_owner = NULL;  // the thread that ran the last profile event
+
+// marks the buffer of a thread as finished when the thread exits
+struct RingBufferHandle {
+  RingBuffer *ring = NULL;
+  ~RingBufferHandle() {
+    if (ring) {
+      ring->finished = true;
+    }
+  }
+};
+static thread_local RingBufferHandle ring_buffer;
+
+static RingBuffer *new_ring_buffer(int64_t tid) {
+  // reuse the buffer of the thread that finished first, if we keep too many
+  RingBuffer *oldest = NULL;
+  size_t finished = 0;
+  for (RingBuffer *ring : ring_buffers) {
+    if (ring->finished) {
+      finished++;
+      if (!oldest || ring->last_time < oldest->last_time) {
+        oldest = ring;
+      }
+    }
+  }
+  if (finished >= MAX_FINISHED_RINGS) {
+    if (ring_owner == oldest) {
+      ring_owner = NULL;
+    }
+    oldest->reset(tid);
+    return oldest;
+  }
+  RingBuffer *ring = new RingBuffer(tid, ring_capacity);
+  ring_buffers.push_back(ring);
+  return ring;
+}
+
+static inline uint64_t monotonic_ns() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec * 1000000000ull + ts.tv_nsec;
+}
+
+int pytrace_trace_ring(PyObject *obj, PyFrameObject *frame, int what,
+                       PyObject *arg) {
+  int16_t kind;
+  if ((what == PyTrace_CALL) || (what == PyTrace_C_CALL)) {
+    kind = RECORD_ENTRY;
+  } else if ((what == PyTrace_RETURN) || (what == PyTrace_C_RETURN)) {
+    kind = RECORD_RETURN;
+  } else {
+    return 0;
+  }
+  uint64_t time = monotonic_ns();
+  RingBuffer *ring = ring_buffer.ring;
+  if (!ring) {
+    ring = ring_buffer.ring = new_ring_buffer(syscall(SYS_gettid));
+  }
+  if (ring != ring_owner) {
+    // CPython does not tell us when the GIL changes hands, but the profile
+    // function only runs with the GIL held, so when the thread differs from
+    // the previous event, the GIL went from that thread to us in between
+    if (ring_owner) {
+      ring_owner->write(ring_owner->last_time, 0, 0, RECORD_DROP, 0);
+    }
+    ring->write(time, 0, 0, RECORD_TAKE, 0);
+    ring_owner = ring;
+  }
+  PyCodeObject *code = frame->f_code;
+  if (seen_codes.insert(code).second) {
+    Py_INCREF(code);
+  }
+  ring->write(time, (uint64_t)(uintptr_t)code,
+              PyCode_Addr2Line(code, frame->f_lasti), kind, what);
+  return 0;
+}
+
+static int write_string(FILE *f, PyObject *unicode) {
+  Py_ssize_t size;
+  const char *text = PyUnicode_AsUTF8AndSize(unicode, &size);
+  if (!text) {
+    return -1;
+  }
+  uint32_t length = (uint32_t)size;
+  fwrite(&length, sizeof(length), 1, f);
+  fwrite(text, 1, length, f);
+  return 0;
+}
+
+static PyObject *pytrace_dump(PyObject *obj, PyObject *args) {
+  // File format (native endianness):
+  //   "PER4MRB1", uint32 version (1), uint32 number of threads, int64 pid
+  //   per thread: int64 tid, uint64 written, uint64 capacity, followed by
+  //     min(written, capacity) records (oldest first) of 24 bytes each:
+  //     uint64 time (ns), uint64 code id, int32 lineno, int16 kind, int16 what
+  //   uint64 number of symbols, per symbol: uint64 code id,
+  //     uint32 length + utf8 filename, uint32 length + utf8 funcname
+  const char *filename;
+  if (!PyArg_ParseTuple(args, "s", &filename)) {
+    return NULL;
+  }
+  FILE *f = fopen(filename, "wb");
+  if (!f) {
+    return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+  }
+  fwrite("PER4MRB1", 1, 8, f);
+  uint32_t header[2] = {1, (uint32_t)ring_buffers.size()};
+  fwrite(header, sizeof(header), 1, f);
+  int64_t pid = getpid();
+  fwrite(&pid, sizeof(pid), 1, f);
+  for (RingBuffer *ring : ring_buffers) {
+    uint64_t capacity = ring->records.size();
+    fwrite(&ring->tid, sizeof(ring->tid), 1, f);
+    fwrite(&ring->written, sizeof(ring->written), 1, f);
+    fwrite(&capacity, sizeof(capacity), 1, f);
+    if (ring->written <= capacity) {
+      fwrite(ring->records.data(), sizeof(Record), ring->written, f);
+    } else {
+      size_t start = ring->written % capacity;
+      fwrite(ring->records.data() + start, sizeof(Record), capacity - start, f);
+      fwrite(ring->records.data(), sizeof(Record), start, f);
+    }
+  }
+  uint64_t count = seen_codes.size();
+  fwrite(&count, sizeof(count), 1, f);
+  for (PyCodeObject *code : seen_codes) {
+    uint64_t code_id = (uint64_t)(uintptr_t)code;
+    fwrite(&code_id, sizeof(code_id), 1, f);
+    if (write_string(f, code->co_filename) || write_string(f, code->co_name)) {
+      fclose(f);
+      return NULL;
+    }
+  }
+  if (fclose(f) != 0) {
+    return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+  }
+  Py_RETURN_NONE;
+}
+
+static void clear_ring_buffers() {
+  // only call this when not tracing, other threads keep their (thread_local)
+  // pointer, so we reset the records, but keep the buffers
+  for (RingBuffer *ring : ring_buffers) {
+    ring->written = 0;
+    ring->last_time = 0;
+  }
+  ring_owner = NULL;
+}
 
 int pytrace_trace(PyObject *obj, PyFrameObject *frame, int what,
                   PyObject *arg) {
@@ -39,27 +276,388 @@ int pytrace_trace(PyObject *obj, PyFrameObject *frame, int what,
   return 0;
 }
 
-static PyObject *pytrace_start(PyObject *obj, PyObject *args) {
-  PyEval_SetProfile(pytrace_trace, NULL);
-  // PyObject *threading_module = PyImport_ImportModule("threading");
-  // PyObject *threading_setprofile =
-  //     PyObject_GetAttrString(threading_module, "setprofile");
-  // Py_INCREF(Py_None);
-  // PyObject *pytrace_cfunction = PyCFunction_New(pytrace_trace, Py_None);
-  // PyObject *args = Py_BuildValue("(N)", pytrace_cfunction);
-  // PyObject_CallObject(setprofile, args);
-  // Py_DECREF(args);
+// Sampling and filtering, applied before any of the above profile functions
+// (and thus the probes) get called. We keep track of which calls we passed on
+// (per thread) so we always pass on the matching return as well.
+struct Filter {
+  uint64_t generation;  // incremented on each start, to reset thread state
+  Py_tracefunc trace;  // the profile function we pass the events on to
+  uint64_t sample_every;  // 0 or 1 means every call
+  uint64_t sample_interval;  // ns, 0 means no time based sampling
+  Py_ssize_t min_depth;
+  Py_ssize_t max_depth;  // -1 means no maximum
+  std::vector<std::string> modules;  // substrings of the filename, empty means all
+};
+
+struct ThreadFilterState {
+  uint64_t generation = 0;
+  uint64_t calls = 0;
+  uint64_t last_sample = 0;
+  std::vector<char> passed;  // for each frame on the stack, if we passed on the call
+};
+
+static Filter filter = {0, NULL, 0, 0, 0, -1, {}};
+static thread_local ThreadFilterState filter_state;
+// we cache if a code object passes the module filter in its co_extra
+static Py_ssize_t code_extra_index = -1;
+
+static bool module_passes(PyCodeObject *code) {
+  if (filter.modules.empty()) {
+    return true;
+  }
+  void *extra = NULL;
+  if (_PyCode_GetExtra((PyObject *)code, code_extra_index, &extra) == 0 &&
+      extra && ((uintptr_t)extra >> 1) == filter.generation) {
+    return (uintptr_t)extra & 1;
+  }
+  const char *filename = PyUnicode_AsUTF8(code->co_filename);
+  bool passes = false;
+  if (filename) {
+    for (const std::string &module : filter.modules) {
+      if (strstr(filename, module.c_str())) {
+        passes = true;
+        break;
+      }
+    }
+  } else {
+    PyErr_Clear();
+  }
+  _PyCode_SetExtra((PyObject *)code, code_extra_index,
+                   (void *)(uintptr_t)((filter.generation << 1) | passes));
+  return passes;
+}
+
+int pytrace_trace_filtered(PyObject *obj, PyFrameObject *frame, int what,
+                           PyObject *arg) {
+  ThreadFilterState &state = filter_state;
+  if (state.generation != filter.generation) {
+    state.generation = filter.generation;
+    state.calls = 0;
+    state.last_sample = 0;
+    state.passed.clear();
+  }
+  if ((what == PyTrace_CALL) || (what == PyTrace_C_CALL)) {
+    Py_ssize_t depth = state.passed.size();
+    bool passes = depth >= filter.min_depth &&
+                  (filter.max_depth < 0 || depth <= filter.max_depth);
+    if (passes && filter.sample_every > 1) {
+      passes = (state.calls++ % filter.sample_every) == 0;
+    }
+    if (passes && filter.sample_interval) {
+      uint64_t now = monotonic_ns();
+      passes = now - state.last_sample >= filter.sample_interval;
+      if (passes) {
+        state.last_sample = now;
+      }
+    }
+    passes = passes && module_passes(frame->f_code);
+    state.passed.push_back(passes);
+    if (passes) {
+      return filter.trace(obj, frame, what, arg);
+    }
+  } else if ((what == PyTrace_RETURN) || (what == PyTrace_C_RETURN) ||
+             (what == PyTrace_C_EXCEPTION)) {
+    // a C function that raises gives C_EXCEPTION instead of C_RETURN
+    if (state.passed.empty()) {
+      return 0;  // a call from before we started
+    }
+    bool passed = state.passed.back();
+    state.passed.pop_back();
+    if (passed) {
+      return filter.trace(obj, frame, what == PyTrace_C_EXCEPTION ? PyTrace_C_RETURN : what, arg);
+    }
+  }
+  return 0;
+}
+
+// the profile function pytrace installs (in all threads)
+static Py_tracefunc current_trace = NULL;
+// the threading.setprofile hook we installed, and the one it replaced (e.g.
+// VizTracer's), which we put back on stop
+static PyObject *installed_hook = NULL;
+static PyObject *previous_hook = NULL;
+
+static bool is_pytrace(Py_tracefunc func) {
+  return func == pytrace_trace || func == pytrace_trace_id ||
+         func == pytrace_trace_ring || func == pytrace_trace_filtered;
+}
+
+static void set_profile(PyThreadState *tstate, Py_tracefunc func) {
+#if PY_VERSION_HEX >= 0x03090000
+  _PyEval_SetProfile(tstate, func, NULL);
+#else
+  // what PyEval_SetProfile does, but for any thread
+  PyObject *previous = tstate->c_profileobj;
+  tstate->c_profilefunc = NULL;
+  tstate->c_profileobj = NULL;
+  tstate->use_tracing = tstate->c_tracefunc != NULL;
+  Py_XDECREF(previous);
+  tstate->c_profilefunc = func;
+  tstate->use_tracing = (func != NULL) || (tstate->c_tracefunc != NULL);
+#endif
+}
+
+static void set_profile_all_threads(Py_tracefunc func) {
+  // we hold the GIL, so no thread can be running Python code
+  PyThreadState *tstate = PyInterpreterState_ThreadHead(PyThreadState_Get()->interp);
+  for (; tstate; tstate = PyThreadState_Next(tstate)) {
+    set_profile(tstate, func);
+  }
+}
+
+static void clear_profile_all_threads() {
+  // only where pytrace is still the profile function, so we do not remove
+  // the profile function of someone else (e.g. VizTracer) that replaced us
+  PyThreadState *tstate = PyInterpreterState_ThreadHead(PyThreadState_Get()->interp);
+  for (; tstate; tstate = PyThreadState_Next(tstate)) {
+    if (is_pytrace(tstate->c_profilefunc)) {
+      set_profile(tstate, NULL);
+    }
+  }
+}
+
+static PyObject *pytrace_thread_hook(PyObject *obj, PyObject *args) {
+  // threading.setprofile makes new threads call sys.setprofile(hook) before
+  // they run, so this gets called once per thread (on the first event). We
+  // replace ourselves with the C profile function and pass on the event, so
+  // only the first event of a thread goes through Python
+  PyObject *frame, *arg;
+  const char *event;
+  if (!PyArg_ParseTuple(args, "OsO", &frame, &event, &arg)) {
+    return NULL;
+  }
+  PyEval_SetProfile(current_trace, NULL);
+  if (current_trace && PyFrame_Check(frame)) {
+    int what = -1;
+    if (strcmp(event, "call") == 0) {
+      what = PyTrace_CALL;
+    } else if (strcmp(event, "return") == 0) {
+      what = PyTrace_RETURN;
+    } else if (strcmp(event, "c_call") == 0) {
+      what = PyTrace_C_CALL;
+    } else if (strcmp(event, "c_return") == 0) {
+      what = PyTrace_C_RETURN;
+    }
+    if (what != -1) {
+      current_trace(NULL, (PyFrameObject *)frame, what, arg);
+    }
+  }
+  Py_RETURN_NONE;
+}
+
+static PyMethodDef pytrace_thread_hook_def = {
+    "_thread_hook", (PyCFunction)pytrace_thread_hook, METH_VARARGS,
+    "installs pytrace in a new thread"};
+
+static int threading_setprofile(PyObject *hook) {
+  PyObject *threading = PyImport_ImportModule("threading");
+  if (!threading) {
+    return -1;
+  }
+  PyObject *result = PyObject_CallMethod(threading, "setprofile", "(O)", hook);
+  Py_DECREF(threading);
+  if (!result) {
+    return -1;
+  }
+  Py_DECREF(result);
+  return 0;
+}
+
+static PyObject *threading_getprofile() {
+  // threading.getprofile() only exists since Python 3.10, so we read what it returns
+  PyObject *threading = PyImport_ImportModule("threading");
+  if (!threading) {
+    return NULL;
+  }
+  PyObject *hook = PyObject_GetAttrString(threading, "_profile_hook");
+  Py_DECREF(threading);
+  return hook;
+}
+
+static int install_thread_hook() {
+  if (installed_hook) {
+    return 0;  // started again without stopping
+  }
+  PyObject *previous = threading_getprofile();
+  if (!previous) {
+    return -1;
+  }
+  PyObject *hook = PyCFunction_New(&pytrace_thread_hook_def, NULL);
+  if (!hook) {
+    Py_DECREF(previous);
+    return -1;
+  }
+  if (threading_setprofile(hook)) {
+    Py_DECREF(previous);
+    Py_DECREF(hook);
+    return -1;
+  }
+  previous_hook = previous;
+  installed_hook = hook;
+  return 0;
+}
+
+static int remove_thread_hook() {
+  if (!installed_hook) {
+    return 0;
+  }
+  PyObject *hook = threading_getprofile();
+  if (!hook) {
+    return -1;
+  }
+  // if someone replaced our hook after we started, we leave theirs alone
+  int failed = hook == installed_hook ? threading_setprofile(previous_hook) : 0;
+  Py_DECREF(hook);
+  if (failed) {
+    return -1;
+  }
+  Py_CLEAR(installed_hook);
+  Py_CLEAR(previous_hook);
+  return 0;
+}
+
+static PyObject *pytrace_start(PyObject *obj, PyObject *args, PyObject *kwargs) {
+  int ids = 0;
+  int threads = 1;
+  Py_ssize_t ring = 0;
+  Py_ssize_t sample_every = 0;
+  double sample_interval = 0;
+  Py_ssize_t min_depth = 0;
+  Py_ssize_t max_depth = -1;
+  PyObject *modules = Py_None;
+  static const char *kwlist[] = {"ids",          "threads",         "ring",
+                                 "sample_every", "sample_interval", "min_depth",
+                                 "max_depth",    "modules",         NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|ppnndnnO", (char **)kwlist,
+                                   &ids, &threads, &ring, &sample_every,
+                                   &sample_interval, &min_depth, &max_depth,
+                                   &modules)) {
+    return NULL;
+  }
+  if (ring < 0 || sample_every < 0 || sample_interval < 0 || min_depth < 0) {
+    PyErr_SetString(PyExc_ValueError,
+                    "ring, sample_every, sample_interval and min_depth should "
+                    "be >= 0");
+    return NULL;
+  }
+  std::vector<std::string> module_list;
+  if (modules != Py_None) {
+    PyObject *sequence = PySequence_Fast(modules, "modules should be a sequence of strings");
+    if (!sequence) {
+      return NULL;
+    }
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++) {
+      const char *module = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(sequence, i));
+      if (!module) {
+        Py_DECREF(sequence);
+        return NULL;
+      }
+      module_list.push_back(module);
+    }
+    Py_DECREF(sequence);
+  }
+  if (!module_list.empty() && code_extra_index < 0) {
+    code_extra_index = _PyEval_RequestCodeExtraIndex(NULL);
+    if (code_extra_index < 0) {
+      PyErr_SetString(PyExc_RuntimeError, "could not get a code extra index");
+      return NULL;
+    }
+  }
+  if (ring) {
+    if (ring_capacity && (size_t)ring != ring_capacity) {
+      // threads that already have a buffer keep using it
+      PyErr_SetString(PyExc_ValueError,
+                      "ring buffer size cannot be changed once set");
+      return NULL;
+    }
+    ring_capacity = ring;
+    current_trace = pytrace_trace_ring;
+  } else {
+    current_trace = ids ? pytrace_trace_id : pytrace_trace;
+  }
+  if (sample_every > 1 || sample_interval > 0 || min_depth > 0 ||
+      max_depth >= 0 || !module_list.empty()) {
+    filter.generation++;
+    filter.trace = current_trace;
+    filter.sample_every = sample_every;
+    filter.sample_interval = (uint64_t)(sample_interval * 1e9);
+    filter.min_depth = min_depth;
+    filter.max_depth = max_depth;
+    filter.modules = module_list;
+    current_trace = pytrace_trace_filtered;
+  }
+  if (threads) {
+    if (install_thread_hook()) {
+      return NULL;
+    }
+    set_profile_all_threads(current_trace);
+  } else {
+    PyEval_SetProfile(current_trace, NULL);
+  }
   Py_RETURN_NONE;
 }
 
 static PyObject *pytrace_stop(PyObject *obj, PyObject *args) {
-  PyEval_SetProfile(NULL, NULL);
+  current_trace = NULL;
+  if (remove_thread_hook()) {
+    return NULL;
+  }
+  clear_profile_all_threads();
+  Py_RETURN_NONE;
+}
+
+static PyObject *pytrace_symbols(PyObject *obj, PyObject *args) {
+  PyObject *symbols = PyDict_New();
+  if (!symbols) {
+    return NULL;
+  }
+  for (PyCodeObject *code : seen_codes) {
+    PyObject *key = PyLong_FromUnsignedLongLong(
+        (unsigned long long)(uintptr_t)code);
+    PyObject *value = Py_BuildValue("(OO)", code->co_filename, code->co_name);
+    if (!key || !value || PyDict_SetItem(symbols, key, value) < 0) {
+      Py_XDECREF(key);
+      Py_XDECREF(value);
+      Py_DECREF(symbols);
+      return NULL;
+    }
+    Py_DECREF(key);
+    Py_DECREF(value);
+  }
+  return symbols;
+}
+
+static PyObject *pytrace_clear_symbols(PyObject *obj, PyObject *args) {
+  for (PyCodeObject *code : seen_codes) {
+    Py_DECREF(code);
+  }
+  seen_codes.clear();
+  clear_ring_buffers();
   Py_RETURN_NONE;
 }
 
 static PyMethodDef pytrace_methods[] = {
-    {"start", (PyCFunction)pytrace_start, METH_VARARGS, "start tracing"},
+    {"start", (PyCFunction)(void (*)(void))pytrace_start,
+     METH_VARARGS | METH_KEYWORDS,
+     "start(ids=False, threads=True, ring=0) start tracing, with ids=True code "
+     "object ids are passed to the probes instead of strings, with "
+     "threads=True all existing and new threads are traced, with ring=N the "
+     "last N events of each thread are kept in memory instead (see dump), "
+     "costing N * 24 bytes per thread (of the last 16 finished threads too). "
+     "To limit the overhead, sample_every=N only traces every Nth call, "
+     "sample_interval=seconds at most one call per interval per thread, "
+     "min_depth/max_depth only calls at that callstack depth (counted from "
+     "where tracing started), and modules=['mypackage/'] only calls from code "
+     "with one of these strings in the filename"},
     {"stop", (PyCFunction)pytrace_stop, METH_VARARGS, "stop tracing"},
+    {"symbols", (PyCFunction)pytrace_symbols, METH_NOARGS,
+     "dict mapping code object id -> (filename, funcname), for all ids passed "
+     "to the probes"},
+    {"clear_symbols", (PyCFunction)pytrace_clear_symbols, METH_NOARGS,
+     "forget the code objects and ring buffer events seen so far"},
+    {"dump", (PyCFunction)pytrace_dump, METH_VARARGS,
+     "dump(filename) writes the ring buffers and symbols to a file, read it "
+     "with per4m.ringbuffer"},
     {NULL, NULL, 0, NULL}};
 
 static struct PyModuleDef pytrace_module = {
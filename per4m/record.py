@@ -1,18 +1,29 @@
 import argparse
+from collections import deque
 import contextlib
+import glob
 import os
 import runpy
+import select
 import shlex
+import shutil
 import subprocess
 import signal
 import sys
+import tempfile
+import threading
 import time
 
 import viztracer
-import numpy
+
+from .perfutils import perf_version
 
 
 RETRIES = 10
+# --control needs perf 5.9, and starting with the events disabled (-D -1) perf 5.10
+CONTROL_PERF_VERSION = (5, 10)
+# we keep only the last lines perf writes to stdout/stderr, since it writes a line for each enable, disable and dump
+OUTPUT_LINES = 1000
 
 
 usage = """
@@ -22,31 +33,179 @@ Run VizTracer and perf simultaneously. See also man perf record.
 Usage:
 
 $ perf-pyrecord -e cycles -m per4m.example2
+
+To only record some regions, run with --windowed and use per4m.record.window() in your code:
+
+    import per4m.record
+    with per4m.record.window():
+        hot_section()
 """
 
+class PerfControlError(OSError):
+    pass
+
+
 class PerfRecord:
-    def __init__(self, output='perf.data', args=[], verbose=1, stacktrace=True, buffer_size="128M"):
+    def __init__(self, output='perf.data', args=[], verbose=1, stacktrace=True, buffer_size="128M", pid=None, control=True, enabled=True, overwrite=False, max_files=10):
         self.output = output
+        self.pid = pid  # by default, record ourselves
         self.buffer_size = buffer_size
         self.args = args
         self.stacktrace = stacktrace
         self.verbose = verbose
+        # use perf record --control (perf >= 5.10) to know when perf is recording, otherwise we poll perf.data
+        self.control = control
+        self.control_dir = None
+        # with enabled=False, perf only records inside a window(), this needs the control fifo
+        self.enabled = enabled
+        self.windows = 0  # number of RecordingWindows we are in
+        # flight recorder: perf only keeps the last buffer_size (per cpu) of events in memory, and writes
+        # them to a new file ({output}.<timestamp>) on dump(), keeping at most max_files of them
+        self.overwrite = overwrite
+        self.max_files = max_files
+        # windows can be entered from several threads, a command and its ack should not interleave
+        self.control_lock = threading.Lock()
 
     def __enter__(self):
         self.start()
         return self
 
-    def start(self):
-        pid = os.getpid()
+    def _command(self):
+        pid = self.pid if self.pid is not None else os.getpid()
         # cmd = f"perf record -e 'sched:*' --call-graph dwarf -k CLOCK_MONOTONIC --pid {pid} -o {self.output}"
         perf_args = ' '.join(self.args)
         if self.stacktrace:
             perf_args += " --call-graph dwarf"
-        cmd = f"perf record  {perf_args} -k CLOCK_MONOTONIC --pid {pid} -o {self.output}"
+        if self.overwrite:
+            perf_args += f" --overwrite --switch-output=signal --switch-max-files={self.max_files} -m {self.buffer_size}"
+        return f"perf record  {perf_args} -k CLOCK_MONOTONIC --pid {pid} -o {self.output}"
+
+    def _run(self, cmd):
         if self.verbose >= 2:
             print(f"Running: {cmd}")
         args = shlex.split(cmd)
         self.perf = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+        # keep reading perf's output, otherwise perf blocks when the pipe is full (and stops acknowledging commands)
+        self.perf_output = []
+        self.readers = []
+        for pipe in (self.perf.stdout, self.perf.stderr):
+            lines = deque(maxlen=OUTPUT_LINES)
+            reader = threading.Thread(target=lines.extend, args=(pipe,), daemon=True)
+            reader.start()
+            self.perf_output.append(lines)
+            self.readers.append(reader)
+
+    def _communicate(self, timeout=None):
+        # like Popen.communicate, but returns what the readers collected (the last OUTPUT_LINES lines)
+        self.perf.wait(timeout=timeout)
+        for reader in self.readers:
+            reader.join(timeout)
+        return tuple(b''.join(lines) for lines in self.perf_output)
+
+    def start(self):
+        if self.control:
+            try:
+                return self._start_control()
+            except PerfControlError as e:
+                if self.verbose >= 2:
+                    print(f"{e}, falling back to waiting for perf to write to {self.output}")
+                self._close_control()
+        return self._start_polling()
+
+    def _start_control(self):
+        # perf starts with all events disabled (-D -1), and acknowledges when it enabled them
+        version = perf_version()
+        if version is not None and version < CONTROL_PERF_VERSION:
+            raise PerfControlError(f'perf {version[0]}.{version[1]} cannot start disabled with --control, this needs perf >= {CONTROL_PERF_VERSION[0]}.{CONTROL_PERF_VERSION[1]}')
+        self.control_dir = tempfile.mkdtemp(prefix='per4m-')
+        control_fifo = os.path.join(self.control_dir, 'control')
+        ack_fifo = os.path.join(self.control_dir, 'ack')
+        os.mkfifo(control_fifo)
+        os.mkfifo(ack_fifo)
+        # opening read/write does not block on waiting for perf to open the other end
+        self.control_fd = os.open(control_fifo, os.O_RDWR)
+        self.ack_fd = os.open(ack_fifo, os.O_RDWR)
+        self._run(f"{self._command()} -D -1 --control fifo:{control_fifo},{ack_fifo}")
+        # disabling is a no-op, but we know perf is ready when it acknowledges it
+        try:
+            self.send('enable' if self.enabled else 'disable')
+        except PerfControlError:
+            # do not leave perf running (e.g. when it never acknowledged), we may fall back to polling
+            if self.perf.poll() is None:
+                self.perf.terminate()
+                self._communicate(timeout=5)
+            self._close_control()
+            raise
+        with windows_lock:
+            active_recorders.append(self)
+        return self
+
+    def send(self, command, timeout=10):
+        """Sends a command (e.g. enable or disable) to perf, and waits till perf acknowledges it"""
+        with self.control_lock:
+            if self.control_dir is None:
+                raise PerfControlError('perf is not running with a control fifo')
+            os.write(self.control_fd, f'{command}\n'.encode('ascii'))
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                ready, _, _ = select.select([self.ack_fd], [], [], 0.05)
+                if ready and b'ack' in os.read(self.ack_fd, 64):
+                    return
+                if self.perf.poll() is not None:
+                    outs, errs = self._communicate()
+                    raise PerfControlError(f'perf exited with code {self.perf.returncode} before acknowledging {command!r}: {errs.decode("utf8").strip()}')
+            raise PerfControlError(f'perf did not acknowledge {command!r} within {timeout} seconds')
+
+    def enable(self):
+        """Resumes recording (without restarting perf)"""
+        self.send('enable')
+        self.enabled = True
+
+    def disable(self):
+        """Pauses recording, perf keeps running but does not record events"""
+        self.send('disable')
+        self.enabled = False
+
+    def window(self, pytrace=None):
+        """Only record inside this window, usable as context manager or decorator, see RecordingWindow"""
+        return RecordingWindow(self, pytrace=pytrace)
+
+    def _close_control(self):
+        with windows_lock:
+            if self in active_recorders:
+                active_recorders.remove(self)
+        if self.control_dir is not None:
+            os.close(self.control_fd)
+            os.close(self.ack_fd)
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def dump(self, timeout=10):
+        """In overwrite mode, lets perf write the events it has in its buffer to a new file, and returns its filename"""
+        if not self.overwrite:
+            raise ValueError('dump only works in overwrite (flight recorder) mode')
+        pattern = glob.escape(self.output) + '.[0-9]*'
+        before = set(glob.glob(pattern))
+        self.perf.send_signal(signal.SIGUSR2)
+        deadline = time.time() + timeout
+        size = None
+        while time.time() < deadline:
+            time.sleep(0.05)
+            new = sorted(set(glob.glob(pattern)) - before)
+            if new:
+                # wait till perf is done writing
+                new_size = os.path.getsize(new[-1])
+                if new_size == size:
+                    return new[-1]
+                size = new_size
+            if self.perf.poll() is not None:
+                raise OSError(f'perf exited with code {self.perf.returncode}')
+        raise OSError(f'perf did not dump its buffer within {timeout} seconds')
+
+    def _start_polling(self):
+        if not self.enabled:
+            raise PerfControlError('perf record needs --control support (perf >= 5.10) to start disabled')
+        self._run(self._command())
         start_time = time.time()
         for _ in range(RETRIES):
             if os.path.exists(self.output):
@@ -58,6 +217,10 @@ class PerfRecord:
         else:
             self._finish()
             raise OSError(f'perf did not create {self.output}')
+        if self.overwrite:
+            # perf only writes events on a dump, so we cannot wait for it to write
+            time.sleep(0.05)
+            return self
         start_size = os.path.getsize(self.output)
         for _ in range(RETRIES):
             size = os.path.getsize(self.output)
@@ -73,8 +236,9 @@ class PerfRecord:
         return self
 
     def _finish(self):
+        self._close_control()
         self.perf.terminate()
-        outs, errs = self.perf.communicate(timeout=5)
+        outs, errs = self._communicate(timeout=5)
         if self.verbose >= 1:
             print(outs.decode('utf8'))
         if errs:
@@ -94,6 +258,69 @@ class PerfRecord:
         self.perf.wait()
 
 
+# PerfRecords that are running with a control fifo, used by window()
+active_recorders = []
+# number of windows we are in that use pytrace
+pytrace_windows = 0
+# guards the above, and the number of windows each recorder is in, since windows can be entered from several threads
+windows_lock = threading.RLock()
+
+
+class RecordingWindow(contextlib.ContextDecorator):
+    """Enables the recorders (and optionally pytrace) on enter, and disables them again on exit.
+
+    Can be nested (only the outermost window toggles), and used as a decorator, e.g.:
+
+        with perf.window():
+            hot_section()
+
+    pytrace can be a dict with arguments for pytrace.start, to also trace Python calls in the window.
+    """
+    def __init__(self, *recorders, pytrace=None):
+        self.recorders = recorders
+        self.pytrace = pytrace
+        # per thread, a stack of the recorders we enabled, in case we are entered recursively
+        self.local = threading.local()
+
+    def __enter__(self):
+        global pytrace_windows
+        with windows_lock:
+            # if we are used from the module level window(), take the recorders running at this moment
+            recorders = self.recorders or list(active_recorders)
+            if not hasattr(self.local, 'entered'):
+                self.local.entered = []
+            self.local.entered.append(recorders)
+            for recorder in recorders:
+                recorder.windows += 1
+                if recorder.windows == 1:
+                    recorder.enable()
+            if self.pytrace is not None:
+                pytrace_windows += 1
+                if pytrace_windows == 1:
+                    from . import pytrace
+                    pytrace.start(**self.pytrace)
+        return self
+
+    def __exit__(self, *exc):
+        global pytrace_windows
+        with windows_lock:
+            if self.pytrace is not None:
+                pytrace_windows -= 1
+                if pytrace_windows == 0:
+                    from . import pytrace
+                    pytrace.stop()
+            for recorder in self.local.entered.pop():
+                recorder.windows -= 1
+                if recorder.windows == 0:
+                    recorder.disable()
+        return False
+
+
+def window(pytrace=None):
+    """Records only inside this window, with all PerfRecords that are running (e.g. started by perf-pyrecord --windowed)"""
+    return RecordingWindow(pytrace=pytrace)
+
+
 @contextlib.contextmanager
 def empty_context():
     yield
@@ -114,6 +341,7 @@ def main(argv=sys.argv):
     parser.add_argument('--event', '-e', dest='events', help="Select PMU event, passed down to perf record (see man perf record)", action='append', default=[])
 
     parser.add_argument('--tracer_entries', type=int, default=1000000, help="See viztracer --help")
+    parser.add_argument('--windowed', help="Only let perf record inside per4m.record.window() regions (default: %(default)s)", default=False, action='store_true')
 
     # # these gets passed to stacktraceinject
     # parser.add_argument('--keep-cpython-evals', help="keep CPython evaluation stacktraces (instead of replacing) (default: %(default)s)", default=True, action='store_true')
@@ -141,7 +369,7 @@ def main(argv=sys.argv):
     for event in args.events:
         perf_args.append(f' -e {event}')
     with ctx:
-        with PerfRecord(verbose=verbose, args=perf_args) as perf:
+        with PerfRecord(verbose=verbose, args=perf_args, enabled=not args.windowed) as perf:
             with viztracer.VizTracer(output_file=viztracer_path, verbose=verbose, tracer_entries=args.tracer_entries):
                 if args.module:
                     runpy.run_module(args.module)
@@ -0,0 +1,99 @@
+import heapq
+import struct
+
+
+# Reads the files written by pytrace.dump, the in-process tracer (pytrace.start(ring=N)) that does not
+# need perf or uprobes. It yields the same events (and fields) as perfdata.PerfData, so gil2trace and
+# EventStore can use it directly. CPython does not tell us when the GIL is taken or dropped, so pytrace
+# infers it from the thread that runs the profile function: the GIL went from thread A to B between
+# the last event of A and the first event of B. This means we only see GIL switches at the resolution
+# of Python calls, and never see a thread waiting on the GIL.
+
+MAGIC = b'PER4MRB1'
+
+# record kinds, see pytrace.cpp
+RECORD_ENTRY, RECORD_RETURN, RECORD_TAKE, RECORD_DROP = range(4)
+
+_header = struct.Struct('=8sIIq')
+_thread = struct.Struct('=qQQ')
+_record = struct.Struct('=QQihh')
+_u64 = struct.Struct('=Q')
+_u32 = struct.Struct('=I')
+
+# what perf would call the events, when using the uprobes
+_event_names = {
+    RECORD_ENTRY: ['pytrace:function_entry'],
+    RECORD_RETURN: ['pytrace:function_return'],
+    RECORD_TAKE: ['python:take_gil', 'python:take_gil__return'],
+    RECORD_DROP: ['python:drop_gil', 'python:drop_gil__return'],
+}
+
+
+class RingBufferDump:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            data = f.read()
+        magic, version, thread_count, self.pid = _header.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not a pytrace ring buffer dump')
+        if version != 1:
+            raise ValueError(f'Unsupported pytrace ring buffer dump version {version}')
+        offset = _header.size
+        self.threads = []  # list of (tid, records), records is a memoryview of the raw records
+        self.dropped = {}  # tid -> number of overwritten records
+        for i in range(thread_count):
+            tid, written, capacity = _thread.unpack_from(data, offset)
+            offset += _thread.size
+            size = min(written, capacity) * _record.size
+            self.threads.append((tid, memoryview(data)[offset:offset + size]))
+            self.dropped[tid] = max(0, written - capacity)
+            offset += size
+        self.symbols = {}  # code id -> (filename, funcname)
+        count, = _u64.unpack_from(data, offset)
+        offset += _u64.size
+        for i in range(count):
+            code, = _u64.unpack_from(data, offset)
+            offset += _u64.size
+            names = []
+            for j in range(2):
+                length, = _u32.unpack_from(data, offset)
+                offset += _u32.size
+                names.append(data[offset:offset + length].decode('utf8', 'replace'))
+                offset += length
+            self.symbols[code] = tuple(names)
+
+    def records(self):
+        """Yields (time_ns, tid, code, lineno, kind, what) of all threads, sorted by time
+
+        When ring buffers overflowed, we only yield the records from the moment we have the records
+        of all threads, and skip a thread's GIL drop when we did not see it taking the GIL.
+        """
+        start = max((_record.unpack_from(records, 0)[0] for tid, records in self.threads if self.dropped[tid] and len(records)), default=0)
+
+        def thread_records(tid, records):
+            has_taken = False
+            for time, code, lineno, kind, what in _record.iter_unpack(records):
+                if time < start:
+                    continue
+                if kind == RECORD_TAKE:
+                    has_taken = True
+                elif kind == RECORD_DROP and not has_taken:
+                    continue
+                yield time, tid, code, lineno, kind, what
+        return heapq.merge(*[thread_records(tid, records) for tid, records in self.threads], key=lambda record: record[0])
+
+    def tokenized_events(self):
+        """Yields (header, stacktrace, (comm, pid, cpu, time, count, event, fields)) like perfdata.PerfData"""
+        unknown = ('<unknown>', None)
+        for time_ns, tid, code, lineno, kind, what in self.records():
+            time = time_ns / 1e3
+            time_text = f"{time_ns // 10**9}.{time_ns % 10**9:09d}:"
+            if kind in (RECORD_ENTRY, RECORD_RETURN):
+                filename, funcname = self.symbols.get(code, unknown)
+                fields = {'filename': filename, 'funcname': funcname or f'{code:#x}', 'l': lineno, 'what': what}
+            else:
+                fields = {}
+            for event in _event_names[kind]:
+                header = f"python {self.pid}/{tid} {time_text} {event}:"
+                yield header, None, ('python', tid, None, time, None, event, fields)
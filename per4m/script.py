@@ -1,13 +1,15 @@
 import argparse
-import json
+import bisect
+from collections import OrderedDict
 import shlex
 import subprocess
 import sys
 
-from viztracer.prog_snapshot import ProgSnapshot
+from viztracer.prog_snapshot import Frame
 
 
 from .perfutils import read_events, parse_header
+from .tracemerge import load_snapshot
 
 usage = """
 
@@ -21,17 +23,146 @@ $ perf-pyscript | per4m stacktraceinject --input viztracer.json
 def print_stderr(*args):
     print(*args, file=sys.stderr)
 
-def stacktrace_inject(stacktrace, snapshot, pid, time, keep_cpython_evals=False, perror=print_stderr, allow_mismatch=False, pedantic=False):
-    # we'll do in place modification
-    stacktrace = stacktrace.copy()
-    # First, we build op parts of the callstack from VizTracers
-    # We can go into and out of Python/C several times
+class SnapshotIndex:
+    """Finds the Python callstack at a given time and thread, in O(log n) instead of O(n) per lookup.
+
+    Equivalent to ProgSnapshot.goto_tid followed by goto_timestamp, but we keep a sorted array
+    of the start times of the children of each node (built once, on first use) instead of
+    recreating them for every lookup. Since many samples fall in the same function call, the
+    formatted Python stacktraces are cached (LRU) per innermost function call node.
+
+    With merge=True, lookups of the same thread that come in time order (as perf script gives
+    them) walk the call tree with a StackCursor instead of searching it, so a whole perf script
+    output is injected in a single pass over both the samples and the call tree.
+    """
+    def __init__(self, snapshot, cache_size=4096, merge=False):
+        self.snapshot = snapshot
+        self.trees = {}  # tid -> FuncTree
+        for pid, forest in snapshot.func_trees.items():
+            for tid, tree in forest.items():
+                self.trees.setdefault(tid, tree)
+        for pid, forest in snapshot.func_trees.items():
+            if forest:
+                # ProgSnapshot falls back to the current tree for a pid that is not a tid
+                self.trees.setdefault(pid, next(iter(forest.values())))
+        self.pids = list(self.trees)
+        self._starts = {}  # node -> start times of its children
+        self._cache = OrderedDict()  # innermost node -> (pystacktraces, bottom_frame)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.merge = merge
+        self.cursors = {}  # tid -> StackCursor
+
+    def starts(self, node):
+        starts = self._starts.get(node)
+        if starts is None:
+            starts = self._starts[node] = [child.start for child in node.children]
+        return starts
+
+    def find_node(self, tid, ts):
+        """Returns the innermost function call node of thread tid at time ts"""
+        root = self.trees[tid].root
+        idx = bisect.bisect(self.starts(root), ts)
+        node = root.children[idx - 1 if idx else 0]
+        while node.children:
+            idx = bisect.bisect_left(self.starts(node), ts)
+            if idx == 0:
+                break
+            child = node.children[idx - 1]
+            if child.end <= ts:
+                break
+            node = child
+        return node
+
+    def frame(self, node):
+        """Returns a viztracer Frame (as ProgSnapshot.curr_frame would be) for node"""
+        nodes = []
+        while node is not None and node.parent is not None:  # the root node is not part of the callstack
+            nodes.append(node)
+            node = node.parent
+        frame = None
+        for node in reversed(nodes):
+            frame = Frame(frame, node)
+        return frame
+
+    def python_stacktraces(self, tid, ts):
+        """Returns (pystacktraces, bottom_frame), see stacktrace_inject"""
+        if self.merge:
+            cursor = self.cursors.get(tid)
+            if cursor is None:
+                cursor = self.cursors[tid] = StackCursor(self.trees[tid])
+            node = cursor.advance(ts)
+            if node is None:  # went back in time
+                node = self.find_node(tid, ts)
+        else:
+            node = self.find_node(tid, ts)
+        cached = self._cache.get(node)
+        if cached is not None:
+            self.hits += 1
+            self._cache.move_to_end(node)
+            return cached
+        self.misses += 1
+        bottom_frame = self.frame(node)
+        cached = self._cache[node] = python_stacktraces(bottom_frame), bottom_frame
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return cached
+
+
+class StackCursor:
+    """Walks the call tree of a single thread forward in time, keeping track of the live callstack.
+
+    Gives the same node as SnapshotIndex.find_node, but since each node only moves forward over
+    its children, all lookups together cost O(number of calls + number of lookups).
+    """
+    def __init__(self, tree):
+        self.root = tree.root
+        self.top = 0  # number of top level calls that started at or before ts
+        self.path = []  # the live callstack, a list of [node, number of children started before ts]
+        self.ts = None
+
+    def advance(self, ts):
+        """Returns the innermost function call node at time ts, or None when ts is before the previous ts"""
+        if self.ts is not None and ts < self.ts:
+            return None
+        self.ts = ts
+        children = self.root.children
+        while self.top < len(children) and children[self.top].start <= ts:
+            self.top += 1
+        node = children[self.top - 1 if self.top else 0]
+        path = self.path
+        if not path or path[0][0] is not node:
+            path[:] = [[node, 0]]
+        # leave the calls that have ended, since siblings do not overlap, the remaining
+        # callstack is still valid, and we only need to look deeper from there
+        level = len(path) - 1
+        while level > 0 and path[level][0].end <= ts:
+            level -= 1
+        del path[level + 1:]
+        while True:
+            entry = path[level]
+            node, count = entry
+            children = node.children
+            while count < len(children) and children[count].start < ts:
+                count += 1
+            entry[1] = count
+            if count == 0:
+                break
+            child = children[count - 1]
+            if child.end <= ts:
+                break
+            path.append([child, 0])
+            level += 1
+        return node
+
+
+def python_stacktraces(bottom_frame):
+    """Formats the callstack of a viztracer Frame as perf script lines, split in parts where C calls into Python"""
     pystacktraces = [[]]
     pystacktrace_part = pystacktraces[-1]
 
-    snapshot.goto_tid(pid)
-    snapshot.goto_timestamp(time)
-    bottom_frame = frame = snapshot.curr_frame
+    frame = bottom_frame
     was_in_python = frame.node.is_python
     while frame:
         node = frame.node
@@ -63,6 +194,22 @@ def stacktrace_inject(stacktrace, snapshot, pid, time, keep_cpython_evals=False,
         pystacktrace_part.append(f'000000000000000000000000 {type}::{funcname}{location} ([{filename}])')
         was_in_python = node.is_python
         frame = frame.parent
+    return pystacktraces
+
+
+def stacktrace_inject(stacktrace, snapshot, pid, time, keep_cpython_evals=False, perror=print_stderr, allow_mismatch=False, pedantic=False):
+    """Injects the Python callstack in a perf stacktrace, snapshot is a SnapshotIndex (preferred) or a ProgSnapshot"""
+    # we'll do in place modification
+    stacktrace = stacktrace.copy()
+    # First, we build op parts of the callstack from VizTracers
+    # We can go into and out of Python/C several times
+    if isinstance(snapshot, SnapshotIndex):
+        pystacktraces, bottom_frame = snapshot.python_stacktraces(pid, time)
+    else:
+        snapshot.goto_tid(pid)
+        snapshot.goto_timestamp(time)
+        bottom_frame = snapshot.curr_frame
+        pystacktraces = python_stacktraces(bottom_frame)
     
     # Next, we find where in the perf output, we were in the Python evaluate loop (multiple places possible)
     # A list of (index_min, index_max) where the Python stacktraces should be injected/replaced
@@ -153,6 +300,8 @@ def main(argv=sys.argv):
     parser.add_argument('--no-allow-mismatch', dest="allow_mismatch", action='store_false')
     parser.add_argument('--pedantic', help="If false, accept known stack mismatch issues (default: %(default)s)", default=False, action='store_true')
     parser.add_argument('--no-pedantic', dest="pedantic", action='store_false')
+    parser.add_argument('--merge', help="Walk the VizTracer call tree along with the (time ordered) perf samples, instead of searching it for each sample (default: %(default)s)", default=True, action='store_true')
+    parser.add_argument('--no-merge', dest="merge", action='store_false')
     parser.add_argument('--input', '-i', help="VizTracer input (default %(default)s)", default="viztracer.json")
     parser.add_argument('--output', '-o', dest="output", default=None, help="Output filename (default %(default)s)")
     
@@ -175,14 +324,12 @@ def main(argv=sys.argv):
     
     if verbose >= 1:
         print_stderr("Loading snapshot")
-    with open(args.input, "r") as f:
-        json_data = f.read()
-    snap = ProgSnapshot(json_data)
+    # a single streaming pass gives us the snapshot, and the first timestamp
+    snapshot, summary = load_snapshot(args.input)
+    snap = SnapshotIndex(snapshot, merge=args.merge)
     # find all pids (or tids)
-    pids = list(snap.func_trees)
-    for pid in pids.copy():
-        pids.extend(list(snap.func_trees[pid]))
-    t0 = min(event['ts'] for event in json.loads(json_data)['traceEvents'])
+    pids = set(snap.pids)
+    t0 = summary.t0
     
     for header, stacktrace in read_events(perf.stdout):
         print(header, file=output)
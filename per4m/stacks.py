@@ -0,0 +1,96 @@
+from array import array
+from collections import Counter
+import re
+
+
+class StackTable:
+    """Interns stacktraces, so each unique frame string and each unique stack is stored once.
+
+    Frames map to a frame id, and a stack (a sequence of frames) to a stack id. The frame ids of
+    all stacks are stored back to back in a single array, with an offsets array pointing into it.
+    """
+    def __init__(self):
+        self.frames = []  # frame id -> frame string
+        self.frame_ids = {}
+        self.stack_ids = {}  # tuple of frame ids -> stack id
+        self.offsets = array('l', [0])
+        self.stack_frames = array('l')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, stack_id):
+        """Returns the stacktrace (a list of frame strings) of a stack id"""
+        frames = self.frames
+        return [frames[frame_id] for frame_id in self.frame_ids_of(stack_id)]
+
+    def frame_ids_of(self, stack_id):
+        return self.stack_frames[self.offsets[stack_id]:self.offsets[stack_id + 1]]
+
+    def intern_frame(self, frame):
+        frame_id = self.frame_ids.get(frame)
+        if frame_id is None:
+            frame_id = self.frame_ids[frame] = len(self.frames)
+            self.frames.append(frame)
+        return frame_id
+
+    def intern(self, stacktrace):
+        """Returns the stack id of a stacktrace (a sequence of frame strings)"""
+        key = tuple(self.intern_frame(frame) for frame in stacktrace)
+        stack_id = self.stack_ids.get(key)
+        if stack_id is None:
+            stack_id = self.stack_ids[key] = len(self)
+            self.stack_frames.extend(key)
+            self.offsets.append(len(self.stack_frames))
+        return stack_id
+
+
+_offset = re.compile(r'\+0x[0-9a-f]+$')
+
+
+def fold_frame(frame):
+    """Converts a perf script stack line to a name in folded format, like stackcollapse-perf.pl
+
+    e.g. '7f2b3c4d5e6f take_gil+0x1d5 (/usr/bin/python3.8)' -> 'take_gil'
+    and kernel functions get a _[k] suffix, e.g. '__schedule_[k]'
+    """
+    parts = frame.split(' ', 1)
+    name = parts[-1]
+    kernel = False
+    if name.endswith(')') and ' (' in name:
+        index = name.rindex(' (')
+        kernel = name[index:] == ' ([kernel.kallsyms])'
+        name = name[:index]
+    name = _offset.sub('', name)
+    if kernel:
+        name += '_[k]'
+    return name.replace(';', ':')
+
+
+class FoldedStacks:
+    """Aggregates weights per unique stack, and writes them in folded format (one 'root;...;leaf weight' line per stack)"""
+    def __init__(self, stacks=None):
+        self.stacks = stacks if stacks is not None else StackTable()
+        self.weights = Counter()  # stack id -> weight
+        self._folded_frames = {}  # frame id -> folded name
+
+    def add(self, stacktrace, weight):
+        self.weights[self.stacks.intern(stacktrace)] += weight
+
+    def _fold(self, frame_id):
+        name = self._folded_frames.get(frame_id)
+        if name is None:
+            name = self._folded_frames[frame_id] = fold_frame(self.stacks.frames[frame_id])
+        return name
+
+    def folded(self):
+        """Returns a Counter mapping folded stack -> weight, perf stacks have the leaf first, folded stacks the root first"""
+        folded = Counter()
+        for stack_id, weight in self.weights.items():
+            frame_ids = self.stacks.frame_ids_of(stack_id)
+            folded[';'.join(self._fold(frame_id) for frame_id in reversed(frame_ids))] += weight
+        return folded
+
+    def write(self, output):
+        for folded, weight in sorted(self.folded().items()):
+            print(f'{folded} {weight}', file=output)
@@ -0,0 +1,197 @@
+import argparse
+from collections import Counter
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from .perfutils import read_tokenized_events
+from .perf2trace import EventKinds, print_summary, TAKE, TAKE_RETURN, DROP_RETURN
+
+
+usage = """
+
+Live, top like, view of who has the GIL, and who waits on it, over a sliding window.
+
+Usage:
+
+(read the docs to install the GIL uprobes)
+$ per4m top --pid 1234
+Or feed it perf script output yourself:
+$ perf record -e 'python:*gil*' -k CLOCK_MONOTONIC -o - --pid 1234 | perf script -i - --ns | per4m top
+"""
+
+
+class GilMonitor:
+    """Runs the GIL state machine of gil2trace online, keeping the time on and waiting on the GIL per thread per bucket (of bucket_size seconds)
+
+    Only the buckets of the last window seconds are kept, and threads are forgotten when we have not seen them in the
+    window, so memory use does not grow over time.
+    """
+    def __init__(self, window=10, bucket_size=1, **probes):
+        self.event_kinds = EventKinds(**probes)
+        self.bucket_size = bucket_size * 1e6  # in us, like the times
+        self.window_buckets = max(1, int(round(window / bucket_size)))
+        self.first_seen = {}  # pid -> time
+        self.last_seen = {}
+        self.wants_take_gil = {}
+        self.has_gil = {}
+        self.time_on_gil = {}  # pid -> Counter(bucket -> time in us)
+        self.time_wait_gil = {}
+        self.parent_pid = None
+        self.time = None  # the last time we have seen
+        self.events = 0
+
+    def feed(self, tokens):
+        comm, pid, cpu, time, count, event, other = tokens
+        kind = self.event_kinds[event]
+        if kind not in (TAKE, TAKE_RETURN, DROP_RETURN):
+            return
+        self.events += 1
+        if self.parent_pid is None:
+            self.parent_pid = pid
+        if pid not in self.first_seen:
+            self.first_seen[pid] = time
+            self.time_on_gil[pid] = Counter()
+            self.time_wait_gil[pid] = Counter()
+        self.last_seen[pid] = time
+        if kind == TAKE:
+            self.wants_take_gil[pid] = time
+        elif kind == TAKE_RETURN:
+            wants = self.wants_take_gil.pop(pid, time)
+            self._add(self.time_wait_gil[pid], max(self.first_seen[pid], wants), time)
+            self.has_gil[pid] = time
+        elif kind == DROP_RETURN:
+            if pid in self.has_gil:
+                self._add(self.time_on_gil[pid], self.has_gil.pop(pid), time)
+        self.advance(time)
+
+    def advance(self, time):
+        """Moves the window to time (in us), e.g. when no events arrive because the process is idle"""
+        if self.time is None or time > self.time:
+            previous_bucket = None if self.time is None else self._bucket(self.time)
+            self.time = time
+            if self._bucket(time) != previous_bucket:
+                self._prune()
+
+    def _bucket(self, time):
+        return int(time // self.bucket_size)
+
+    def _add(self, counter, begin, end):
+        # spread the interval over the buckets it covers
+        while begin < end:
+            bucket = self._bucket(begin)
+            bucket_end = min(end, (bucket + 1) * self.bucket_size)
+            counter[bucket] += bucket_end - begin
+            begin = bucket_end
+
+    def window(self):
+        """Returns the (begin, end) time (in us) of the sliding window"""
+        last = self._bucket(self.time)
+        return (last - self.window_buckets + 1) * self.bucket_size, self.time
+
+    def _prune(self):
+        begin = self.window()[0]
+        first_bucket = self._bucket(begin)
+        for pid in list(self.first_seen):
+            if self.last_seen[pid] < begin and pid not in self.has_gil and pid not in self.wants_take_gil:
+                for mapping in (self.first_seen, self.last_seen, self.time_on_gil, self.time_wait_gil):
+                    del mapping[pid]
+                continue
+            for counter in (self.time_on_gil[pid], self.time_wait_gil[pid]):
+                for bucket in [bucket for bucket in counter if bucket < first_bucket]:
+                    del counter[bucket]
+
+    def summary(self):
+        """Returns t_min, t_max, time_on_gil and time_wait_gil (dicts mapping pid -> time in us) over the window, see print_summary"""
+        t_min, t_max, time_on_gil, time_wait_gil = {}, {}, {}, {}
+        if self.time is None:
+            return t_min, t_max, time_on_gil, time_wait_gil
+        begin, end = self.window()
+        first_bucket = self._bucket(begin)
+        for pid in self.first_seen:
+            t_min[pid] = max(begin, self.first_seen[pid])
+            t_max[pid] = end
+            time_on_gil[pid] = sum(value for bucket, value in self.time_on_gil[pid].items() if bucket >= first_bucket)
+            time_wait_gil[pid] = sum(value for bucket, value in self.time_wait_gil[pid].items() if bucket >= first_bucket)
+            # include what is still going on
+            if pid in self.has_gil:
+                time_on_gil[pid] += end - max(begin, self.has_gil[pid])
+            elif pid in self.wants_take_gil:
+                time_wait_gil[pid] += end - max(begin, self.first_seen[pid], self.wants_take_gil[pid])
+        return t_min, t_max, time_on_gil, time_wait_gil
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     usage=usage)
+    parser.add_argument('--verbose', '-v', action='count', default=1)
+    parser.add_argument('--quiet', '-q', action='count', default=0)
+    parser.add_argument('--pid', '-p', type=int, help="Run perf on this process, instead of reading perf script output from stdin")
+    parser.add_argument('--window', type=float, default=10, help="Sliding window in seconds (default: %(default)s)")
+    parser.add_argument('--interval', type=float, default=1, help="Refresh interval in seconds (default: %(default)s)")
+    parser.add_argument('--no-clear', dest="clear", default=True, action='store_false', help="Do not clear the screen before each refresh")
+
+    args = parser.parse_args(argv[1:])
+    verbose = args.verbose - args.quiet
+
+    perf_record = perf_script = None
+    if args.pid:
+        cmd = f"perf record -e 'python:*gil*' -k CLOCK_MONOTONIC --pid {args.pid} -o -"
+        if verbose >= 2:
+            print(f"Running: {cmd}", file=sys.stderr)
+        perf_record = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        cmd = "perf script -i - --ns"
+        perf_script = subprocess.Popen(shlex.split(cmd), stdin=perf_record.stdout, stdout=subprocess.PIPE, text=True)
+        perf_record.stdout.close()  # perf script has its own copy
+        input = perf_script.stdout
+    else:
+        input = sys.stdin
+
+    monitor = GilMonitor(window=args.window, bucket_size=min(args.interval, args.window))
+    lock = threading.Lock()
+    done = threading.Event()
+    # the time of the last event, and our (monotonic) time when we read it
+    last_read = [None, None]
+
+    def consume():
+        try:
+            for header, stacktrace, tokens in read_tokenized_events(input):
+                with lock:
+                    monitor.feed(tokens)
+                    last_read[:] = tokens[3], time.monotonic()
+        finally:
+            done.set()
+
+    def show():
+        with lock:
+            if not done.is_set() and last_read[0] is not None:
+                # when no events arrive (e.g. the process is idle), time still passes
+                monitor.advance(last_read[0] + (time.monotonic() - last_read[1]) * 1e6)
+            summary = monitor.summary()
+            events = monitor.events
+        if args.clear:
+            print('\033[H\033[J', end='')
+        print(f"GIL activity over the last {args.window:g} seconds ({events} GIL events seen)")
+        print_summary(*summary, monitor.parent_pid, verbose=verbose)
+
+    reader = threading.Thread(target=consume, daemon=True)
+    reader.start()
+    try:
+        while not done.wait(args.interval):
+            show()
+        show()  # the input ended
+    except KeyboardInterrupt:
+        pass
+    finally:
+        processes = [process for process in (perf_record, perf_script) if process is not None]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
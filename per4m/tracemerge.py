@@ -0,0 +1,274 @@
+import argparse
+import gzip
+import heapq
+import json
+import re
+import sys
+
+from .tracewriter import trace_writer
+
+
+usage = """
+
+Merge TraceEvent JSON files (e.g. from VizTracer and per4m perf2trace), streaming, so memory does not grow with the size of the traces.
+
+Usage:
+
+$ per4m merge viztracer.json giltracer.json schedtracer.json -o merged.json
+Or as a Perfetto trace, which is much smaller, and opens a lot faster in https://ui.perfetto.dev
+$ per4m merge viztracer.json giltracer.json -o merged.pftrace
+"""
+
+
+class TraceReader:
+    """Iterates over the events of a TraceEvent JSON file (optionally gzip compressed), without loading it all in memory.
+
+    The file is either a list of events, or an object with the events in traceEvents. The other keys
+    of the object (e.g. viztracer_metadata) are in metadata, once we read past them.
+    """
+    def __init__(self, filename, chunk_size=1 << 20):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.metadata = {}
+
+    def __iter__(self):
+        with (gzip.open(self.filename, 'rt', encoding='utf8') if self.filename.endswith('.gz') else open(self.filename, encoding='utf8')) as f:
+            yield from _JsonStream(f, self.chunk_size).trace_events(self.metadata)
+
+
+class _JsonStream:
+    # decodes JSON values one at a time from a file, keeping only what we did not decode yet in memory
+    def __init__(self, f, chunk_size):
+        self.file = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size=None):
+        data = self.file.read(size or self.chunk_size)
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += data
+        return bool(data)
+
+    def peek(self):
+        # skips whitespace, returns the next character, or '' at the end of the file
+        while True:
+            buffer, pos = self.buffer, self.pos
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            self.pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f'Expected one of {characters!r} in {self.file.name} at {self.pos}, got {character!r}')
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or not self.fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                # read larger chunks, so large values do not take quadratic time
+                if not self.fill(size):
+                    raise
+                size *= 2
+
+    def trace_events(self, metadata):
+        if self.peek() == '[':
+            yield from self.array()
+            return
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == 'traceEvents':
+                yield from self.array()
+            else:
+                metadata[key] = self.value()
+            if self.expect(',}') == '}':
+                return
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class TraceSummary:
+    """What we need to know of a trace (like the first timestamp, t0), gathered while streaming over it"""
+    def __init__(self):
+        self.t0 = None
+        self.t_max = None
+        self.pids = set()  # all pids and tids
+        self.count = 0
+
+    def add(self, event):
+        self.count += 1
+        ts = event.get('ts')
+        if ts is not None:
+            end = ts + event.get('dur', 0)
+            if self.t0 is None or ts < self.t0:
+                self.t0 = ts
+            if self.t_max is None or end > self.t_max:
+                self.t_max = end
+        for key in ('pid', 'tid'):
+            if key in event:
+                self.pids.add(event[key])
+
+
+def _trace_source(source):
+    # returns (events, metadata) of a filename, a trace dict (like VizTracer.data) or an iterable of events
+    if isinstance(source, str):
+        reader = TraceReader(source)
+        return reader, reader.metadata  # the metadata is filled in while we read
+    if isinstance(source, dict):
+        return source['traceEvents'], {key: value for key, value in source.items() if key != 'traceEvents'}
+    return source, {}
+
+
+def _reorder(events, size):
+    # sorts the events by timestamp, as long as none of them is more than size events out of place
+    heap = []
+    for index, event in enumerate(events):
+        item = (event.get('ts', -1), index, event)
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        else:
+            yield heapq.heappushpop(heap, item)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def merge_traces(sources, output, format=None, compress=None, max_events=None, reorder=100_000):
+    """Merges the events of the traces into output (see tracewriter.trace_writer), returns a TraceSummary
+
+    A source is a TraceEvent JSON filename, a trace dict (like VizTracer.data) or an iterable of events
+    (e.g. the events gil2trace yields, so we do not need to write them to disk first). Sources do not
+    need to be sorted, VizTracer for instance writes a function (X event) after the calls it made. We
+    sort each source with a window of reorder events, and merge them by timestamp, so the output is
+    sorted when no event is more than reorder events out of place in its source (else it is roughly
+    sorted, viewers sort the events themselves). The metadata (e.g. of VizTracer) of the first source is kept.
+    """
+    sources = [_trace_source(source) for source in sources]
+    summary = TraceSummary()
+    with trace_writer(output, format=format, compress=compress, max_events=max_events) as writer:
+        for event in heapq.merge(*[_reorder(events, reorder) for events, metadata in sources], key=lambda event: event.get('ts', -1)):
+            summary.add(event)
+            writer.write(event)
+        writer.metadata.update(sources[0][1])
+    return summary
+
+
+# the last VizTracer version with a ProgSnapshot (vdb), of which we know how ProgSnapshot.load works
+SNAPSHOT_VIZTRACER_VERSION = (0, 15)
+
+
+def load_snapshot(filename):
+    """Loads a VizTracer JSON file in a ProgSnapshot in a single streaming pass, returns (snapshot, summary)
+
+    Like ProgSnapshot(json_string), but without keeping the JSON text and the decoded JSON in memory,
+    and computing the TraceSummary (e.g. t0) on the way. This does what ProgSnapshot.load does, so for
+    VizTracer versions we do not know, we fall back to ProgSnapshot(json_string).
+    """
+    import viztracer
+    from viztracer.prog_snapshot import ProgSnapshot, Frame
+    version = tuple(int(part) for part in re.findall(r'\d+', viztracer.__version__)[:2])
+    if version > SNAPSHOT_VIZTRACER_VERSION:
+        return _load_snapshot_json(filename)
+    reader = TraceReader(filename)
+    snapshot = ProgSnapshot()
+    summary = TraceSummary()
+    for event in reader:
+        summary.add(event)
+        snapshot.load_event(event)
+    if 'viztracer_metadata' not in reader.metadata:
+        raise ValueError(f'{filename} is not written by VizTracer, or by a version that is too old')
+    if not snapshot.check_version(reader.metadata['viztracer_metadata']['version']):
+        raise ValueError(f'{filename} is written by an incompatible version of VizTracer')
+    # the rest is what ProgSnapshot.load does
+    snapshot.first_tree = min(snapshot.get_trees(), key=lambda tree: tree.first_ts())
+    first_ts = snapshot.first_tree.first_ts()
+    snapshot.curr_tree = snapshot.first_tree
+    snapshot.curr_frame = Frame(None, snapshot.first_tree.first_node())
+    for tree in snapshot.get_trees():
+        tree.normalize(first_ts)
+    snapshot.counter_events.normalize(first_ts)
+    snapshot.object_events.normalize(first_ts)
+    return snapshot, summary
+
+
+def _load_snapshot_json(filename):
+    from viztracer.prog_snapshot import ProgSnapshot
+    with (gzip.open(filename, 'rt', encoding='utf8') if filename.endswith('.gz') else open(filename, encoding='utf8')) as f:
+        snapshot = ProgSnapshot(f.read())
+    if not snapshot.valid:
+        raise ValueError(f'{filename} is not written by VizTracer, or by an incompatible version')
+    summary = TraceSummary()
+    for event in TraceReader(filename):
+        summary.add(event)
+    return snapshot, summary
+
+
+def build_report(sources, output, verbose=1):
+    """Combines the traces (see merge_traces) into output, an html report needs VizTracer (and memory for all events), other formats are streamed"""
+    if output.endswith('.html'):
+        from viztracer.report_builder import ReportBuilder
+        # newer versions of ReportBuilder only take a list of filenames, or a single trace dict, so we
+        # combine the traces ourselves, with the metadata of the first trace that has it
+        trace = {'traceEvents': []}
+        for events, metadata in map(_trace_source, sources):
+            trace['traceEvents'].extend(events)
+            for key, value in metadata.items():
+                trace.setdefault(key, value)
+        # ReportBuilder expects VizTracer's metadata, which perf only traces (e.g. giltracer --pid) do not have
+        trace.setdefault('viztracer_metadata', {})
+        builder = ReportBuilder(trace, verbose=verbose)
+        builder.save(output_file=output)
+    else:
+        summary = merge_traces(sources, output)
+        if verbose >= 1:
+            print(f"Wrote {summary.count} events to {output}")
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     usage=usage)
+    parser.add_argument('--verbose', '-v', action='count', default=1)
+    parser.add_argument('--quiet', '-q', action='count', default=0)
+    parser.add_argument('--output', '-o', default='merged.json', help="Output filename, gzip compressed when it ends with .gz (default %(default)s)")
+    parser.add_argument('--format', choices=['json', 'perfetto'], default=None, help="Write TraceEvent JSON, or a Perfetto protobuf trace (default: perfetto when the output filename ends with .pftrace(.gz), else json)")
+    parser.add_argument('--max-events', type=int, default=None, help="Only keep the last N trace events, to limit the output size, the ends of async and duration events whose begin was dropped are dropped too (default: keep all)")
+    parser.add_argument('inputs', nargs='+', help="TraceEvent JSON files to merge")
+
+    args = parser.parse_args(argv[1:])
+    verbose = args.verbose - args.quiet
+    summary = merge_traces(args.inputs, args.output, format=args.format, max_events=args.max_events)
+    if verbose >= 1:
+        print(f"Wrote {summary.count} events of {len(summary.pids)} processes/threads to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
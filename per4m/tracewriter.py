@@ -0,0 +1,110 @@
+from collections import Counter, deque
+import gzip
+import json
+
+
+class TraceEventWriter:
+    """Writes TraceEvent JSON incrementally, so memory does not grow with the number of events.
+
+    Events are written one by one as they come in. If max_events is given, we only keep the
+    last max_events events (a ring buffer) and write them out when closing, without the ends of
+    async (b/e) and duration (B/E) events whose begin was dropped. If compress is None,
+    gzip is used when the filename ends with .gz. The keys in metadata (e.g. viztracer_metadata)
+    are written next to traceEvents when closing.
+
+    Usage:
+
+    with TraceEventWriter('giltracer.json') as writer:
+        for header, event in gil2trace(sys.stdin):
+            writer.write(event)
+    """
+    def __init__(self, output, compress=None, max_events=None):
+        self.output = output
+        if compress is None:
+            compress = output.endswith('.gz')
+        self.compress = compress
+        self.max_events = max_events
+        self.ring = deque(maxlen=max_events) if max_events else None
+        self.count = 0
+        self.dropped = 0
+        self.metadata = {}
+        self.file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self.compress:
+            self.file = gzip.open(self.output, 'wt')
+        else:
+            self.file = open(self.output, 'w')
+        self.file.write('{"traceEvents": [')
+        return self
+
+    def write(self, event):
+        if self.ring is not None:
+            if len(self.ring) == self.max_events:
+                self.dropped += 1
+            self.ring.append(event)
+        else:
+            self._write(event)
+
+    def _write(self, event):
+        if self.count:
+            self.file.write(',\n')
+        self.file.write(json.dumps(event))
+        self.count += 1
+
+    def _balanced(self):
+        # the ring may have dropped the begin of an async (b) or duration (B) event, but kept its end,
+        # which viewers show as a slice that never ends, so we skip those ends
+        open_async = Counter()  # (pid, cat, id, name) -> number of begins we kept
+        open_duration = Counter()  # (pid, tid) -> number of begins we kept
+        for event in self.ring:
+            phase = event.get('ph')
+            if phase in ('b', 'e'):
+                counter, key = open_async, (event.get('pid'), event.get('cat'), event.get('id'), event.get('name'))
+            elif phase in ('B', 'E'):
+                counter, key = open_duration, (event.get('pid'), event.get('tid'))
+            else:
+                yield event
+                continue
+            if phase in ('b', 'B'):
+                counter[key] += 1
+            elif counter[key]:
+                counter[key] -= 1
+            else:
+                self.dropped += 1
+                continue
+            yield event
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.ring is not None:
+            for event in self._balanced():
+                self._write(event)
+            self.ring.clear()
+        self.file.write(']')
+        for key, value in self.metadata.items():
+            self.file.write(f', {json.dumps(key)}: {json.dumps(value)}')
+        self.file.write('}')
+        self.file.close()
+        self.file = None
+
+
+def trace_writer(output, format=None, **kwargs):
+    """Returns a TraceEventWriter, or a PerfettoWriter for format='perfetto' (default: when output ends with .pftrace or .pftrace.gz)"""
+    if format is None:
+        format = 'perfetto' if output.endswith(('.pftrace', '.pftrace.gz')) else 'json'
+    if format == 'perfetto':
+        from .perfetto import PerfettoWriter
+        return PerfettoWriter(output, **kwargs)
+    elif format == 'json':
+        return TraceEventWriter(output, **kwargs)
+    else:
+        raise ValueError(f'Unknown trace format {format}')
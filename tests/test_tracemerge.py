@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from per4m import tracemerge
+from per4m.tracemerge import build_report, load_snapshot, merge_traces
+
+
+def gil_events(pid):
+    for i in range(3):
+        yield {"pid": pid, "tid": f'{pid}', "ts": 10.0 * i, "name": "GIL", "ph": "b", "cat": "GIL state", "id": i}
+        yield {"pid": pid, "tid": f'{pid}', "ts": 10.0 * i + 5, "name": "GIL", "ph": "e", "cat": "GIL state", "id": i}
+
+
+def work():
+    return sum(range(100))
+
+
+def test_html_report(tmp_path):
+    viztracer = pytest.importorskip("viztracer")
+    tracer = viztracer.VizTracer(verbose=0)
+    tracer.start()
+    work()
+    tracer.stop()
+    tracer.parse()
+    sched = tmp_path / 'schedtracer.json'
+    sched.write_text(json.dumps({"traceEvents": [{"pid": 1, "tid": 1, "ts": 1.0, "dur": 2.0, "name": "S(GIL)", "ph": "X"}]}))
+    output = tmp_path / 'giltracer.html'
+    # like giltracer does: VizTracer's data, events of gil2trace, and a file
+    build_report([tracer.data, gil_events(1), str(sched)], str(output), verbose=0)
+    html = output.read_text()
+    assert 'work' in html
+    assert 'S(GIL)' in html
+    assert 'GIL state' in html
+
+
+def test_html_report_without_viztracer(tmp_path):
+    # e.g. giltracer --pid, where we only have perf data
+    pytest.importorskip("viztracer")
+    output = tmp_path / 'giltracer.html'
+    build_report([gil_events(1), gil_events(2)], str(output), verbose=0)
+    assert 'GIL state' in output.read_text()
+
+
+def test_json_report(tmp_path):
+    output = tmp_path / 'merged.json'
+    build_report([gil_events(1), gil_events(2)], str(output), verbose=0)
+    events = json.loads(output.read_text())['traceEvents']
+    assert len(events) == 12
+    assert [event['ts'] for event in events] == sorted(event['ts'] for event in events)
+
+
+def test_merge_unsorted(tmp_path):
+    # like VizTracer, a function is written after the calls it made
+    calls = [{"pid": 1, "tid": 1, "ts": 10.0 + i, "dur": 0.5, "name": "inner", "ph": "X"} for i in range(10)]
+    outer = {"pid": 1, "tid": 1, "ts": 5.0, "dur": 20.0, "name": "outer", "ph": "X"}
+    output = tmp_path / 'merged.json'
+    summary = merge_traces([calls + [outer], gil_events(2)], str(output), reorder=20)
+    events = json.loads(output.read_text())['traceEvents']
+    assert summary.count == len(events) == 17
+    assert [event['ts'] for event in events] == sorted(event['ts'] for event in events)
+
+
+@pytest.mark.parametrize("version", [(0, 15), (0, 0)])
+def test_load_snapshot(tmp_path, monkeypatch, version):
+    viztracer = pytest.importorskip("viztracer")
+    pytest.importorskip("viztracer.prog_snapshot")
+    # (0, 0) makes it fall back to ProgSnapshot(json_string)
+    monkeypatch.setattr(tracemerge, 'SNAPSHOT_VIZTRACER_VERSION', version)
+    tracer = viztracer.VizTracer(verbose=0)
+    tracer.start()
+    work()
+    tracer.stop()
+    filename = str(tmp_path / 'viztracer.json')
+    tracer.save(filename)
+    snapshot, summary = load_snapshot(filename)
+    assert summary.t0 is not None
+    assert summary.count > 0
+    assert snapshot.first_tree is not None